@@ -0,0 +1,232 @@
+# Compact storage for the demand matrices, which are mostly null requests
+# A demand fold is an operand tile padded with null rows for the inter fold gaps and null columns
+# for the unused array rows or cols, and usually skewed, ie. column c is shifted down by c rows.
+# The valid requests of each row are then a contiguous band of columns, hence for each row only
+# the start column, the length of the band and the offset of the band in a packed array of the
+# values are kept. The null requests around the bands are never stored.
+#
+# The memory system reads the valid requests of a block of rows straight from the packed values,
+# the dense matrix with the -1s is built only when it is needed, eg. for the SRAM trace files.
+import numpy as np
+
+
+class band_matrix:
+    def __init__(self):
+        self.shape = (0, 0)
+        self.dtype = np.dtype(np.int32)
+
+        # Per row: the first column of the band and its length
+        self.row_starts = np.zeros(0, dtype=np.int64)
+        self.row_lengths = np.zeros(0, dtype=np.int64)
+
+        # The band of row r is values[row_offsets[r]:row_offsets[r + 1]]
+        # A block of rows shares the values of the matrix it is taken from, hence the offsets need not start at 0
+        self.row_offsets = np.zeros(1, dtype=np.int64)
+        self.values = np.zeros(0, dtype=np.int32)
+
+        self.params_set_flag = False
+
+    #
+    def set_params(self, num_cols, row_starts, row_lengths, row_offsets, values):
+        assert row_starts.shape[0] == row_lengths.shape[0], 'Row starts and lengths do not match'
+        assert row_offsets.shape[0] == row_lengths.shape[0] + 1, 'Row offsets do not match the rows'
+
+        self.shape = (row_lengths.shape[0], num_cols)
+        self.dtype = values.dtype
+
+        self.row_starts = row_starts
+        self.row_lengths = row_lengths
+        self.row_offsets = row_offsets
+        self.values = values
+
+        self.params_set_flag = True
+
+    # The rows [start_row, end_row) as a band matrix sharing the arrays of this one
+    def get_rows(self, start_row, end_row):
+        assert self.params_set_flag, 'Parameters are not set'
+
+        end_row = min(end_row, self.shape[0])
+        start_row = min(start_row, end_row)
+
+        rows = band_matrix()
+        rows.set_params(num_cols=self.shape[1],
+                        row_starts=self.row_starts[start_row:end_row],
+                        row_lengths=self.row_lengths[start_row:end_row],
+                        row_offsets=self.row_offsets[start_row:end_row + 1],
+                        values=self.values)
+        return rows
+
+    # Only the unit step slices of the rows, eg. band[start:end] or band[start:end, :]
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            assert len(key) == 2 and key[1] == slice(None), 'Only the rows of a band matrix can be sliced'
+            key = key[0]
+
+        assert isinstance(key, slice) and key.step in (None, 1), 'Only the rows of a band matrix can be sliced'
+        start_row, end_row, _ = key.indices(self.shape[0])
+        return self.get_rows(start_row, end_row)
+
+    # Requests in the bands, in the order of service ie. row by row, null requests inside the bands included
+    def get_band_elems(self):
+        assert self.params_set_flag, 'Parameters are not set'
+        return self.values[self.row_offsets[0]:self.row_offsets[-1]]
+
+    # Row of each of the requests in the bands
+    def get_band_elem_rows(self):
+        assert self.params_set_flag, 'Parameters are not set'
+        return np.repeat(np.arange(self.shape[0]), self.row_lengths)
+
+    # Rows with nothing in their band
+    def get_null_rows(self):
+        assert self.params_set_flag, 'Parameters are not set'
+        return self.row_lengths == 0
+
+    # The matrix with the null requests filled in
+    def to_dense(self):
+        assert self.params_set_flag, 'Parameters are not set'
+
+        dense = np.full(self.shape, -1, dtype=self.dtype)
+        elems = self.get_band_elems()
+        if elems.shape[0] == 0:
+            return dense
+
+        elem_rows = self.get_band_elem_rows()
+        first_elem_of_row = self.row_offsets[:-1] - self.row_offsets[0]
+        elem_cols = np.arange(elems.shape[0]) - np.repeat(first_elem_of_row - self.row_starts, self.row_lengths)
+        dense[elem_rows, elem_cols] = elems
+
+        return dense
+
+    #
+    def __array__(self, dtype=None, copy=None):
+        dense = self.to_dense()
+        if dtype is not None:
+            dense = dense.astype(dtype, copy=False)
+        return dense
+
+    # The arrays held, eg. to make these read only
+    def get_arrays(self):
+        return [self.row_starts, self.row_lengths, self.row_offsets, self.values]
+
+    #
+    def get_nbytes(self):
+        return sum([array.nbytes for array in self.get_arrays()])
+
+
+# Band matrix of skew_matrix() applied to the input padded with prefix_rows null rows on the top,
+# suffix_rows null rows at the bottom and null columns on the right up to num_cols
+# Row k of the skewed matrix holds the anti-diagonal k - prefix_rows of the input, from the left to the right
+def get_skewed_band(input_matrix_np, num_cols, prefix_rows=0, suffix_rows=0):
+    input_matrix_np = np.asarray(input_matrix_np)
+    in_rows, in_cols = input_matrix_np.shape
+    assert in_cols <= num_cols, 'Input is wider than the band matrix'
+
+    num_rows = prefix_rows + in_rows + suffix_rows + num_cols - 1
+    diagonals = np.arange(num_rows, dtype=np.int64) - prefix_rows
+
+    # Columns of the input on each anti-diagonal
+    row_starts = np.maximum(diagonals - in_rows + 1, 0)
+    row_ends = np.minimum(diagonals + 1, in_cols)
+    row_lengths = np.maximum(row_ends - row_starts, 0)
+    row_starts[row_lengths == 0] = 0
+
+    row_offsets = np.zeros(num_rows + 1, dtype=np.int64)
+    np.cumsum(row_lengths, out=row_offsets[1:])
+
+    num_elems = int(row_offsets[-1])
+    elem_cols = np.arange(num_elems, dtype=np.int64) \
+                - np.repeat(row_offsets[:-1] - row_starts, row_lengths)
+    elem_rows = np.repeat(diagonals, row_lengths) - elem_cols
+    values = input_matrix_np[elem_rows, elem_cols]
+
+    band = band_matrix()
+    band.set_params(num_cols=num_cols, row_starts=row_starts, row_lengths=row_lengths,
+                    row_offsets=row_offsets, values=values)
+    return band
+
+
+# Band matrix of the input padded as in get_skewed_band(), without the skew
+def get_unskewed_band(input_matrix_np, num_cols, prefix_rows=0, suffix_rows=0):
+    input_matrix_np = np.asarray(input_matrix_np)
+    in_rows, in_cols = input_matrix_np.shape
+    assert in_cols <= num_cols, 'Input is wider than the band matrix'
+
+    num_rows = prefix_rows + in_rows + suffix_rows
+
+    row_starts = np.zeros(num_rows, dtype=np.int64)
+    row_lengths = np.zeros(num_rows, dtype=np.int64)
+    row_lengths[prefix_rows:prefix_rows + in_rows] = in_cols
+
+    row_offsets = np.zeros(num_rows + 1, dtype=np.int64)
+    np.cumsum(row_lengths, out=row_offsets[1:])
+
+    band = band_matrix()
+    band.set_params(num_cols=num_cols, row_starts=row_starts, row_lengths=row_lengths,
+                    row_offsets=row_offsets, values=np.ascontiguousarray(input_matrix_np).reshape(-1))
+    return band
+
+
+# Stacks the band matrices along the rows
+def concatenate_bands(bands):
+    assert len(bands) > 0, 'No band matrices to stack'
+    if len(bands) == 1:
+        return bands[0]
+
+    num_cols = bands[0].shape[1]
+    values = []
+    row_offsets = [np.zeros(1, dtype=np.int64)]
+    num_elems = 0
+    for band in bands:
+        assert band.shape[1] == num_cols, 'Band matrices should have the same number of columns'
+        values.append(band.get_band_elems())
+        row_offsets.append(band.row_offsets[1:] - band.row_offsets[0] + num_elems)
+        num_elems += values[-1].shape[0]
+
+    stacked = band_matrix()
+    stacked.set_params(num_cols=num_cols,
+                       row_starts=np.concatenate([band.row_starts for band in bands]),
+                       row_lengths=np.concatenate([band.row_lengths for band in bands]),
+                       row_offsets=np.concatenate(row_offsets),
+                       values=np.concatenate(values))
+    return stacked
+
+
+# Stacks the blocks of demand lines, either all band matrices or all arrays
+def concatenate_demand_blocks(blocks):
+    if isinstance(blocks[0], band_matrix):
+        return concatenate_bands(blocks)
+
+    if len(blocks) == 1:
+        return blocks[0]
+    return np.concatenate(blocks, axis=0)
+
+
+# The valid requests of a block of demand lines, given as an array or a band matrix,
+# in the order of service and the line each of them is on
+# For a band matrix only the requests in the bands are looked at
+def get_valid_requests(demand_lines):
+    if isinstance(demand_lines, band_matrix):
+        elems = demand_lines.get_band_elems()
+        elem_lines = demand_lines.get_band_elem_rows()
+        valid = elems != -1
+        if not valid.all():
+            elems = elems[valid]
+            elem_lines = elem_lines[valid]
+        return elems, elem_lines
+
+    valid = demand_lines != -1
+    return demand_lines[valid], np.nonzero(valid)[0]
+
+
+# The demand lines as an array, with the null requests filled in
+def get_dense_demand(demand_lines):
+    if isinstance(demand_lines, band_matrix):
+        return demand_lines.to_dense()
+    return demand_lines
+
+
+# Lines of a block of demand lines which have no requests, for a band matrix the lines with empty bands
+def get_null_lines(demand_lines):
+    if isinstance(demand_lines, band_matrix):
+        return demand_lines.get_null_rows()
+    return np.all(demand_lines == -1, axis=1)
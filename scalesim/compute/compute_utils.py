@@ -0,0 +1,31 @@
+# Helpers shared by the systolic compute classes of all three dataflows
+from functools import lru_cache
+
+import numpy as np
+
+
+# Element (r, c) of a prefetch matrix is read on the anti-diagonal r + c,
+# and on a given anti-diagonal the elements are read bottom to top.
+# The order only depends on the shape, hence the permutation is computed once per shape
+# and shared between the folds and the layers.
+@lru_cache(maxsize=32)
+def get_anti_diagonal_order(num_rows, num_cols):
+    row_ids, col_ids = np.indices((num_rows, num_cols))
+
+    # Sort key: diagonal id first, then the row id in descending order
+    sort_key = (row_ids + col_ids) * num_rows + (num_rows - 1 - row_ids)
+    order = np.argsort(sort_key, axis=None, kind='stable')
+
+    # The cached array is shared, make sure no one modifies it in place
+    order.flags.writeable = False
+    return order
+
+
+#
+def rollout_along_anti_diagonals(input_matrix_np):
+    num_rows, num_cols = input_matrix_np.shape
+    order = get_anti_diagonal_order(num_rows, num_cols)
+
+    # A single gather with the precomputed permutation
+    rolled_out = input_matrix_np.reshape(-1)[order]
+    return rolled_out.reshape((1, num_rows * num_cols))
@@ -1,9 +1,16 @@
 import math
+from collections import OrderedDict
+
 import numpy as np
 from tqdm import tqdm
 
 from scalesim.topology_utils import topologies as topoutil
 from scalesim.scale_config import scale_config as cfg
+from scalesim.dtype_utils import get_address_dtype
+from scalesim.matrix_spill import spill_chunk_bytes
+
+# Tiles kept in the lazy mode, see operand_matrix.enable_lazy_tiles()
+default_max_cached_tiles = 16
 
 
 # This class defines data types for operand matrices
@@ -29,10 +36,26 @@ class operand_matrix(object):
         self.ifmap_offset, self.filter_offset, self.ofmap_offset = 0, 10000000, 20000000
         self.matrix_offset_arr = [0, 10000000, 20000000]
 
+        # Address data type, see dtype_utils
+        self.addr_dtype = np.int32
+
+        # The conv windows of the GEMM and 1x1 conv layers are contiguous in the ifmap and do not overlap,
+        # their ifmap matrix is the ifmap itself in the row major order, see calc_dense_ifmap_elem_addr()
+        self.dense_ifmap = False
+
         # Address matrices
-        self.ifmap_addr_matrix = np.ones((self.ofmap_px_per_filt, self.conv_window_size), dtype=int)
-        self.filter_addr_matrix = np.ones((self.conv_window_size, self.num_filters), dtype=int)
-        self.ofmap_addr_matrix = np.ones((self.ofmap_px_per_filt, self.num_filters), dtype=int)
+        self.ifmap_addr_matrix = np.ones((self.ofmap_px_per_filt, self.conv_window_size), dtype=self.addr_dtype)
+        self.filter_addr_matrix = np.ones((self.conv_window_size, self.num_filters), dtype=self.addr_dtype)
+        self.ofmap_addr_matrix = np.ones((self.ofmap_px_per_filt, self.num_filters), dtype=self.addr_dtype)
+
+        # Lazy mode: the matrices are never built in full, the requested tiles are computed on demand
+        # The recently used tiles are kept, keyed by the operand and the tile bounds
+        self.lazy_tiles = False
+        self.max_cached_tiles = default_max_cached_tiles
+        self.tile_cache = OrderedDict()
+
+        # The matrices larger than its threshold are kept in files, see matrix_spill
+        self.spill = None
 
         # Flags
         self.params_set_flag = False
@@ -90,10 +113,28 @@ class operand_matrix(object):
         self.ifmap_offset, self.filter_offset, self.ofmap_offset \
             = self.config.get_offsets()
 
+        # Overflow check: the addresses of all the operands, offsets included, should fit the address type
+        max_ifmap_addr = self.ifmap_offset \
+                         + self.ifmap_rows * self.ifmap_cols * self.num_input_channels * self.batch_size
+        max_filter_addr = self.filter_offset + self.conv_window_size * self.num_filters
+        max_ofmap_addr = self.ofmap_offset + self.ofmap_px_per_filt * self.num_filters * self.batch_size
+        min_addr = min(self.ifmap_offset, self.filter_offset, self.ofmap_offset)
+        max_addr = max(max_ifmap_addr, max_filter_addr, max_ofmap_addr)
+        self.addr_dtype = get_address_dtype(min_address=min_addr, max_address=max_addr)
+
+        # GEMM layers: the filter spans a full ifmap row, 1x1 convs: the filter is a single pixel
+        # With the unit strides, the window of ofmap px i is the ifmap block starting at i * conv_window_size
+        gemm_layout = self.filter_rows == 1 and self.filter_cols == self.ifmap_cols and self.row_stride == 1
+        pointwise_layout = self.filter_rows == 1 and self.filter_cols == 1 \
+                           and self.row_stride == 1 and self.col_stride == 1
+        self.dense_ifmap = gemm_layout or pointwise_layout
+
         # Address matrices: This is needed to take into account the updated dimensions
-        self.ifmap_addr_matrix = np.ones((self.ofmap_px_per_filt * self.batch_size, self.conv_window_size), dtype='>i4')
-        self.filter_addr_matrix = np.ones((self.conv_window_size, self.num_filters), dtype='>i4')
-        self.ofmap_addr_matrix = np.ones((self.ofmap_px_per_filt, self.num_filters), dtype='>i4')
+        # np.zeros does not touch the memory, the matrices are filled in create_operand_matrices()
+        self.ifmap_addr_matrix = np.zeros((self.ofmap_px_per_filt * self.batch_size, self.conv_window_size),
+                                          dtype=self.addr_dtype)
+        self.filter_addr_matrix = np.zeros((self.conv_window_size, self.num_filters), dtype=self.addr_dtype)
+        self.ofmap_addr_matrix = np.zeros((self.ofmap_px_per_filt, self.num_filters), dtype=self.addr_dtype)
         self.params_set_flag = True
 
         # TODO: This should be called from top level
@@ -108,6 +149,96 @@ class operand_matrix(object):
         #    print(message)
         #    return False, None, None, None
 
+    # The matrix getters return operand_tile_view objects instead of the matrices,
+    # and the parts are computed when these are requested. For the layers whose matrices do not fit in the memory
+    def enable_lazy_tiles(self, max_cached_tiles=default_max_cached_tiles):
+        assert max_cached_tiles > 0, 'At least one tile should be cached'
+
+        self.lazy_tiles = True
+        self.max_cached_tiles = max_cached_tiles
+        self.tile_cache = OrderedDict()
+
+    #
+    def is_lazy(self):
+        return self.lazy_tiles
+
+    # The address matrices above the spill threshold are built chunk by chunk in a memmap
+    def set_matrix_spill(self, spill_obj):
+        self.spill = spill_obj
+
+    #
+    def needs_spill(self, operand):
+        if self.spill is None:
+            return False
+        rows, cols = self.get_matrix_shape(operand)
+        return self.spill.needs_spill(rows * cols * np.dtype(self.addr_dtype).itemsize)
+
+    # Fills the memmap a block of rows at a time, only the temporaries of one block are in the memory
+    def create_spilled_matrix(self, operand):
+        rows, cols = self.get_matrix_shape(operand)
+        addr_matrix = self.spill.allocate((rows, cols), self.addr_dtype, name=operand + '_operand')
+
+        # The index math holds several temporaries of the size of the block
+        row_bytes = max(8 * cols * np.dtype(self.addr_dtype).itemsize, 1)
+        block_rows = max(spill_chunk_bytes // row_bytes, 1)
+        for start_row in range(0, rows, block_rows):
+            num_rows = min(block_rows, rows - start_row)
+            addr_matrix[start_row: start_row + num_rows, :] = self.calc_tile(operand, start_row, num_rows, 0, cols)
+
+        return addr_matrix
+
+    # Dimensions of the operand matrices
+    def get_matrix_shape(self, operand):
+        if operand == 'ifmap':
+            return self.ofmap_px_per_filt * self.batch_size, self.conv_window_size
+        elif operand == 'filter':
+            return self.conv_window_size, self.num_filters
+        return self.ofmap_px_per_filt, self.num_filters
+
+    # Lazy mode counterpart of the get_*_matrix_part() functions
+    def get_lazy_tile(self, operand, start_row, num_rows, start_col, num_cols):
+        my_name = 'operand_matrix.get_lazy_tile(): '
+        err_prefix = 'Error: ' + my_name
+        if not self.params_set_flag:
+            message = err_prefix + ": Parameters not set yet. Run set_params(). Exiting!"
+            print(message)
+            return -1, np.zeros((1, 1))
+
+        matrix_rows, matrix_cols = self.get_matrix_shape(operand)
+        if (start_row + num_rows) > matrix_rows or (start_col + num_cols) > matrix_cols:
+            message = err_prefix + ": Illegal arguments. Exiting!"
+            print(message)
+            return -2, np.zeros((1, 1))
+
+        key = (operand, start_row, num_rows, start_col, num_cols)
+        if key in self.tile_cache:
+            self.tile_cache.move_to_end(key)
+            return 0, self.tile_cache[key]
+
+        tile = self.calc_tile(operand, start_row, num_rows, start_col, num_cols)
+
+        # The cached tile is handed out again, make sure no one modifies it in place
+        tile.flags.writeable = False
+
+        self.tile_cache[key] = tile
+        if len(self.tile_cache) > self.max_cached_tiles:
+            self.tile_cache.popitem(last=False)
+
+        return 0, tile
+
+    # Addresses of a block of the operand matrix
+    def calc_tile(self, operand, start_row, num_rows, start_col, num_cols):
+        row_indices = np.arange(start_row, start_row + num_rows, dtype=self.addr_dtype)
+        col_indices = np.arange(start_col, start_col + num_cols, dtype=self.addr_dtype)
+        if operand == 'ifmap' and self.dense_ifmap:
+            return self.calc_dense_ifmap_elem_addr(row_indices, col_indices)
+        elif operand == 'ifmap':
+            i, j = np.meshgrid(row_indices, col_indices, indexing='ij')
+            return self.calc_ifmap_elem_addr(i, j)
+        elif operand == 'filter':
+            return self.calc_filter_elem_addr(np.expand_dims(row_indices, axis=1), col_indices)
+        return self.calc_ofmap_elem_addr(np.expand_dims(row_indices, axis=1), col_indices)
+
     # top level function to create the operand matrices
     def create_operand_matrices(self):
         my_name = 'operand_matrix.create_operand_matrices(): '
@@ -138,8 +269,18 @@ class operand_matrix(object):
             print(message)
             return -1
 
-        row_indices = np.arange(self.batch_size * self.ofmap_px_per_filt)
-        col_indices = np.arange(self.conv_window_size)
+        if self.needs_spill('ifmap'):
+            self.ifmap_addr_matrix = self.create_spilled_matrix('ifmap')
+            return 0
+
+        # The index arithmetic stays within the address range, hence it is done in the address type
+        row_indices = np.arange(self.batch_size * self.ofmap_px_per_filt, dtype=self.addr_dtype)
+        col_indices = np.arange(self.conv_window_size, dtype=self.addr_dtype)
+
+        if self.dense_ifmap:
+            self.ifmap_addr_matrix = self.calc_dense_ifmap_elem_addr(row_indices, col_indices)
+            return 0
+
         # Create 2D index arrays using meshgrid
         i, j = np.meshgrid(row_indices, col_indices, indexing='ij')
 
@@ -166,13 +307,20 @@ class operand_matrix(object):
         c_col, c_ch = np.divmod(k, channel)
 
         valid_indices = np.logical_and(c_row + i_row < ifmap_rows, c_col + i_col < ifmap_cols)
-        ifmap_px_addr = np.full(i.shape, -1)
+        ifmap_px_addr = np.full(i.shape, -1, dtype=self.addr_dtype)
         if valid_indices.any():
             internal_address = (c_row[valid_indices] * ifmap_cols + c_col[valid_indices]) * channel + c_ch[valid_indices]
             ifmap_px_addr[valid_indices] = internal_address + window_addr[valid_indices] + offset
 
         return ifmap_px_addr
 
+    # The ifmap matrix of the dense layers, an outer sum of the row and col indices
+    # There is no index math of the conv windows and no invalid element to mask
+    def calc_dense_ifmap_elem_addr(self, row_indices, col_indices):
+        row_addr = np.expand_dims(row_indices * self.conv_window_size + self.ifmap_offset, axis=1)
+        ifmap_px_addr = row_addr + col_indices
+        return ifmap_px_addr.astype(self.addr_dtype, copy=False)
+
     # creates the ofmap operand
     def create_ofmap_matrix(self):
         my_name = 'operand_matrix.create_ofmap_matrix(): '
@@ -182,8 +330,12 @@ class operand_matrix(object):
             print(message)
             return -1
 
-        row_indices = np.expand_dims(np.arange(self.ofmap_px_per_filt), axis=1)
-        col_indices = np.arange(self.num_filters)
+        if self.needs_spill('ofmap'):
+            self.ofmap_addr_matrix = self.create_spilled_matrix('ofmap')
+            return 0
+
+        row_indices = np.expand_dims(np.arange(self.ofmap_px_per_filt, dtype=self.addr_dtype), axis=1)
+        col_indices = np.arange(self.num_filters, dtype=self.addr_dtype)
         self.ofmap_addr_matrix = self.calc_ofmap_elem_addr(row_indices, col_indices)
 
         return 0
@@ -205,8 +357,12 @@ class operand_matrix(object):
             print(message)
             return -1
 
-        row_indices = np.expand_dims(np.arange(self.conv_window_size), axis=1)
-        col_indices = np.arange(self.num_filters)
+        if self.needs_spill('filter'):
+            self.filter_addr_matrix = self.create_spilled_matrix('filter')
+            return 0
+
+        row_indices = np.expand_dims(np.arange(self.conv_window_size, dtype=self.addr_dtype), axis=1)
+        col_indices = np.arange(self.num_filters, dtype=self.addr_dtype)
         self.filter_addr_matrix = self.calc_filter_elem_addr(row_indices, col_indices)
 
         return 0
@@ -228,6 +384,9 @@ class operand_matrix(object):
             num_rows = self.ofmap_px_per_filt
         if num_cols == -1:
             num_cols = self.conv_window_size
+        if self.lazy_tiles:
+            return self.get_lazy_tile('ifmap', start_row, num_rows, start_col, num_cols)
+
         my_name = 'operand_matrix.get_ifmap_matrix_part(): '
         err_prefix = 'Error: ' + my_name
         if not self.matrices_ready_flag:
@@ -252,6 +411,8 @@ class operand_matrix(object):
         return 0, ret_mat
 
     def get_ifmap_matrix(self):
+        if self.lazy_tiles:
+            return 0, operand_tile_view(self, 'ifmap')
         return self.get_ifmap_matrix_part()
 
     # function to get a part or the full filter operand
@@ -262,6 +423,9 @@ class operand_matrix(object):
             num_rows = self.conv_window_size
         if num_cols == -1:
             num_cols = self.num_filters
+        if self.lazy_tiles:
+            return self.get_lazy_tile('filter', start_row, num_rows, start_col, num_cols)
+
         my_name = 'operand_matrix.get_filter_matrix_part(): '
         err_prefix = 'Error: ' + my_name
         if not self.matrices_ready_flag:
@@ -288,6 +452,8 @@ class operand_matrix(object):
         return 0, ret_mat
 
     def get_filter_matrix(self):
+        if self.lazy_tiles:
+            return 0, operand_tile_view(self, 'filter')
         return self.get_filter_matrix_part()
 
     # function to get a part or the full ofmap operand
@@ -300,6 +466,9 @@ class operand_matrix(object):
             num_rows = self.ofmap_px_per_filt
         if num_cols == -1:
             num_cols = self.num_filters
+        if self.lazy_tiles:
+            return self.get_lazy_tile('ofmap', start_row, num_rows, start_col, num_cols)
+
         my_name = 'operand_matrix.get_ofmap_matrix_part(): '
         err_prefix = 'Error: ' + my_name
         if not self.matrices_ready_flag:
@@ -327,9 +496,16 @@ class operand_matrix(object):
         return 0, ret_mat
 
     def get_ofmap_matrix(self):
+        if self.lazy_tiles:
+            return 0, operand_tile_view(self, 'ofmap')
         return self.get_ofmap_matrix_part()
 
     def get_all_operand_matrix(self):
+        if self.lazy_tiles:
+            return operand_tile_view(self, 'ifmap'), \
+                   operand_tile_view(self, 'filter'), \
+                   operand_tile_view(self, 'ofmap')
+
         if not self.matrices_ready_flag:
             me = 'operand_matrix.' + 'get_all_operand_matrix()'
             message = 'ERROR:' + me + ': Matrices not ready or matrix gen failed'
@@ -341,6 +517,62 @@ class operand_matrix(object):
                self.ofmap_addr_matrix
 
 
+# Stands in for an operand matrix in the lazy mode
+# Slicing it computes only the sliced tile, so the compute classes pull the operands fold by fold
+# as they slice the matrices. Only the basic slices with a unit step are supported.
+class operand_tile_view(object):
+    def __init__(self, op_mat_obj, operand, transposed=False):
+        self.op_mat_obj = op_mat_obj
+        self.operand = operand
+        self.transposed = transposed
+
+        rows, cols = op_mat_obj.get_matrix_shape(operand)
+        if transposed:
+            rows, cols = cols, rows
+        self.shape = (rows, cols)
+        self.ndim = 2
+        self.dtype = np.dtype(op_mat_obj.addr_dtype)
+
+    #
+    def transpose(self, axes=None):
+        assert axes is None or tuple(axes) == (1, 0), 'Only 2D transpose is supported'
+        return operand_tile_view(self.op_mat_obj, self.operand, transposed=not self.transposed)
+
+    @property
+    def T(self):
+        return self.transpose()
+
+    #
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key, slice(None))
+        assert len(key) == 2, 'Operand tiles are 2D'
+
+        bounds = []
+        for idx, dim in zip(key, self.shape):
+            assert isinstance(idx, slice), 'Operand tiles support slices only'
+            start, stop, step = idx.indices(dim)
+            assert step == 1, 'Operand tiles support unit steps only'
+            bounds.append((start, max(stop - start, 0)))
+
+        if self.transposed:
+            bounds.reverse()
+
+        (start_row, num_rows), (start_col, num_cols) = bounds
+        _, tile = self.op_mat_obj.get_lazy_tile(self.operand, start_row, num_rows, start_col, num_cols)
+
+        if self.transposed:
+            return tile.T
+        return tile
+
+    # The full matrix, for the code which needs it as an array
+    def __array__(self, dtype=None, copy=None):
+        full_matrix = self[:, :]
+        if dtype is not None:
+            return full_matrix.astype(dtype)
+        return np.array(full_matrix)
+
+
 if __name__ == '__main__':
     opmat = operand_matrix()
     tutil = topoutil()
@@ -1,7 +1,9 @@
 import math
 import numpy as np
-from tqdm import tqdm
 from scalesim.scale_config import scale_config as cfg
+from scalesim.compute.compute_utils import rollout_along_anti_diagonals
+from scalesim.matrix_spill import block_writer
+from scalesim.band_matrix import get_skewed_band, get_unskewed_band
 
 
 class systolic_compute_is:
@@ -41,6 +43,9 @@ class systolic_compute_is:
         self.mapping_efficiency_per_fold = []
         self.compute_utility_per_fold = []
 
+        # The full demand matrices larger than its threshold are written to files, see matrix_spill
+        self.spill = None
+
         # Flags
         self.params_set_flag = False
         self.prefetch_mat_ready_flag = False
@@ -77,6 +82,10 @@ class systolic_compute_is:
 
         self.params_set_flag = True
 
+    #
+    def set_matrix_spill(self, spill_obj):
+        self.spill = spill_obj
+
     #
     def create_prefetch_matrices(self):
         assert self.params_set_flag, 'Parameters are not set'
@@ -100,7 +109,7 @@ class systolic_compute_is:
 
             #If there is under utilization, fill them with null requests
             if delta > 0:
-                null_req_mat = np.ones((self.Sr, delta)) * -1
+                null_req_mat = np.full((self.Sr, delta), -1, dtype=self.ifmap_op_mat.dtype)
                 this_fold_prefetch = np.concatenate((this_fold_prefetch, null_req_mat), axis=1)
 
             if fc == 0:
@@ -124,7 +133,7 @@ class systolic_compute_is:
             this_fold_prefetch = np.transpose(this_fold_prefetch)
 
             if delta > 0:
-                null_req_mat = np.ones((self.T, delta)) * -1
+                null_req_mat = np.full((self.T, delta), -1, dtype=self.filter_op_mat.dtype)
                 this_fold_prefetch = np.concatenate((this_fold_prefetch, null_req_mat), axis=1)
 
             if fr == 0:
@@ -135,182 +144,145 @@ class systolic_compute_is:
         # Fixing ISSUE #15, #16
         # Roll out the matrices along the diagonal to account for temporal locality when there is a skew in demand
 
-        M, N = self.filter_prefetch_matrix.shape
-        num_elems = M * N
-        num_diags = M + N
-        prefetches = np.zeros((1, num_elems))
-        idx = 0
-
-        pbar = tqdm(total=M * N, disable=True)
-        # print('DEBUG: Total = ' + str(num_elems) + ' Diags = ' + str(num_diags))
-
-        for diag_id in range(num_diags):
-            max_row_id = min(diag_id, M - 1)
-            min_row_id = max(0, diag_id - N + 1)
-            valid_rows = max_row_id - min_row_id + 1
-
-            for offset in range(valid_rows):
-                row_id = max_row_id - offset
-                col_id = diag_id - row_id
-
-                elem = self.filter_prefetch_matrix[row_id][col_id]
-                prefetches[0, idx] = elem
-                idx += 1
-                pbar.update(1)
-
-        pbar.close()
-        self.filter_prefetch_matrix = prefetches
+        self.filter_prefetch_matrix = rollout_along_anti_diagonals(self.filter_prefetch_matrix)
 
     #
     def create_demand_matrices(self):
         assert self.params_set_flag, 'Parameters are not set'
 
-        self.create_ifmap_demand_mat()
-        self.create_filter_demand_mat()
-        self.create_ofmap_demand_mat()
+        # The folds are stacked as they come, in a file if the matrices grow too large
+        ifmap_demand_writer = block_writer(self.spill, name='ifmap_demand')
+        filter_demand_writer = block_writer(self.spill, name='filter_demand')
+        ofmap_demand_writer = block_writer(self.spill, name='ofmap_demand')
 
-        assert self.ifmap_demand_matrix.shape[0] == self.filter_demand_matrix.shape[0], 'IFMAP and Filter demands out of sync'
-        assert self.ofmap_demand_matrix.shape[0] == self.filter_demand_matrix.shape[0], 'OFMAP and Filter demands out of sync'
-        assert self.ifmap_demand_matrix.shape[1] == self.arr_col, 'IFMAP demands exceed the rows'
-        assert self.filter_demand_matrix.shape[1] == self.arr_row,'Filter demands exceed the cols'
-        assert self.ofmap_demand_matrix.shape[1] == self.arr_col, 'OFMAP demands exceed the cols'
+        for ifmap_fold_demand, filter_fold_demand, ofmap_fold_demand in self.get_demand_matrices_per_fold():
+            ifmap_demand_writer.append(ifmap_fold_demand)
+            filter_demand_writer.append(filter_fold_demand)
+            ofmap_demand_writer.append(ofmap_fold_demand)
 
-        self.demand_mat_ready_flag = True
+        self.ifmap_demand_matrix = ifmap_demand_writer.finish()
+        self.filter_demand_matrix = filter_demand_writer.finish()
+        self.ofmap_demand_matrix = ofmap_demand_writer.finish()
 
-    #
-    def create_ifmap_demand_mat(self):
+    # Generates the demand matrices one fold at a time, in the order in which the folds are computed
+    # This way the memory system can consume the demands without holding the matrices of the entire layer
+    # The demands of each fold are band matrices, see band_matrix
+    def get_demand_bands_per_fold(self):
         assert self.params_set_flag, 'Parameters are not set'
 
-        inter_fold_gap_suffix = self.arr_row + self.arr_col + self.T - 2
-        inter_fold_gap_suffix_mat = np.ones((inter_fold_gap_suffix, self.arr_col)) * -1
+        self.ifmap_reads = 0
+        self.filter_reads = 0
+        self.ofmap_writes = 0
+        self.mapping_efficiency_per_fold = []
+        self.compute_utility_per_fold = []
 
         for fc in range(self.col_fold):
             for fr in range(self.row_fold):
-                row_start_id = fr * self.arr_row
-                row_end_idx = min(row_start_id + self.arr_row, self.Sr)
-                row_delta = self.arr_row - (row_end_idx - row_start_id)
+                ifmap_fold_demand = self.create_ifmap_demand_fold(fc, fr)
+                filter_fold_demand = self.create_filter_demand_fold(fr)
+                ofmap_fold_demand = self.create_ofmap_demand_fold(fc)
 
-                col_start_id = fc * self.arr_col
-                col_end_idx = min(col_start_id + self.arr_col, self.Sc)
-                col_delta = self.arr_col - (col_end_idx - col_start_id)
+                assert ifmap_fold_demand.shape[0] == filter_fold_demand.shape[0], 'IFMAP and Filter demands out of sync'
+                assert ofmap_fold_demand.shape[0] == filter_fold_demand.shape[0], 'OFMAP and Filter demands out of sync'
+                assert ifmap_fold_demand.shape[1] == self.arr_col, 'IFMAP demands exceed the rows'
+                assert filter_fold_demand.shape[1] == self.arr_row,'Filter demands exceed the cols'
+                assert ofmap_fold_demand.shape[1] == self.arr_col, 'OFMAP demands exceed the cols'
 
-                # Indexing the cols with row start and row end idx are correct
-                # See the comment on ifmap_prefetch generation
-                this_fold_demand = self.ifmap_op_mat_trans[row_start_id:row_end_idx, col_start_id: col_end_idx]
-                self.ifmap_reads += this_fold_demand.shape[0] * this_fold_demand.shape[1]
+                yield ifmap_fold_demand, filter_fold_demand, ofmap_fold_demand
 
-                # Take into account under utilization
-                if col_delta > 0:
-                    null_req_mat = np.ones((this_fold_demand.shape[0], col_delta)) * -1
-                    this_fold_demand = np.concatenate((this_fold_demand, null_req_mat), axis=1)
+        self.demand_mat_ready_flag = True
 
-                if row_delta > 0:
-                    null_req_mat = np.ones((row_delta, self.arr_col)) * -1
-                    this_fold_demand = np.concatenate((this_fold_demand, null_req_mat), axis=0)
+    # Same as above, with the null requests of the demand matrices filled in
+    def get_demand_matrices_per_fold(self):
+        for ifmap_fold_demand, filter_fold_demand, ofmap_fold_demand in self.get_demand_bands_per_fold():
+            yield ifmap_fold_demand.to_dense(), filter_fold_demand.to_dense(), ofmap_fold_demand.to_dense()
 
-                # The IFMAP elems are needed to be filled in reverse order to ensure that
-                # top element is pushed in last to maintain alignment with the input elements
-                this_fold_demand = np.flip(this_fold_demand, 0)
+    #
+    def create_ifmap_demand_fold(self, fc, fr):
+        # Account for the cycles for partial sum generation and accumulation
+        inter_fold_gap_suffix = self.arr_row + self.arr_col + self.T - 2
+
+        row_start_id = fr * self.arr_row
+        row_end_idx = min(row_start_id + self.arr_row, self.Sr)
+        row_delta = self.arr_row - (row_end_idx - row_start_id)
+
+        col_start_id = fc * self.arr_col
+        col_end_idx = min(col_start_id + self.arr_col, self.Sc)
 
-                # Account for the cycles for partial sum generation and accumulation
-                this_fold_demand = np.concatenate((this_fold_demand, inter_fold_gap_suffix_mat), axis=0)
+        # Indexing the cols with row start and row end idx are correct
+        # See the comment on ifmap_prefetch generation
+        this_fold_demand = self.ifmap_op_mat_trans[row_start_id:row_end_idx, col_start_id: col_end_idx]
+        self.ifmap_reads += this_fold_demand.shape[0] * this_fold_demand.shape[1]
 
-                # Calculate the mapping efficiency
-                row_used = min(self.arr_row, row_end_idx - row_start_id)
-                col_used = min(self.arr_col, col_end_idx - col_start_id)
-                mac_used = row_used * col_used
-                mapping_eff_this_fold = mac_used / (self.arr_row * self.arr_col)
+        # The IFMAP elems are needed to be filled in reverse order to ensure that
+        # top element is pushed in last to maintain alignment with the input elements
+        # Hence the null requests of the under utilized rows come first
+        this_fold_demand = np.flip(this_fold_demand, 0)
+        this_fold_demand = get_unskewed_band(this_fold_demand, num_cols=self.arr_col,
+                                             prefix_rows=row_delta,
+                                             suffix_rows=inter_fold_gap_suffix)
 
-                cycles_this_fold = this_fold_demand.shape[0] + this_fold_demand.shape[1] - 1
-                compute_cycles_this_fold = mac_used * self.T
-                compute_util_this_fold = compute_cycles_this_fold / (self.arr_row * self.arr_col * cycles_this_fold)
+        # Calculate the mapping efficiency
+        row_used = min(self.arr_row, row_end_idx - row_start_id)
+        col_used = min(self.arr_col, col_end_idx - col_start_id)
+        mac_used = row_used * col_used
+        mapping_eff_this_fold = mac_used / (self.arr_row * self.arr_col)
 
-                self.mapping_efficiency_per_fold.append(mapping_eff_this_fold)
-                self.compute_utility_per_fold.append(compute_util_this_fold)
+        cycles_this_fold = this_fold_demand.shape[0] + this_fold_demand.shape[1] - 1
+        compute_cycles_this_fold = mac_used * self.T
+        compute_util_this_fold = compute_cycles_this_fold / (self.arr_row * self.arr_col * cycles_this_fold)
 
-                if fr == 0 and fc == 0:
-                    self.ifmap_demand_matrix = this_fold_demand
-                else:
-                    self.ifmap_demand_matrix = np.concatenate((self.ifmap_demand_matrix, this_fold_demand), axis=0)
+        self.mapping_efficiency_per_fold.append(mapping_eff_this_fold)
+        self.compute_utility_per_fold.append(compute_util_this_fold)
 
         # Skew is not needed in IFMAP for IS
+        return this_fold_demand
 
     #
-    def create_filter_demand_mat(self):
-        assert self.params_set_flag, 'Parameters are not set'
-
+    def create_filter_demand_fold(self, fr):
+        # Account for the cycles for weights to load
         inter_fold_gap_prefix = self.arr_row
-        inter_fold_gap_prefix_mat = np.ones((inter_fold_gap_prefix, self.arr_row)) * -1
 
+        # Account for the cycles for final output to drain out
         inter_fold_gap_suffix = self.arr_col - 1
-        inter_fold_gap_suffix_mat = np.ones((inter_fold_gap_suffix, self.arr_row)) * -1
 
-        for fc in range(self.col_fold):
-            for fr in range(self.row_fold):
-                row_start_id = fr * self.arr_row
-                row_end_idx = min(row_start_id + self.arr_row, self.Sr)
-                delta = self.arr_row - (row_end_idx - row_start_id)
-
-                # Indexing the cols with row start and row end idx are correct
-                # See the comment on ifmap_prefetch generation
-                this_fold_demand = self.filter_op_mat[row_start_id: row_end_idx, :]
-                this_fold_demand = np.transpose(this_fold_demand)
-                self.filter_reads += this_fold_demand.shape[0] * this_fold_demand.shape[1]
-
-                # Take into account under utilization
-                if delta > 0:
-                    null_req_mat = np.ones((self.T, delta)) * -1
-                    this_fold_demand = np.concatenate((this_fold_demand, null_req_mat), axis=1)
-
-                # Account for the cycles for weights to load
-                this_fold_demand = np.concatenate((inter_fold_gap_prefix_mat, this_fold_demand), axis=0)
-
-                # Account for the cycles for final output to drain out
-                this_fold_demand = np.concatenate((this_fold_demand, inter_fold_gap_suffix_mat), axis=0)
-
-                # Add skew to the IFMAP demand matrix to reflect systolic pipeline fill
-                this_fold_demand = skew_matrix(this_fold_demand)
-
-                if fr == 0 and fc == 0:
-                    self.filter_demand_matrix = this_fold_demand
-                else:
-                    self.filter_demand_matrix = np.concatenate((self.filter_demand_matrix, this_fold_demand), axis=0)
+        row_start_id = fr * self.arr_row
+        row_end_idx = min(row_start_id + self.arr_row, self.Sr)
+
+        # Indexing the cols with row start and row end idx are correct
+        # See the comment on ifmap_prefetch generation
+        this_fold_demand = self.filter_op_mat[row_start_id: row_end_idx, :]
+        this_fold_demand = np.transpose(this_fold_demand)
+        self.filter_reads += this_fold_demand.shape[0] * this_fold_demand.shape[1]
+
+        # Add skew to the IFMAP demand matrix to reflect systolic pipeline fill
+        # The under utilized cols and the inter fold gaps are null requests outside the bands
+        this_fold_demand = get_skewed_band(this_fold_demand, num_cols=self.arr_row,
+                                           prefix_rows=inter_fold_gap_prefix,
+                                           suffix_rows=inter_fold_gap_suffix)
+
+        return this_fold_demand
     # END of filter demand generation
 
     #
-    def create_ofmap_demand_mat(self):
-        assert self.params_set_flag, 'Parameters are not set'
-
+    def create_ofmap_demand_fold(self, fc):
+        # These are the null demands to account for when the operands are streamed in
+        # and the OFMAPS are not ready
         inter_fold_gap_prefix = 2 * self.arr_row - 1
-        inter_fold_gap_prefix_mat = np.ones((inter_fold_gap_prefix, self.arr_col)) * -1
 
-        for fc in range(self.col_fold):
-            for fr in range(self.row_fold):
-                col_start_id = fc * self.arr_col
-                col_end_idx = min(col_start_id + self.arr_col, self.Sc)
-                col_delta = self.arr_col - (col_end_idx - col_start_id)
-
-                this_fold_demand = self.ofmap_op_mat[col_start_id: col_end_idx, :]
-                this_fold_demand = np.transpose(this_fold_demand)
-                self.ofmap_writes += this_fold_demand.shape[0] * this_fold_demand.shape[1]
-
-                # Adding null requests when there is under utilization ie. no mapping along a few rows or cols
-                if col_delta > 0:
-                    null_req_mat = np.ones((self.T, col_delta)) * -1
-                    this_fold_demand = np.concatenate((this_fold_demand, null_req_mat), axis=1)
-
-                # Now add the prefix matrix
-                # These are the null demands to account for when the operands are streamed in
-                # and the OFMAPS are not ready
-                this_fold_demand = np.concatenate((inter_fold_gap_prefix_mat, this_fold_demand), axis=0)
-
-                # Add skew to the OFMAP demand matrix to reflect systolic pipeline fill
-                this_fold_demand = skew_matrix(this_fold_demand)
-
-                if fr == 0 and fc == 0:
-                    self.ofmap_demand_matrix = this_fold_demand
-                else:
-                    self.ofmap_demand_matrix = np.concatenate((self.ofmap_demand_matrix, this_fold_demand), axis=0)
+        col_start_id = fc * self.arr_col
+        col_end_idx = min(col_start_id + self.arr_col, self.Sc)
+
+        this_fold_demand = self.ofmap_op_mat[col_start_id: col_end_idx, :]
+        this_fold_demand = np.transpose(this_fold_demand)
+        self.ofmap_writes += this_fold_demand.shape[0] * this_fold_demand.shape[1]
+
+        # Add skew to the OFMAP demand matrix to reflect systolic pipeline fill
+        # The under utilized cols are null requests outside the bands
+        this_fold_demand = get_skewed_band(this_fold_demand, num_cols=self.arr_col,
+                                           prefix_rows=inter_fold_gap_prefix)
+
+        return this_fold_demand
     # END of OFMAP demand generation
 
     #
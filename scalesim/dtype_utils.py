@@ -0,0 +1,25 @@
+import numpy as np
+
+
+# Data types used for the address and the cycle arrays across the simulator
+# Addresses are stored as native int32 unless the configured offsets and the operand sizes
+# of a layer need a wider type. -1 is the null request in either case.
+# Cycles can be negative (prefetches before the compute starts) and grow with the layer size,
+# they are always int64.
+cycle_dtype = np.int64
+
+
+# Narrowest native integer type which holds every address in [min_address, max_address]
+def get_address_dtype(min_address=0, max_address=0):
+    int32_info = np.iinfo(np.int32)
+    if int32_info.min < min_address and max_address <= int32_info.max:
+        return np.int32
+
+    int64_info = np.iinfo(np.int64)
+    if not (int64_info.min < min_address and max_address <= int64_info.max):
+        message = 'ERROR: dtype_utils.get_address_dtype(): '
+        message += 'Addresses in [' + str(min_address) + ', ' + str(max_address) + '] overflow int64'
+        print(message)
+        exit()
+
+    return np.int64
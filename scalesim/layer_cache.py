@@ -0,0 +1,233 @@
+# Persistent cache of the per layer simulation results
+# A layer is simulated only once for a given shape and the config fields which affect its simulation.
+# The results are looked up with a hash of these, so the same layer in another topology,
+# or in a later run, is not simulated again.
+#
+# Each entry is a directory <cache_dir>/<key>/ with the report items in report.json
+# and optionally the traces of the layer. The least recently used entries are evicted
+# once the cache grows beyond its size limit.
+import os
+import json
+import shutil
+import hashlib
+
+from scalesim.trace_utils import trace_names, get_trace_filename
+
+# Bump this when a change in the cache layout changes the entries, the older entries are not used then
+# The keys also hold a hash of the simulator sources, hence any change in the simulator misses the older entries
+cache_version = 1
+
+# Hash of the sources of the scalesim package, computed once per process
+sources_hash = ''
+
+default_cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'scalesim')
+default_max_size_mb = 1024
+
+report_filename = 'report.json'
+
+
+class layer_cache:
+    def __init__(self):
+        self.cache_dir = default_cache_dir
+        self.max_size_bytes = default_max_size_mb * 1024 * 1024
+        self.cache_traces = False
+
+        self.params_set_flag = False
+
+    #
+    def set_params(self, cache_dir='', max_size_mb=default_max_size_mb, cache_traces=False):
+        assert max_size_mb > 0, 'Cache size should be positive'
+
+        if cache_dir == '':
+            cache_dir = default_cache_dir
+        self.cache_dir = cache_dir
+        self.max_size_bytes = int(max_size_mb * 1024 * 1024)
+        self.cache_traces = cache_traces
+
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+        self.params_set_flag = True
+
+    # Hash of the layer hyper parameters and the config fields which affect the simulation of the layer
+    # The layer name, the run name and the topology file do not change the results
+    def get_layer_key(self, config_obj, topo_obj, layer_id):
+        layer_params = topo_obj.get_layer_params(layer_id)
+
+        key_items = {
+            'version': cache_version,
+            'sources': get_sources_hash(),
+            'layer_params': [int(x) for x in layer_params[1:]],
+            'array_dims': [int(x) for x in config_obj.get_array_dims()],
+            'mem_sizes_kb': [int(x) for x in config_obj.get_mem_sizes()],
+            'dataflow': config_obj.get_dataflow(),
+            'offsets': [int(x) for x in config_obj.get_offsets()],
+            'user_bandwidth': bool(config_obj.use_user_dram_bandwidth()),
+            'bandwidths': [],
+        }
+        if key_items['user_bandwidth']:
+            key_items['bandwidths'] = [int(x) for x in config_obj.get_bandwidths_as_list()]
+
+        key_string = json.dumps(key_items, sort_keys=True)
+        return hashlib.sha256(key_string.encode('utf-8')).hexdigest()
+
+    # Returns the compute, bandwidth and detailed report items of the layer, None on a miss
+    # If trace_format is given, it is a hit only if the traces in that format are cached as well
+    def lookup(self, key, trace_format=''):
+        assert self.params_set_flag, 'Parameters are not set'
+
+        entry_dir = self.get_entry_dir(key)
+        report_file = os.path.join(entry_dir, report_filename)
+
+        try:
+            with open(report_file, 'r') as f:
+                report = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if not trace_format == '':
+            if trace_format not in report['trace_formats']:
+                return None
+
+        # Mark the entry as the most recently used
+        try:
+            os.utime(report_file)
+        except OSError:
+            pass
+
+        return report['compute'], report['bandwidth'], report['detail']
+
+    # Copies the cached traces of the layer to the layer directory
+    def restore_traces(self, key, dir_name, trace_format='csv'):
+        assert self.params_set_flag, 'Parameters are not set'
+
+        entry_dir = self.get_entry_dir(key)
+        for trace_name in trace_names:
+            src = get_trace_filename(entry_dir, trace_name, trace_format)
+            if os.path.exists(src):
+                shutil.copyfile(src, get_trace_filename(dir_name, trace_name, trace_format))
+
+    # Adds the results of a layer, and its traces if the traces are cached and the layer directory is given
+    # Another process might add the same layer at the same time, the entry is put in place in one rename
+    def store(self, key, comp_items, bw_items, detail_items, dir_name='', trace_format='csv'):
+        assert self.params_set_flag, 'Parameters are not set'
+
+        report = {
+            'compute': [to_builtin(x) for x in comp_items],
+            'bandwidth': [to_builtin(x) for x in bw_items],
+            'detail': [to_builtin(x) for x in detail_items],
+            'trace_formats': [],
+        }
+
+        entry_dir = self.get_entry_dir(key)
+        tmp_dir = entry_dir + '.tmp.' + str(os.getpid())
+        if os.path.isdir(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.makedirs(tmp_dir)
+
+        if self.cache_traces and not dir_name == '':
+            for trace_name in trace_names:
+                src = get_trace_filename(dir_name, trace_name, trace_format)
+                if os.path.exists(src):
+                    shutil.copyfile(src, get_trace_filename(tmp_dir, trace_name, trace_format))
+            report['trace_formats'].append(trace_format)
+
+        with open(os.path.join(tmp_dir, report_filename), 'w') as f:
+            json.dump(report, f)
+
+        if os.path.isdir(entry_dir):
+            shutil.rmtree(entry_dir, ignore_errors=True)
+        try:
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            # The same layer was added in the meanwhile
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        self.evict()
+
+    # Removes the least recently used entries till the cache fits in its size limit
+    def evict(self):
+        assert self.params_set_flag, 'Parameters are not set'
+
+        entries = []
+        total_size = 0
+        for key in os.listdir(self.cache_dir):
+            if '.tmp.' in key:
+                continue    # Being added by another process
+
+            entry_dir = self.get_entry_dir(key)
+            report_file = os.path.join(entry_dir, report_filename)
+            try:
+                last_used = os.path.getmtime(report_file)
+                entry_size = get_dir_size(entry_dir)
+            except OSError:
+                continue    # Not an entry, or removed by another process
+
+            entries.append((last_used, entry_size, entry_dir))
+            total_size += entry_size
+
+        entries.sort()
+        for _, entry_size, entry_dir in entries:
+            if not total_size > self.max_size_bytes:
+                break
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total_size -= entry_size
+
+    #
+    def clear(self):
+        assert self.params_set_flag, 'Parameters are not set'
+
+        for key in os.listdir(self.cache_dir):
+            entry_dir = self.get_entry_dir(key)
+            if os.path.isdir(entry_dir):
+                shutil.rmtree(entry_dir, ignore_errors=True)
+
+    #
+    def get_entry_dir(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    #
+    def get_size_bytes(self):
+        assert self.params_set_flag, 'Parameters are not set'
+        return get_dir_size(self.cache_dir)
+
+
+# The python sources of the scalesim package, with their paths relative to the package
+def get_sources_hash():
+    global sources_hash
+    if not sources_hash == '':
+        return sources_hash
+
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    source_files = []
+    for root, dirs, files in os.walk(package_dir):
+        dirs[:] = [d for d in dirs if not d == '__pycache__']
+        for name in files:
+            if name.endswith('.py'):
+                source_files.append(os.path.relpath(os.path.join(root, name), package_dir))
+
+    sources = hashlib.sha256()
+    for source_file in sorted(source_files):
+        sources.update(source_file.replace(os.sep, '/').encode('utf-8'))
+        with open(os.path.join(package_dir, source_file), 'rb') as f:
+            sources.update(f.read())
+
+    sources_hash = sources.hexdigest()
+    return sources_hash
+
+
+# Numpy scalars in the report items are stored as the python numbers they print as
+def to_builtin(item):
+    if hasattr(item, 'item'):
+        return item.item()
+    return item
+
+
+#
+def get_dir_size(dir_name):
+    size = 0
+    for root, _, files in os.walk(dir_name):
+        for name in files:
+            size += os.path.getsize(os.path.join(root, name))
+
+    return size
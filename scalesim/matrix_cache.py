@@ -0,0 +1,132 @@
+# In memory cache of the matrices generated for a layer, shared by the layers of a run
+# The layers of a network often repeat with the same shape, eg. the blocks of a ResNet stage.
+# The operand matrices of such a layer depend only on its shape and the offsets, and the prefetch and
+# the demand matrices on these and the array dims and the dataflow. The matrices of a repeated layer
+# are taken from the cache instead of being generated again.
+#
+# The cached matrices are shared between the layers, hence these are made read only.
+# The least recently used entries are dropped once the total size of the matrices grows beyond the limit.
+from collections import OrderedDict
+
+default_max_size_mb = 512
+
+# Cache of the worker process, see get_process_matrix_cache()
+process_matrix_cache = None
+
+
+class matrix_cache:
+    def __init__(self):
+        self.max_size_bytes = default_max_size_mb * 1024 * 1024
+
+        # key -> [size in bytes, value], in the order of their last use
+        self.entries = OrderedDict()
+        self.size_bytes = 0
+
+        self.num_hits = 0
+        self.num_misses = 0
+
+        self.params_set_flag = False
+
+    #
+    def set_params(self, max_size_mb=default_max_size_mb):
+        assert max_size_mb > 0, 'Cache size should be positive'
+
+        self.max_size_bytes = int(max_size_mb * 1024 * 1024)
+        self.params_set_flag = True
+        self.evict()
+
+    # Returns the cached value, None on a miss
+    def lookup(self, key):
+        assert self.params_set_flag, 'Parameters are not set'
+
+        if key not in self.entries:
+            self.num_misses += 1
+            return None
+
+        self.entries.move_to_end(key)
+        self.num_hits += 1
+        return self.entries[key][1]
+
+    # The arrays of the value should be frozen by the caller, see freeze_arrays()
+    # A value larger than the whole cache is not stored
+    def store(self, key, value, size_bytes):
+        assert self.params_set_flag, 'Parameters are not set'
+
+        if size_bytes > self.max_size_bytes:
+            return
+
+        if key in self.entries:
+            self.size_bytes -= self.entries[key][0]
+            del self.entries[key]
+
+        self.entries[key] = [size_bytes, value]
+        self.size_bytes += size_bytes
+        self.evict()
+
+    # Drops the least recently used entries till the cache fits in its size limit
+    def evict(self):
+        while self.size_bytes > self.max_size_bytes and len(self.entries) > 0:
+            size_bytes, _ = self.entries.popitem(last=False)[1]
+            self.size_bytes -= size_bytes
+
+    #
+    def clear(self):
+        self.entries = OrderedDict()
+        self.size_bytes = 0
+
+    #
+    def get_max_size_bytes(self):
+        return self.max_size_bytes
+
+    #
+    def get_size_bytes(self):
+        return self.size_bytes
+
+    #
+    def get_num_entries(self):
+        return len(self.entries)
+
+    #
+    def get_hit_counts(self):
+        return self.num_hits, self.num_misses
+
+
+# The cache shared by the layers run in this process, for the worker processes of a parallel run
+def get_process_matrix_cache(max_size_mb=default_max_size_mb):
+    global process_matrix_cache
+
+    if process_matrix_cache is None:
+        process_matrix_cache = matrix_cache()
+        process_matrix_cache.set_params(max_size_mb=max_size_mb)
+
+    return process_matrix_cache
+
+
+# The operand matrices depend on the layer shape and the offsets, the layer name does not matter
+def get_operand_key(config_obj, topo_obj, layer_id):
+    layer_params = topo_obj.get_layer_params(layer_id)
+
+    key = ('operand',
+           tuple([int(x) for x in layer_params[1:]]),
+           tuple([int(x) for x in config_obj.get_offsets()]))
+    return key
+
+
+# The prefetch and the demand matrices depend on the operands, the array dims and the dataflow
+def get_compute_key(config_obj, topo_obj, layer_id):
+    operand_key = get_operand_key(config_obj, topo_obj, layer_id)
+
+    key = ('compute',) + operand_key[1:] \
+          + (config_obj.get_dataflow(), tuple([int(x) for x in config_obj.get_array_dims()]))
+    return key
+
+
+# Makes the arrays read only, so that a layer cannot modify the matrices shared with the other layers
+# Returns the bytes held by the arrays
+def freeze_arrays(arrays):
+    size_bytes = 0
+    for array in arrays:
+        array.flags.writeable = False
+        size_bytes += array.nbytes
+
+    return size_bytes
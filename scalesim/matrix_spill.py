@@ -0,0 +1,125 @@
+# Disk backed storage for the matrices too large for the memory
+# The operand matrices and the full demand matrices larger than the threshold are kept in np.memmap files
+# in a scratch directory, the OS pages them in and out as these are read. The files are removed
+# when released, the mapped matrices stay valid till they are dropped.
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+default_threshold_mb = 1024
+
+# Bytes computed or copied at a time while a spilled matrix is filled
+spill_chunk_bytes = 64 * 1024 * 1024
+
+
+class matrix_spill:
+    def __init__(self):
+        self.scratch_dir = ''
+        self.threshold_bytes = default_threshold_mb * 1024 * 1024
+
+        # Directory of the files of this object, created on the first spill
+        self.spill_dir = ''
+        self.num_files = 0
+
+        self.params_set_flag = False
+
+    #
+    def set_params(self, scratch_dir='', threshold_mb=default_threshold_mb):
+        assert threshold_mb > 0, 'Spill threshold should be positive'
+
+        self.scratch_dir = scratch_dir
+        self.threshold_bytes = int(threshold_mb * 1024 * 1024)
+        self.params_set_flag = True
+
+    #
+    def needs_spill(self, num_bytes):
+        assert self.params_set_flag, 'Parameters are not set'
+        return num_bytes > self.threshold_bytes
+
+    # A memmap for the matrices above the threshold, an array in the memory otherwise
+    def allocate(self, shape, dtype, name='matrix'):
+        assert self.params_set_flag, 'Parameters are not set'
+
+        num_bytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        if not self.needs_spill(num_bytes):
+            return np.empty(shape, dtype=dtype)
+
+        return np.memmap(self.get_new_filename(name), dtype=dtype, mode='w+', shape=shape)
+
+    #
+    def get_new_filename(self, name):
+        if self.spill_dir == '':
+            scratch_dir = self.scratch_dir
+            if scratch_dir == '':
+                scratch_dir = None
+            elif not os.path.isdir(scratch_dir):
+                os.makedirs(scratch_dir, exist_ok=True)
+            self.spill_dir = tempfile.mkdtemp(prefix='scalesim_spill_', dir=scratch_dir)
+
+        self.num_files += 1
+        return os.path.join(self.spill_dir, name + '_' + str(self.num_files) + '.bin')
+
+    # Removes the files, the matrices mapped from them are still readable on POSIX systems
+    def release(self):
+        if not self.spill_dir == '':
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+        self.spill_dir = ''
+
+    #
+    def is_spilled(self):
+        return not self.spill_dir == ''
+
+
+# Stacks the blocks of rows given one at a time, eg. the demand matrices of the folds
+# The blocks are kept in the memory till their size crosses the spill threshold,
+# after which all the blocks are written to a file in the order they come in
+class block_writer:
+    def __init__(self, spill_obj=None, name='matrix'):
+        self.spill = spill_obj
+        self.name = name
+
+        self.blocks = []
+        self.num_bytes = 0
+
+        self.filename = ''
+        self.file = None
+        self.num_rows = 0
+        self.num_cols = 0
+        self.dtype = None
+
+    #
+    def append(self, block):
+        if self.file is not None:
+            self.write_block(block)
+            return
+
+        self.blocks.append(block)
+        self.num_bytes += block.nbytes
+
+        if self.spill is not None and self.spill.needs_spill(self.num_bytes):
+            self.filename = self.spill.get_new_filename(self.name)
+            self.file = open(self.filename, 'wb')
+            for pending_block in self.blocks:
+                self.write_block(pending_block)
+            self.blocks = []
+
+    #
+    def write_block(self, block):
+        if self.dtype is None:
+            self.dtype = block.dtype
+            self.num_cols = block.shape[1]
+        assert block.shape[1] == self.num_cols, 'Blocks should have the same number of columns'
+
+        np.ascontiguousarray(block, dtype=self.dtype).tofile(self.file)
+        self.num_rows += block.shape[0]
+
+    # Returns the stacked matrix, read only if it was spilled
+    def finish(self):
+        if self.file is None:
+            return np.concatenate(self.blocks)
+
+        self.file.close()
+        self.file = None
+        return np.memmap(self.filename, dtype=self.dtype, mode='r', shape=(self.num_rows, self.num_cols))
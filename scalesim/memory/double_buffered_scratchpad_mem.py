@@ -7,6 +7,9 @@ from scalesim.memory.read_buffer_estimate_bw import ReadBufferEstimateBw as rdbu
 from scalesim.memory.read_port import read_port as rdport
 from scalesim.memory.write_buffer import write_buffer as wrbuf
 from scalesim.memory.write_port import write_port as wrport
+from scalesim.dtype_utils import cycle_dtype
+from scalesim.trace_utils import write_trace
+from scalesim.band_matrix import concatenate_demand_blocks, get_valid_requests, get_null_lines, get_dense_demand
 
 
 class double_buffered_scratchpad:
@@ -51,6 +54,21 @@ class double_buffered_scratchpad:
         self.ofmap_dram_stop_cycle = 0
         self.ofmap_dram_writes = 0
 
+        # Bounds on the number of demand lines examined at once by service_memory_requests
+        self.min_batch_lines = 16
+        self.max_batch_lines = 4096
+
+        # The SRAM traces of the whole layer are assembled only when they are needed
+        self.keep_sram_traces = True
+
+        # When set, the traces are streamed to these sinks while the requests are serviced
+        # in the order ifmap, filter, ofmap
+        self.sram_trace_sinks = []
+        self.dram_trace_sinks = []
+        self.num_lines_serviced = 0
+        self.batch_lines = self.min_batch_lines
+        self.last_ofmap_serviced_cycle = np.zeros(1, dtype=cycle_dtype)
+
         self.estimate_bandwidth_mode = False,
         self.traces_valid = False
         self.params_valid_flag = True
@@ -59,6 +77,7 @@ class double_buffered_scratchpad:
     def set_params(self,
                    verbose=True,
                    estimate_bandwidth_mode=False,
+                   keep_sram_traces=True,
                    word_size=1,
                    ifmap_buf_size_bytes=2, filter_buf_size_bytes=2, ofmap_buf_size_bytes=2,
                    rd_buf_active_frac=0.5, wr_buf_active_frac=0.5,
@@ -104,9 +123,27 @@ class double_buffered_scratchpad:
                                   backing_buf_bw=ofmap_backing_buf_bw)
 
         self.verbose = verbose
+        self.keep_sram_traces = keep_sram_traces
 
         self.params_valid_flag = True
 
+    # Streams all the traces to the disk instead of keeping them in the memory
+    # Needs to be called after set_params, as the buffers are created there
+    def set_trace_sinks(self,
+                        ifmap_sram_sink, filter_sram_sink, ofmap_sram_sink,
+                        ifmap_dram_sink, filter_dram_sink, ofmap_dram_sink):
+        assert self.params_valid_flag, 'Memories not initialized yet'
+
+        self.sram_trace_sinks = [ifmap_sram_sink, filter_sram_sink, ofmap_sram_sink]
+        self.dram_trace_sinks = [ifmap_dram_sink, filter_dram_sink, ofmap_dram_sink]
+
+        self.ifmap_buf.set_trace_sink(ifmap_dram_sink)
+        self.filter_buf.set_trace_sink(filter_dram_sink)
+        self.ofmap_buf.set_trace_sink(ofmap_dram_sink)
+
+        # The start and stop cycles are tracked while servicing, the SRAM traces are not needed in the memory
+        self.keep_sram_traces = False
+
     #
     def set_read_buf_prefetch_matrices(self,
                                        ifmap_prefetch_mat=np.zeros((1,1)),
@@ -148,46 +185,86 @@ class double_buffered_scratchpad:
 
         return out_cycles_arr_np
 
-    #
+    # The demand matrices of the whole layer are read in chunks of consecutive lines,
+    # so the matrices spilled to the disk are paged in sequentially, one chunk at a time
     def service_memory_requests(self, ifmap_demand_mat, filter_demand_mat, ofmap_demand_mat):
+        demand_blocks = get_demand_line_chunks(ifmap_demand_mat, filter_demand_mat, ofmap_demand_mat,
+                                               chunk_lines=self.max_batch_lines)
+        self.service_memory_requests_per_fold(demand_blocks)
+
+    # Services the demands handed out by the compute unit one fold at a time
+    # The folds are grouped into chunks of at least max_batch_lines lines, only one chunk is held at a time
+    # The SRAM traces are assembled at the end only if keep_sram_traces is set,
+    # or streamed to the disk chunk by chunk if the trace sinks are set
+    def service_memory_requests_per_fold(self, demand_blocks):
         assert self.params_valid_flag, 'Memories not initialized yet'
 
-        ofmap_lines = ofmap_demand_mat.shape[0]
-
         self.total_cycles = 0
         self.stall_cycles = 0
 
-        ifmap_hit_latency = self.ifmap_buf.get_hit_latency()
-        filter_hit_latency = self.filter_buf.get_hit_latency()
-
-        ifmap_serviced_cycles = []
-        filter_serviced_cycles = []
-        ofmap_serviced_cycles = []
-
-        pbar_disable = not self.verbose
-        for i in tqdm(range(ofmap_lines), disable=pbar_disable):
+        self.num_lines_serviced = 0
+        self.batch_lines = self.min_batch_lines
+        self.last_ofmap_serviced_cycle = np.zeros(1, dtype=cycle_dtype)
 
-            cycle_arr = np.zeros((1,1)) + i + self.stall_cycles
+        self.ifmap_sram_start_cycle = -1
+        self.filter_sram_start_cycle = -1
+        self.ofmap_sram_start_cycle = -1
 
-            ifmap_demand_line = ifmap_demand_mat[i, :].reshape((1,ifmap_demand_mat.shape[1]))
-            ifmap_cycle_out = self.ifmap_buf.service_reads(incoming_requests_arr_np=ifmap_demand_line,
-                                                            incoming_cycles_arr=cycle_arr)
-            ifmap_serviced_cycles += [ifmap_cycle_out[0]]
-            ifmap_stalls = ifmap_cycle_out[0] - cycle_arr[0] - ifmap_hit_latency
+        ifmap_trace_blocks = []
+        filter_trace_blocks = []
+        ofmap_trace_blocks = []
 
-            filter_demand_line = filter_demand_mat[i, :].reshape((1, filter_demand_mat.shape[1]))
-            filter_cycle_out = self.filter_buf.service_reads(incoming_requests_arr_np=filter_demand_line,
-                                                           incoming_cycles_arr=cycle_arr)
-            filter_serviced_cycles += [filter_cycle_out[0]]
-            filter_stalls = filter_cycle_out[0] - cycle_arr[0] - filter_hit_latency
+        pbar_disable = not self.verbose
+        pbar = tqdm(disable=pbar_disable)
+
+        ifmap_pending = []
+        filter_pending = []
+        ofmap_pending = []
+        pending_lines = 0
+
+        for ifmap_fold_demand, filter_fold_demand, ofmap_fold_demand in demand_blocks:
+            ifmap_pending.append(ifmap_fold_demand)
+            filter_pending.append(filter_fold_demand)
+            ofmap_pending.append(ofmap_fold_demand)
+            pending_lines += ofmap_fold_demand.shape[0]
+
+            if pending_lines < self.max_batch_lines:
+                continue
+
+            traces = self.service_demand_chunk(ifmap_pending, filter_pending, ofmap_pending)
+            pbar.update(pending_lines)
+
+            ifmap_pending = []
+            filter_pending = []
+            ofmap_pending = []
+            pending_lines = 0
+
+            if len(self.sram_trace_sinks) > 0:
+                for sink, trace in zip(self.sram_trace_sinks, traces):
+                    sink.append(trace)
+            elif self.keep_sram_traces:
+                ifmap_trace_blocks.append(traces[0])
+                filter_trace_blocks.append(traces[1])
+                ofmap_trace_blocks.append(traces[2])
+
+        if pending_lines > 0:
+            traces = self.service_demand_chunk(ifmap_pending, filter_pending, ofmap_pending)
+            pbar.update(pending_lines)
+
+            if len(self.sram_trace_sinks) > 0:
+                for sink, trace in zip(self.sram_trace_sinks, traces):
+                    sink.append(trace)
+            elif self.keep_sram_traces:
+                ifmap_trace_blocks.append(traces[0])
+                filter_trace_blocks.append(traces[1])
+                ofmap_trace_blocks.append(traces[2])
 
-            ofmap_demand_line = ofmap_demand_mat[i, :].reshape((1, ofmap_demand_mat.shape[1]))
-            ofmap_cycle_out = self.ofmap_buf.service_writes(incoming_requests_arr_np=ofmap_demand_line,
-                                                             incoming_cycles_arr_np=cycle_arr)
-            ofmap_serviced_cycles += [ofmap_cycle_out[0]]
-            ofmap_stalls = ofmap_cycle_out[0] - cycle_arr[0]
+        pbar.close()
 
-            self.stall_cycles += int(max(ifmap_stalls[0], filter_stalls[0], ofmap_stalls[0]))
+        # No valid requests at all
+        self.ifmap_sram_start_cycle = max(self.ifmap_sram_start_cycle, 0)
+        self.filter_sram_start_cycle = max(self.filter_sram_start_cycle, 0)
+        self.ofmap_sram_start_cycle = max(self.ofmap_sram_start_cycle, 0)
 
         if self.estimate_bandwidth_mode:
             # IDE shows warning as complete_all_prefetches is not implemented in read_buffer class
@@ -195,22 +272,141 @@ class double_buffered_scratchpad:
             self.ifmap_buf.complete_all_prefetches()
             self.filter_buf.complete_all_prefetches()
 
-        self.ofmap_buf.empty_all_buffers(ofmap_serviced_cycles[-1])
+        self.ofmap_buf.empty_all_buffers(self.last_ofmap_serviced_cycle)
 
-        # Prepare the traces
-        ifmap_services_cycles_np = np.asarray(ifmap_serviced_cycles).reshape((len(ifmap_serviced_cycles), 1))
-        self.ifmap_trace_matrix = np.concatenate((ifmap_services_cycles_np, ifmap_demand_mat), axis=1)
-
-        filter_services_cycles_np = np.asarray(filter_serviced_cycles).reshape((len(filter_serviced_cycles), 1))
-        self.filter_trace_matrix = np.concatenate((filter_services_cycles_np, filter_demand_mat), axis=1)
+        # All the traces are complete at this point
+        for sink in self.sram_trace_sinks + self.dram_trace_sinks:
+            sink.close()
 
-        ofmap_services_cycles_np = np.asarray(ofmap_serviced_cycles).reshape((len(ofmap_serviced_cycles), 1))
-        self.ofmap_trace_matrix = np.concatenate((ofmap_services_cycles_np, ofmap_demand_mat), axis=1)
-        self.total_cycles = int(ofmap_serviced_cycles[-1][0])
+        # Prepare the traces
+        if self.keep_sram_traces:
+            self.ifmap_trace_matrix = np.concatenate(ifmap_trace_blocks, axis=0)
+            self.filter_trace_matrix = np.concatenate(filter_trace_blocks, axis=0)
+            self.ofmap_trace_matrix = np.concatenate(ofmap_trace_blocks, axis=0)
+        self.total_cycles = int(self.last_ofmap_serviced_cycle[0])
 
         # END of serving demands from memory
         self.traces_valid = True
 
+    # Services a chunk of consecutive demand lines, given as lists of blocks
+    # Returns the SRAM trace blocks of the chunk, if they are needed
+    # The blocks are either arrays or band matrices, see band_matrix
+    def service_demand_chunk(self, ifmap_demand_blocks, filter_demand_blocks, ofmap_demand_blocks):
+        ifmap_demand_mat = concatenate_demand_blocks(ifmap_demand_blocks)
+        filter_demand_mat = concatenate_demand_blocks(filter_demand_blocks)
+        ofmap_demand_mat = concatenate_demand_blocks(ofmap_demand_blocks)
+
+        ofmap_lines = ofmap_demand_mat.shape[0]
+        line_offset = self.num_lines_serviced
+
+        ifmap_hit_latency = self.ifmap_buf.get_hit_latency()
+        filter_hit_latency = self.filter_buf.get_hit_latency()
+
+        ifmap_serviced_cycles = np.zeros((ofmap_lines, 1), dtype=cycle_dtype)
+        filter_serviced_cycles = np.zeros((ofmap_lines, 1), dtype=cycle_dtype)
+        ofmap_serviced_cycles = np.zeros((ofmap_lines, 1), dtype=cycle_dtype)
+
+        # Logic:
+        # A stall in any of the buffers delays all the lines that follow, for all the buffers.
+        # Therefore, the lines are sent in batches which end at the first line where any buffer
+        # could stall, ie. a read miss or a write buffer drain. All the lines before it are
+        # serviced stall free. The stall at the last line is accounted before the next batch.
+        #
+        # The lines without any valid request, eg. the inter fold gaps when all the operands are idle,
+        # are fast forwarded in bulk. None of the buffers changes its state on these and there are no stalls,
+        # only the first line of the layer has to go through the buffers to start the prefetches.
+        null_lines = np.logical_and(np.logical_and(get_null_lines(ifmap_demand_mat),
+                                                   get_null_lines(filter_demand_mat)),
+                                    get_null_lines(ofmap_demand_mat))
+        valid_lines = np.flatnonzero(np.logical_not(null_lines))
+
+        batch_lines = self.batch_lines
+        start_line = 0
+        while start_line < ofmap_lines:
+            if null_lines[start_line] and line_offset + start_line > 0:
+                idx = valid_lines.searchsorted(start_line)
+                end_line = ofmap_lines
+                if idx < valid_lines.shape[0]:
+                    end_line = int(valid_lines[idx])
+
+                cycle_arr = np.arange(start_line, end_line, dtype=cycle_dtype).reshape((end_line - start_line, 1)) \
+                            + line_offset + self.stall_cycles
+                ifmap_serviced_cycles[start_line:end_line] = cycle_arr + ifmap_hit_latency
+                filter_serviced_cycles[start_line:end_line] = cycle_arr + filter_hit_latency
+                ofmap_serviced_cycles[start_line:end_line] = cycle_arr
+
+                start_line = end_line
+                continue
+
+            end_line = min(start_line + batch_lines, ofmap_lines)
+            cycle_arr = np.arange(start_line, end_line, dtype=cycle_dtype).reshape((end_line - start_line, 1)) \
+                        + line_offset + self.stall_cycles
+
+            ifmap_demand_lines = ifmap_demand_mat[start_line:end_line, :]
+            filter_demand_lines = filter_demand_mat[start_line:end_line, :]
+            ofmap_demand_lines = ofmap_demand_mat[start_line:end_line, :]
+
+            # Only the drains of the write buffer depend on the cycles
+            event_line = min(self.ifmap_buf.get_first_event_line(ifmap_demand_lines),
+                             self.filter_buf.get_first_event_line(filter_demand_lines),
+                             self.ofmap_buf.get_first_event_line(ofmap_demand_lines, cycle_arr))
+
+            # Include the line with the event, if any, in this batch
+            num_lines = min(event_line + 1, end_line - start_line)
+            end_line = start_line + num_lines
+
+            # Grow the batch while there are no events, shrink it back around the events
+            if event_line < batch_lines:
+                batch_lines = max(2 * num_lines, self.min_batch_lines)
+            else:
+                batch_lines = min(2 * batch_lines, self.max_batch_lines)
+
+            cycle_arr = cycle_arr[:num_lines]
+
+            ifmap_cycle_out = self.ifmap_buf.service_reads(incoming_requests_arr_np=ifmap_demand_lines[:num_lines],
+                                                           incoming_cycles_arr=cycle_arr)
+            ifmap_serviced_cycles[start_line:end_line] = ifmap_cycle_out
+            ifmap_stalls = ifmap_cycle_out[-1] - cycle_arr[-1] - ifmap_hit_latency
+
+            filter_cycle_out = self.filter_buf.service_reads(incoming_requests_arr_np=filter_demand_lines[:num_lines],
+                                                             incoming_cycles_arr=cycle_arr)
+            filter_serviced_cycles[start_line:end_line] = filter_cycle_out
+            filter_stalls = filter_cycle_out[-1] - cycle_arr[-1] - filter_hit_latency
+
+            ofmap_cycle_out = self.ofmap_buf.service_writes(incoming_requests_arr_np=ofmap_demand_lines[:num_lines],
+                                                            incoming_cycles_arr_np=cycle_arr)
+            ofmap_serviced_cycles[start_line:end_line] = ofmap_cycle_out
+            ofmap_stalls = ofmap_cycle_out[-1] - cycle_arr[-1]
+
+            self.stall_cycles += int(max(ifmap_stalls[0], filter_stalls[0], ofmap_stalls[0]))
+
+            start_line = end_line
+
+        self.batch_lines = batch_lines
+        self.num_lines_serviced += ofmap_lines
+        self.last_ofmap_serviced_cycle = ofmap_serviced_cycles[-1]
+
+        # Track the first and the last cycles with valid requests, the traces might not be kept around
+        self.ifmap_sram_start_cycle, self.ifmap_sram_stop_cycle = \
+            update_start_stop_cycles(ifmap_serviced_cycles, ifmap_demand_mat,
+                                     self.ifmap_sram_start_cycle, self.ifmap_sram_stop_cycle)
+        self.filter_sram_start_cycle, self.filter_sram_stop_cycle = \
+            update_start_stop_cycles(filter_serviced_cycles, filter_demand_mat,
+                                     self.filter_sram_start_cycle, self.filter_sram_stop_cycle)
+        self.ofmap_sram_start_cycle, self.ofmap_sram_stop_cycle = \
+            update_start_stop_cycles(ofmap_serviced_cycles, ofmap_demand_mat,
+                                     self.ofmap_sram_start_cycle, self.ofmap_sram_stop_cycle)
+
+        if not (self.keep_sram_traces or len(self.sram_trace_sinks) > 0):
+            return None
+
+        # The null requests are filled in only for the traces
+        ifmap_trace = np.concatenate((ifmap_serviced_cycles, get_dense_demand(ifmap_demand_mat)), axis=1)
+        filter_trace = np.concatenate((filter_serviced_cycles, get_dense_demand(filter_demand_mat)), axis=1)
+        ofmap_trace = np.concatenate((ofmap_serviced_cycles, get_dense_demand(ofmap_demand_mat)), axis=1)
+
+        return ifmap_trace, filter_trace, ofmap_trace
+
     # This is the trace computation logic of this memory system
     # Anand: This is too complex, perform the serve cycle by cycle for the requests
     def service_memory_requests_old(self, ifmap_demand_mat, filter_demand_mat, ofmap_demand_mat):
@@ -261,7 +457,7 @@ class double_buffered_scratchpad:
 
             num_lines = end_line_idx - start_line_idx + 1
             this_req_cycles_arr = [int(x + cycle_offset) for x in range(num_lines)]
-            this_req_cycles_arr_np = np.asarray(this_req_cycles_arr).reshape((num_lines,1))
+            this_req_cycles_arr_np = np.asarray(this_req_cycles_arr, dtype=cycle_dtype).reshape((num_lines,1))
 
             this_req_ifmap_demands = ifmap_demand_mat[start_line_idx:(end_line_idx + 1), :]
             this_req_filter_demands = filter_demand_mat[start_line_idx:(end_line_idx + 1), :]
@@ -280,7 +476,7 @@ class double_buffered_scratchpad:
             # Note: Stalls incurred on reading line i in ifmap reflect the request cycles for line i+1 in filter
             ifmap_hit_latency = self.ifmap_buf.get_hit_latency()
             ifmap_stalls = ifmap_cycles_out - this_req_cycles_arr_np - ifmap_hit_latency    # Vec - vec - scalar
-            ifmap_stalls = np.concatenate((np.zeros((1,1)), ifmap_stalls[0:-1]), axis=0)    # Shift by one row
+            ifmap_stalls = np.concatenate((np.zeros((1,1), dtype=cycle_dtype), ifmap_stalls[0:-1]), axis=0)    # Shift by one row
             this_req_cycles_arr_np = this_req_cycles_arr_np + ifmap_stalls
 
             time_start = time.time()
@@ -293,7 +489,7 @@ class double_buffered_scratchpad:
             # Take care of stalls again --> The entire array stops when there is a stall
             filter_hit_latency = self.filter_buf.get_hit_latency()
             filter_stalls = filter_cycles_out - this_req_cycles_arr_np - filter_hit_latency  # Vec - vec - scalar
-            filter_stalls = np.concatenate((np.zeros((1, 1)), filter_stalls[0:-1]), axis=0)  # Shift by one row
+            filter_stalls = np.concatenate((np.zeros((1, 1), dtype=cycle_dtype), filter_stalls[0:-1]), axis=0)  # Shift by one row
             this_req_cycles_arr_np = this_req_cycles_arr_np + filter_stalls
 
             ofmap_cycles_out = self.ofmap_buf.service_writes(incoming_requests_arr_np=this_req_ofmap_demands,
@@ -347,6 +543,19 @@ class double_buffered_scratchpad:
         #print('DEBUG: Avg time to service reads= ' + str(avg_read_time))
 
         pbar.close()
+
+        # The first and the last cycles with valid requests, found in one pass over the traces
+        self.ifmap_sram_start_cycle, self.ifmap_sram_stop_cycle = \
+            update_start_stop_cycles(self.ifmap_trace_matrix[:, :1], self.ifmap_trace_matrix[:, 1:], -1, 0)
+        self.filter_sram_start_cycle, self.filter_sram_stop_cycle = \
+            update_start_stop_cycles(self.filter_trace_matrix[:, :1], self.filter_trace_matrix[:, 1:], -1, 0)
+        self.ofmap_sram_start_cycle, self.ofmap_sram_stop_cycle = \
+            update_start_stop_cycles(self.ofmap_trace_matrix[:, :1], self.ofmap_trace_matrix[:, 1:], -1, 0)
+
+        self.ifmap_sram_start_cycle = max(self.ifmap_sram_start_cycle, 0)
+        self.filter_sram_start_cycle = max(self.filter_sram_start_cycle, 0)
+        self.ofmap_sram_start_cycle = max(self.ofmap_sram_start_cycle, 0)
+
         # END of serving demands from memory
         self.traces_valid = True
 
@@ -361,90 +570,35 @@ class double_buffered_scratchpad:
         return self.stall_cycles
 
     #
-    def get_ifmap_sram_start_stop_cycles(self):
+    def get_num_lines_serviced(self):
+        assert self.traces_valid, 'Traces not generated yet'
+        return self.num_lines_serviced
+
+    # Prefetches made by the read buffers and drains of the write buffer
+    def get_buffer_event_counts(self):
         assert self.traces_valid, 'Traces not generated yet'
+        return self.ifmap_buf.get_num_prefetches(), self.filter_buf.get_num_prefetches(), \
+            self.ofmap_buf.get_num_drains()
 
-        done = False
-        for ridx in range(self.ifmap_trace_matrix.shape[0]):
-            if done:
-                break
-            row = self.ifmap_trace_matrix[ridx,1:]
-            for addr in row:
-                if not addr == -1:
-                    self.ifmap_sram_start_cycle = self.ifmap_trace_matrix[ridx][0]
-                    done = True
-                    break
-
-        done = False
-        for ridx in range(self.ifmap_trace_matrix.shape[0]):
-            if done:
-                break
-            ridx = -1 * (ridx + 1)
-            row = self.ifmap_trace_matrix[ridx,1:]
-            for addr in row:
-                if not addr == -1:
-                    self.ifmap_sram_stop_cycle  = self.ifmap_trace_matrix[ridx][0]
-                    done = True
-                    break
+    #
+    def get_ifmap_sram_start_stop_cycles(self):
+        assert self.traces_valid, 'Traces not generated yet'
 
+        # Tracked while servicing the requests
         return self.ifmap_sram_start_cycle, self.ifmap_sram_stop_cycle
 
     #
     def get_filter_sram_start_stop_cycles(self):
         assert self.traces_valid, 'Traces not generated yet'
 
-        done = False
-        for ridx in range(self.filter_trace_matrix.shape[0]):
-            if done:
-                break
-            row = self.filter_trace_matrix[ridx, 1:]
-            for addr in row:
-                if not addr == -1:
-                    self.filter_sram_start_cycle = self.filter_trace_matrix[ridx][0]
-                    done = True
-                    break
-
-        done = False
-        for ridx in range(self.filter_trace_matrix.shape[0]):
-            if done:
-                break
-            ridx = -1 * (ridx + 1)
-            row = self.filter_trace_matrix[ridx, 1:]
-            for addr in row:
-                if not addr == -1:
-                    self.filter_sram_stop_cycle = self.filter_trace_matrix[ridx][0]
-                    done = True
-                    break
-
+        # Tracked while servicing the requests
         return self.filter_sram_start_cycle, self.filter_sram_stop_cycle
 
     #
     def get_ofmap_sram_start_stop_cycles(self):
         assert self.traces_valid, 'Traces not generated yet'
 
-        done = False
-        for ridx in range(self.ofmap_trace_matrix.shape[0]):
-            if done:
-                break
-            row = self.ofmap_trace_matrix[ridx, 1:]
-            for addr in row:
-                if not addr == -1:
-                    self.ofmap_sram_start_cycle = self.ofmap_trace_matrix[ridx][0]
-                    done = True
-                    break
-
-        done = False
-        for ridx in range(self.ofmap_trace_matrix.shape[0]):
-            if done:
-                break
-            ridx = -1 * (ridx + 1)
-            row = self.ofmap_trace_matrix[ridx, 1:]
-            for addr in row:
-                if not addr == -1:
-                    self.ofmap_sram_stop_cycle = self.ofmap_trace_matrix[ridx][0]
-                    done = True
-                    break
-
+        # Tracked while servicing the requests
         return self.ofmap_sram_start_cycle, self.ofmap_sram_stop_cycle
 
     #
@@ -480,21 +634,25 @@ class double_buffered_scratchpad:
     #
     def get_ifmap_sram_trace_matrix(self):
         assert self.traces_valid, 'Traces not generated yet'
+        assert self.keep_sram_traces, 'SRAM traces are not kept'
         return self.ifmap_trace_matrix
 
     #
     def get_filter_sram_trace_matrix(self):
         assert self.traces_valid, 'Traces not generated yet'
+        assert self.keep_sram_traces, 'SRAM traces are not kept'
         return self.filter_trace_matrix
 
     #
     def get_ofmap_sram_trace_matrix(self):
         assert self.traces_valid, 'Traces not generated yet'
+        assert self.keep_sram_traces, 'SRAM traces are not kept'
         return self.ofmap_trace_matrix
 
     #
     def get_sram_trace_matrices(self):
         assert self.traces_valid, 'Traces not generated yet'
+        assert self.keep_sram_traces, 'SRAM traces are not kept'
         return self.ifmap_trace_matrix, self.filter_trace_matrix, self.ofmap_trace_matrix
 
     #
@@ -518,33 +676,61 @@ class double_buffered_scratchpad:
         return dram_ifmap_trace, dram_filter_trace, dram_ofmap_trace
 
         #
-    def print_ifmap_sram_trace(self, filename):
+    def print_ifmap_sram_trace(self, filename, trace_format='csv'):
         assert self.traces_valid, 'Traces not generated yet'
-        np.savetxt(filename, self.ifmap_trace_matrix, fmt='%i', delimiter=",")
+        assert self.keep_sram_traces, 'SRAM traces are not kept'
+        write_trace(filename, self.ifmap_trace_matrix, trace_format=trace_format)
 
     #
-    def print_filter_sram_trace(self, filename):
+    def print_filter_sram_trace(self, filename, trace_format='csv'):
         assert self.traces_valid, 'Traces not generated yet'
-        np.savetxt(filename, self.filter_trace_matrix, fmt='%i', delimiter=",")
+        assert self.keep_sram_traces, 'SRAM traces are not kept'
+        write_trace(filename, self.filter_trace_matrix, trace_format=trace_format)
 
     #
-    def print_ofmap_sram_trace(self, filename):
+    def print_ofmap_sram_trace(self, filename, trace_format='csv'):
         assert self.traces_valid, 'Traces not generated yet'
-        np.savetxt(filename, self.ofmap_trace_matrix, fmt='%i', delimiter=",")
+        assert self.keep_sram_traces, 'SRAM traces are not kept'
+        write_trace(filename, self.ofmap_trace_matrix, trace_format=trace_format)
 
     #
-    def print_ifmap_dram_trace(self, filename):
-        self.ifmap_buf.print_trace(filename)
+    def print_ifmap_dram_trace(self, filename, trace_format='csv'):
+        self.ifmap_buf.print_trace(filename, trace_format=trace_format)
 
     #
-    def print_filter_dram_trace(self, filename):
-        self.filter_buf.print_trace(filename)
+    def print_filter_dram_trace(self, filename, trace_format='csv'):
+        self.filter_buf.print_trace(filename, trace_format=trace_format)
 
     #
-    def print_ofmap_dram_trace(self, filename):
-        self.ofmap_buf.print_trace(filename)
+    def print_ofmap_dram_trace(self, filename, trace_format='csv'):
+        self.ofmap_buf.print_trace(filename, trace_format=trace_format)
+
+
+
+
+
+
 
+# Returns the start and stop cycles updated with the valid requests in this block of demands
+# A start cycle of -1 means that no valid request has been seen yet
+def update_start_stop_cycles(serviced_cycles, demand_mat, start_cycle, stop_cycle):
+    _, elem_lines = get_valid_requests(demand_mat)
+    if elem_lines.shape[0] == 0:
+        return start_cycle, stop_cycle
 
+    if start_cycle == -1:
+        start_cycle = serviced_cycles[elem_lines[0]][0]
+    stop_cycle = serviced_cycles[elem_lines[-1]][0]
 
+    return start_cycle, stop_cycle
 
 
+# Splits the demand matrices of a layer into blocks of chunk_lines consecutive lines
+# The blocks are read from the matrices only when these are serviced
+def get_demand_line_chunks(ifmap_demand_mat, filter_demand_mat, ofmap_demand_mat, chunk_lines):
+    num_lines = ofmap_demand_mat.shape[0]
+    for start_line in range(0, num_lines, chunk_lines):
+        end_line = min(start_line + chunk_lines, num_lines)
+        yield np.asarray(ifmap_demand_mat[start_line:end_line]), \
+              np.asarray(filter_demand_mat[start_line:end_line]), \
+              np.asarray(ofmap_demand_mat[start_line:end_line])
@@ -5,6 +5,10 @@ import numpy as np
 from tqdm import tqdm
 
 from scalesim.memory.read_port import read_port
+from scalesim.memory.trace_arena import trace_arena
+from scalesim.dtype_utils import cycle_dtype
+from scalesim.trace_utils import write_trace
+from scalesim.band_matrix import get_valid_requests
 
 
 class read_buffer:
@@ -25,24 +29,34 @@ class read_buffer:
         self.req_gen_bandwidth = 100            # words per cycle
 
         # Status of the buffer
-        self.hashed_buffer = dict()
+        self.index_keys = np.zeros(0, dtype=np.int64)    # Sorted (address, line) keys of the fetch order
         self.num_lines = 0
         self.num_active_buf_lines = 1
         self.num_prefetch_buf_lines = 1
         self.active_buffer_set_limits = []
         self.prefetch_buffer_set_limits = []
 
+        # Valid addresses in the fetch order, line l of the hashed buffer is a contiguous slice of this
+        self.valid_fetch_elems = np.ones(1, dtype=np.int64)
+        self.elems_per_set = 1
+
+        # Sorted contents of the active buffer, used to check a block of requests at once
+        self.active_buffer_contents = np.ones(1, dtype=np.int64)
+        self.active_buffer_contents_limits = []
+
         # Variables to enable prefetching
-        self.fetch_matrix = np.ones((1, 1))
+        self.fetch_matrix = np.ones((1, 1), dtype=int)
         self.last_prefect_cycle = -1
         self.next_line_prefetch_idx = 0
         self.next_col_prefetch_idx = 0
 
         # Access counts
         self.num_access = 0
+        self.num_prefetches = 0
 
-        # Trace matrix
-        self.trace_matrix = np.ones((1, 1))
+        # Trace matrix, the trace is written to the sink instead when one is set
+        self.trace_matrix = trace_arena()
+        self.trace_sink = None
 
         # Flags
         self.active_buf_full_flag = False
@@ -70,6 +84,10 @@ class read_buffer:
         self.active_buf_size = int(math.ceil(self.total_size_elems * self.active_buf_frac))
         self.prefetch_buf_size = self.total_size_elems - self.active_buf_size
 
+    # The trace is streamed to the sink as the prefetches are made, instead of being kept in the memory
+    def set_trace_sink(self, trace_sink):
+        self.trace_sink = trace_sink
+
     #
     def reset(self): # TODO: check if all resets are working propoerly
         # Buffer properties: User specified
@@ -88,21 +106,29 @@ class read_buffer:
         self.req_gen_bandwidth = 100  # words per cycle
 
         # Status of the buffer
-        self.hashed_buffer = dict()
+        self.index_keys = np.zeros(0, dtype=np.int64)    # Sorted (address, line) keys of the fetch order
         self.active_buffer_set_limits = []
         self.prefetch_buffer_set_limits = []
 
+        self.valid_fetch_elems = np.ones(1, dtype=np.int64)
+        self.elems_per_set = 1
+
+        self.active_buffer_contents = np.ones(1, dtype=np.int64)
+        self.active_buffer_contents_limits = []
+
         # Variables to enable prefetching
-        self.fetch_matrix = np.ones((1, 1))
+        self.fetch_matrix = np.ones((1, 1), dtype=int)
         self.last_prefect_cycle = -1
         self.next_line_prefetch_idx = 0
         self.next_col_prefetch_idx = 0
 
         # Access counts
         self.num_access = 0
+        self.num_prefetches = 0
 
-        # Trace matrix
-        self.trace_matrix = np.ones((1, 1))
+        # Trace matrix, the trace is written to the sink instead when one is set
+        self.trace_matrix = trace_arena()
+        self.trace_sink = None
 
         # Flags
         self.active_buf_full_flag = False
@@ -116,19 +142,13 @@ class read_buffer:
 
         num_elems = fetch_matrix_np.shape[0] * fetch_matrix_np.shape[1]
         num_lines = int(math.ceil(num_elems / self.req_gen_bandwidth))
-        self.fetch_matrix = np.ones((num_lines, self.req_gen_bandwidth)) * -1
-
-        # Put stuff into the fetch matrix
-        # This is done to ensure that there is no shape mismatch
-        # Not sure if this is the optimal way to do it or not
-        for i in range(num_elems):
-            src_row = math.floor(i / fetch_matrix_np.shape[1])
-            src_col = math.floor(i % fetch_matrix_np.shape[1])
 
-            dest_row = math.floor(i / self.req_gen_bandwidth)
-            dest_col = math.floor(i % self.req_gen_bandwidth)
-
-            self.fetch_matrix[dest_row][dest_col] = fetch_matrix_np[src_row][src_col]
+        # The fetch matrix is the prefetch matrix flattened in row major order,
+        # padded with null requests at the end and reshaped to the request bandwidth
+        # The buffer owns this copy, as the prefetch logic nullifies some of the entries in place
+        fetch_elems = np.full(num_lines * self.req_gen_bandwidth, -1, dtype=fetch_matrix_np.dtype)
+        fetch_elems[:num_elems] = fetch_matrix_np.reshape(-1)
+        self.fetch_matrix = fetch_elems.reshape((num_lines, self.req_gen_bandwidth))
 
         # Once the fetch matrices are set, populate the data structure for fast lookups and servicing
         self.prepare_hashed_buffer()
@@ -137,32 +157,32 @@ class read_buffer:
     def prepare_hashed_buffer(self):
         elems_per_set = math.ceil(self.total_size_elems / 100)
 
-        prefetch_rows = self.fetch_matrix.shape[0]
-        prefetch_cols = self.fetch_matrix.shape[1]
-
-        line_id = 0
-        elem_ctr = 0
-        current_line = set()
-
-        for r in range(prefetch_rows):
-            for c in range(prefetch_cols):
-                elem = self.fetch_matrix[r][c]
+        # Each line of the hashed buffer holds the next elems_per_set valid addresses in the fetch order
+        # These are just contiguous slices of the valid elements of the flattened fetch matrix
+        fetch_elems = self.fetch_matrix.reshape(-1)
+        self.valid_fetch_elems = fetch_elems[fetch_elems != -1]
+        self.elems_per_set = elems_per_set
 
-                if not elem == -1:
-                    current_line.add(elem)
-                    elem_ctr += 1
+        # The last line holds the remaining elements, if any
+        line_id = self.valid_fetch_elems.shape[0] // elems_per_set
+        num_lines = line_id + 1
 
-                if not elem_ctr < elems_per_set:    # ie > or =
-                    self.hashed_buffer[line_id] = current_line
-                    line_id += 1
-                    elem_ctr = 0
-                    current_line = set()        # new set
+        # The fetch order does not change, hence the lines holding each address are indexed once
+        # Each (address, line) pair is a key address * num_lines + line, kept sorted and without repeats
+        # The lines holding an address are then a contiguous run of keys
+        max_key = (int(np.max(np.abs(self.valid_fetch_elems), initial=0)) + 1) * num_lines
+        if max_key > np.iinfo(np.int64).max:
+            print('ERROR: read_buffer.prepare_hashed_buffer(): Addresses too large to index')
+            exit()
 
-        self.hashed_buffer[line_id] = current_line
+        line_ids = np.arange(self.valid_fetch_elems.shape[0], dtype=np.int64) // elems_per_set
+        keys = np.sort(self.valid_fetch_elems.astype(np.int64) * num_lines + line_ids)
+        distinct = np.ones(keys.shape[0], dtype=bool)
+        distinct[1:] = keys[1:] != keys[:-1]
+        self.index_keys = keys[distinct]
 
         max_num_active_buf_lines = int(math.ceil(self.active_buf_size / elems_per_set))
         max_num_prefetch_buf_lines = int(math.ceil(self.prefetch_buf_size / elems_per_set))
-        num_lines = line_id + 1
 
         if num_lines > max_num_active_buf_lines:
             self.num_active_buf_lines = max_num_active_buf_lines
@@ -183,26 +203,82 @@ class read_buffer:
     def active_buffer_hit(self, addr):
         assert self.active_buf_full_flag, 'Active buffer is not ready yet'
 
+        # The keys of this address which fall in the active lines
+        base_key = int(addr) * self.num_lines
         start_id, end_id = self.active_buffer_set_limits
+        idx = self.index_keys.searchsorted(base_key + start_id)
+        num_keys = self.index_keys.shape[0]
+
         if start_id < end_id:
-            for line_id in range(start_id, end_id):
-                this_set = self.hashed_buffer[line_id]      # O(1) --> accessing hash
-                if addr in this_set:                        # Checking in a set(), O(1) lookup
-                    return True
+            return idx < num_keys and self.index_keys[idx] < base_key + end_id
 
+        # The active buffer wraps around the last line
+        if idx < num_keys and self.index_keys[idx] < base_key + self.num_lines:
+            return True
+
+        idx = self.index_keys.searchsorted(base_key)
+        return idx < num_keys and self.index_keys[idx] < base_key + end_id
+
+    #
+    def get_active_buffer_contents(self):
+        assert self.active_buf_full_flag, 'Active buffer is not ready yet'
+
+        # The contents only change when a new prefetch moves the active buffer limits
+        if self.active_buffer_contents_limits == self.active_buffer_set_limits:
+            return self.active_buffer_contents
+
+        start_id, end_id = self.active_buffer_set_limits
+        if start_id < end_id:
+            line_ranges = [(start_id, end_id)]
         else:
-            for line_id in range(start_id, self.num_lines):
-                this_set = self.hashed_buffer[line_id]  # O(1) --> accessing hash
-                if addr in this_set:  # Checking in a set(), O(1) lookup
-                    return True
-
-            for line_id in range(end_id):
-                this_set = self.hashed_buffer[line_id]  # O(1) --> accessing hash
-                if addr in this_set:  # Checking in a set(), O(1) lookup
-                    return True
-        # Fixing for ISSUE #14
-        # return True
-        return False
+            line_ranges = [(start_id, self.num_lines), (0, end_id)]
+
+        slices = [self.valid_fetch_elems[start * self.elems_per_set: end * self.elems_per_set]
+                  for start, end in line_ranges]
+
+        self.active_buffer_contents = np.unique(np.concatenate(slices))
+        self.active_buffer_contents_limits = list(self.active_buffer_set_limits)
+
+        return self.active_buffer_contents
+
+    # Index of the first line of requests which has an address not present in the active buffer
+    # Returns the number of lines if all the requests are hits
+    # The requests are an array or a band matrix, only the valid requests are looked up
+    # This does not change the state of the buffer
+    def get_first_miss_line(self, incoming_requests_arr_np):
+        num_lines = incoming_requests_arr_np.shape[0]
+        if not self.active_buf_full_flag:
+            return 0
+
+        elems, elem_lines = get_valid_requests(incoming_requests_arr_np)
+        first_miss = self.get_first_miss_elem(elems)
+
+        if first_miss == elems.shape[0]:
+            return num_lines
+
+        return int(elem_lines[first_miss])
+
+    # Index of the first of the valid requests which is not present in the active buffer
+    def get_first_miss_elem(self, elems):
+        if elems.shape[0] == 0:
+            return 0
+
+        contents = self.get_active_buffer_contents()
+        if contents.shape[0] == 0:
+            return 0
+
+        idx = np.searchsorted(contents, elems)
+        idx = np.minimum(idx, contents.shape[0] - 1)
+        miss_elems = np.flatnonzero(contents[idx] != elems)
+
+        if miss_elems.shape[0] == 0:
+            return elems.shape[0]
+
+        return int(miss_elems[0])
+
+    # The read buffer stalls only on a miss
+    def get_first_event_line(self, incoming_requests_arr_np):
+        return self.get_first_miss_line(incoming_requests_arr_np)
 
     #
     def service_reads(self, incoming_requests_arr_np,   # 2D array with the requests
@@ -219,19 +295,31 @@ class read_buffer:
             self.prefetch_active_buffer(start_cycle=start_cycle)    # Needs to use the entire operand matrix
                                                                     # keeping in mind the tile order and everything
 
-        out_cycles_arr = []
         offset = self.hit_latency
+        num_lines = incoming_requests_arr_np.shape[0]
+
+        # Only the valid requests are looked at, the null requests are always served
+        elems, elem_lines = get_valid_requests(incoming_requests_arr_np)
+
+        # The lines before the first miss are all hits and are served in bulk
+        first_miss = self.get_first_miss_elem(elems)
+        if first_miss == elems.shape[0]:
+            first_miss_line = num_lines
+        else:
+            first_miss_line = int(elem_lines[first_miss])
+        out_cycles_arr = list(incoming_cycles_arr[:first_miss_line] + offset)
+
+        # The valid requests of line i are elems[line_limits[i - first_miss_line]:line_limits[i - first_miss_line + 1]]
+        line_limits = np.searchsorted(elem_lines, np.arange(first_miss_line, num_lines + 1))
+
         # for cycle, request_line in tqdm(zip(incoming_cycles_arr, incoming_requests_arr_np)):
-        for i in tqdm(range(incoming_requests_arr_np.shape[0]), disable=True):
+        for i in tqdm(range(first_miss_line, num_lines), disable=True):
             cycle = incoming_cycles_arr[i]
             # Fixing for ISSUE #14
             # request_line = set(incoming_requests_arr_np[i]) #shaves off a few seconds
-            request_line = incoming_requests_arr_np[i]
+            request_line = elems[line_limits[i - first_miss_line]:line_limits[i - first_miss_line + 1]]
 
             for addr in request_line:
-                if addr == -1:
-                    continue
-
                 # if addr not in self.active_buffer_contents: #this is super slow!!!
                 # Fixing for ISSUE #14
                 # if not self.active_buffer_hit(addr):  # --> While loop ensures multiple prefetches if needed
@@ -246,7 +334,7 @@ class read_buffer:
             out_cycles = cycle + offset
             out_cycles_arr.append(out_cycles)
 
-        out_cycles_arr_np = np.asarray(out_cycles_arr).reshape((len(out_cycles_arr), 1))
+        out_cycles_arr_np = np.asarray(out_cycles_arr, dtype=cycle_dtype).reshape((len(out_cycles_arr), 1))
 
         return out_cycles_arr_np
 
@@ -262,6 +350,7 @@ class read_buffer:
 
         requested_data_size = num_lines * self.req_gen_bandwidth
         self.num_access += requested_data_size
+        self.num_prefetches += 1
 
         start_idx = 0
         end_idx = num_lines
@@ -281,7 +370,7 @@ class read_buffer:
 
         # 2. Preparing the cycles array
         #    The start_cycle variable ensures that all the requests have been made before any incoming reads came
-        cycles_arr = np.zeros((num_lines, 1))
+        cycles_arr = np.zeros((num_lines, 1), dtype=cycle_dtype)
         for i in range(cycles_arr.shape[0]):
             cycles_arr[i][0] = -1 * (num_lines - start_cycle - (i - self.backing_buffer.get_latency()))
 
@@ -293,7 +382,12 @@ class read_buffer:
         self.last_prefect_cycle = int(response_cycles_arr[-1][0])
 
         # Update the trace matrix
-        self.trace_matrix = np.concatenate((response_cycles_arr, prefetch_requests), axis=1)
+        this_prefetch_trace = np.concatenate((response_cycles_arr, prefetch_requests), axis=1)
+        if self.trace_sink is None:
+            self.trace_matrix.set_params(num_cols=this_prefetch_trace.shape[1])
+            self.trace_matrix.append(this_prefetch_trace)
+        else:
+            self.trace_sink.append(this_prefetch_trace)
         self.trace_valid = True
 
         # Set active buffer contents
@@ -339,6 +433,7 @@ class read_buffer:
         end_idx = start_idx + num_lines
         requested_data_size = num_lines * self.req_gen_bandwidth
         self.num_access += requested_data_size
+        self.num_prefetches += 1
 
         # In case we need to circle back
         if end_idx > self.fetch_matrix.shape[0]:
@@ -363,7 +458,7 @@ class read_buffer:
                 prefetch_requests[row][col] = -1
 
         # 3. Create the request cycles
-        cycles_arr = np.zeros((num_lines, 1))
+        cycles_arr = np.zeros((num_lines, 1), dtype=cycle_dtype)
         for i in range(cycles_arr.shape[0]):
             # Fixing ISSUE #14
             # cycles_arr[i][0] = self.last_prefect_cycle + i
@@ -379,7 +474,10 @@ class read_buffer:
         assert response_cycles_arr.shape == cycles_arr.shape, 'The request and response cycles dims do not match'
 
         this_prefetch_trace = np.concatenate((response_cycles_arr, prefetch_requests), axis=1)
-        self.trace_matrix = np.concatenate((self.trace_matrix, this_prefetch_trace), axis=0)
+        if self.trace_sink is None:
+            self.trace_matrix.append(this_prefetch_trace)
+        else:
+            self.trace_sink.append(this_prefetch_trace)
 
         # Set the line to be prefetched next
         if requested_data_size > self.active_buf_size:
@@ -395,7 +493,8 @@ class read_buffer:
             print('No trace has been generated yet')
             return
 
-        return self.trace_matrix
+        assert self.trace_sink is None, 'The trace is streamed to the disk'
+        return self.trace_matrix.get_view()
 
     #
     def get_hit_latency(self):
@@ -410,18 +509,28 @@ class read_buffer:
         assert self.trace_valid, 'Traces not ready yet'
         return self.num_access
 
+    #
+    def get_num_prefetches(self):
+        return self.num_prefetches
+
     #
     def get_external_access_start_stop_cycles(self):
         assert self.trace_valid, 'Traces not ready yet'
-        start_cycle = self.trace_matrix[0][0]
-        end_cycle = self.trace_matrix[-1][0]
+        if self.trace_sink is not None:
+            return self.trace_sink.get_start_stop_cycles()
+
+        trace_matrix = self.trace_matrix.get_view()
+        start_cycle = trace_matrix[0][0]
+        end_cycle = trace_matrix[-1][0]
 
         return start_cycle, end_cycle
 
     #
-    def print_trace(self, filename):
+    def print_trace(self, filename, trace_format='csv'):
         if not self.trace_valid:
             print('No trace has been generated yet')
             return
 
-        np.savetxt(filename, self.trace_matrix, fmt='%s', delimiter=",")
+        assert self.trace_sink is None, 'The trace is streamed to the disk'
+
+        write_trace(filename, self.trace_matrix.get_view(), trace_format=trace_format)
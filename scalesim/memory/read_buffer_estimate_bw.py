@@ -2,6 +2,10 @@ import math
 import numpy as np
 
 from scalesim.memory.read_port import read_port
+from scalesim.memory.trace_arena import trace_arena
+from scalesim.dtype_utils import cycle_dtype
+from scalesim.trace_utils import write_trace
+from scalesim.band_matrix import get_valid_requests
 
 
 class ReadBufferEstimateBw:
@@ -23,9 +27,12 @@ class ReadBufferEstimateBw:
 
         # Access counts
         self.num_access = 0
+        self.num_prefetches = 0
 
-        # Trace matrix
-        self.trace_matrix = np.ones((1, 1))
+        # Trace matrix, the trace is written to the sink instead when one is set
+        self.trace_matrix = trace_arena()
+        self.trace_sink = None
+        self.addr_dtype = np.int32      # Follows the dtype of the incoming requests
 
         # Tracking variables
         self.num_items_per_set = -1
@@ -40,11 +47,16 @@ class ReadBufferEstimateBw:
         self.first_request_rcvd_cycle = 0
 
         # Internal data structures
-        self.current_set = set()
+        self.current_set_elems = []     # Blocks of addresses in the current set, in the order of first request
         self.list_of_sets = []
         self.num_sets_active_buffer = 1
         self.num_sets_prefetch_buffer = 1
 
+        # Id of the set each address was put in last, -1 if never seen, indexed from addr_base
+        # An address is in the buffer if this set is not retired yet
+        self.addr_base = 0
+        self.last_set_ids = np.zeros(0, dtype=np.int32)
+
         # Flags
         self.first_request_seen = False
         self.params_set_flag = False
@@ -77,9 +89,11 @@ class ReadBufferEstimateBw:
         self.num_sets_active_buffer = int(self.active_buf_frac * 100)
         self.num_sets_prefetch_buffer = 100 - self.num_sets_active_buffer
 
-        self.current_set = set()
+        self.current_set_elems = []
         self.current_set_id = 0
         self.list_of_sets = []
+        self.addr_base = 0
+        self.last_set_ids = np.zeros(0, dtype=np.int32)
         self.read_buffer_set_start_id = 0
         self.read_buffer_set_end_id = self.num_sets_active_buffer - 1
         self.last_prefetch_start_cycle = -2
@@ -88,6 +102,14 @@ class ReadBufferEstimateBw:
         #
         self.params_set_flag = True
 
+    # The trace is streamed to the sink as the prefetches are made, instead of being kept in the memory
+    def set_trace_sink(self, trace_sink):
+        self.trace_sink = trace_sink
+
+    # In estimate mode the reads never stall, hence there is no line at which the buffer needs attention
+    def get_first_event_line(self, incoming_requests_arr_np):
+        return incoming_requests_arr_np.shape[0]
+
     #
     def service_reads(self, incoming_requests_arr_np, incoming_cycles_arr):
         assert self.params_set_flag, 'Parameters are not set yet'
@@ -95,99 +117,158 @@ class ReadBufferEstimateBw:
 
         outcycles = incoming_cycles_arr + self.hit_latency  # In estimate mode, operation is stall free.
         # Therefore its always a hit
+        self.addr_dtype = incoming_requests_arr_np.dtype
 
         # The following to track requests and maintain proper state of the buffer
-        for i in range(incoming_requests_arr_np.shape[0]):
-            cycle = int(incoming_cycles_arr[i][0])
-
-            requests_this_cycle = incoming_requests_arr_np[i]
-            if not self.first_request_seen:
-                if max(requests_this_cycle) > -1:
-                    self.first_request_rcvd_cycle = cycle
-                    self.first_request_seen = True
-
-            for addr in requests_this_cycle:
-                if not addr == -1:
-                    self.manage_prefetches(cycle, addr)
+        self.track_requests(incoming_requests_arr_np, incoming_cycles_arr)
 
         return outcycles
 
-    #
-    def manage_prefetches(self, cycle, addr):
+    # Puts the addresses seen for the first time into sets, in the order of the requests,
+    # and prefetches the sets as they fill up.
+    # An address is new if it is not in any of the sets which are not retired yet, including the current one.
+    # Between two filled sets the live sets do not change, hence the new addresses are the
+    # first occurrences of the addresses which were last put in a retired set, or never seen.
+    def track_requests(self, incoming_requests_arr_np, incoming_cycles_arr):
+        # The row of each request, to find the cycle at which a set fills up
+        addrs, rows = get_valid_requests(incoming_requests_arr_np)
+        addrs = addrs.astype(np.int64)
+        if addrs.shape[0] == 0:
+            return
 
-        # If this is a new address, otherwise its a hit
-        if self.check_hit(addr):
+        if not self.first_request_seen:
+            self.first_request_rcvd_cycle = int(incoming_cycles_arr[rows[0]][0])
+            self.first_request_seen = True
+
+        self.grow_last_set_ids(int(addrs.min()), int(addrs.max()))
+        addr_idx = addrs - self.addr_base
+
+        num_addrs = addrs.shape[0]
+        pos = 0
+        while pos < num_addrs:
+            if self.num_items_per_set > 0:
+                elems_needed = self.num_items_per_set - self.elems_current_set
+            else:
+                elems_needed = num_addrs            # The set never fills up
+
+            # Look ahead just enough requests to fill up the current set
+            window = 4 * elems_needed
+            while True:
+                end = min(pos + window, num_addrs)
+                candidates = np.flatnonzero(self.last_set_ids[addr_idx[pos:end]] < self.read_buffer_set_start_id)
+                _, first_idx = np.unique(addr_idx[pos:end][candidates], return_index=True)
+                new_idx = candidates[np.sort(first_idx)]
+
+                if new_idx.shape[0] >= elems_needed or end == num_addrs:
+                    break
+                window *= 2
+
+            new_idx = new_idx[:elems_needed]
+            self.last_set_ids[addr_idx[pos:end][new_idx]] = self.current_set_id
+            self.current_set_elems.append(addrs[pos:end][new_idx])
+            self.elems_current_set += new_idx.shape[0]
+
+            if not self.elems_current_set == self.num_items_per_set:
+                break
+
+            last_new = pos + int(new_idx[-1])
+            self.fill_current_set(cycle=int(incoming_cycles_arr[rows[last_new]][0]))
+            pos = last_new + 1
+
+    # The addresses are tracked in an array indexed from the lowest address seen, grown as needed
+    def grow_last_set_ids(self, min_addr, max_addr):
+        if self.last_set_ids.shape[0] == 0:
+            self.addr_base = min_addr
+            self.last_set_ids = np.full(max_addr - min_addr + 1, -1, dtype=np.int32)
             return
 
-        if addr not in self.current_set:
-            self.current_set.add(addr)
-            self.elems_current_set += 1
-
-            if self.elems_current_set == self.num_items_per_set:
-                self.list_of_sets += [self.current_set]
-                self.current_set = set()
-                self.elems_current_set = 0
-                self.current_set_id += 1
-
-                if self.current_set_id == self.read_buffer_set_end_id + 1:  # This should be prefetched
-                    if not self.active_buffer_prefetch_done:
-                        self.prefetch_bandwidth = self.default_bandwidth
-                        self.last_prefetch_end_cycle = self.first_request_rcvd_cycle - 1 - self.backing_buffer.get_latency()
-
-                        cycles_needed = (self.num_sets_prefetch_buffer * self.num_items_per_set) \
-                                        / self.prefetch_bandwidth
-                        cycles_needed = math.ceil(cycles_needed)
-
-                        self.last_prefetch_start_cycle = self.last_prefetch_end_cycle - cycles_needed + 1
-
-                        self.prefetch()
-                        self.prefetch_buffer_set_start_id =self.read_buffer_set_end_id + 1
-                        self.prefetch_buffer_set_end_id = self.prefetch_buffer_set_start_id + \
-                                                          self.num_sets_prefetch_buffer - 1
-                        self.active_buffer_prefetch_done = True
-
-                    else:
-                        elems_to_prefetch = self.num_sets_prefetch_buffer * self.num_items_per_set
-                        cycles_needed = self.last_prefetch_end_cycle - self.last_prefetch_start_cycle + 1
-                        self.prefetch_bandwidth = math.ceil(elems_to_prefetch / cycles_needed)
-                        self.prefetch()
-                        self.prefetch_buffer_set_start_id += self.num_sets_prefetch_buffer
-                        self.prefetch_buffer_set_end_id += self.num_sets_prefetch_buffer
-                    
-                    #Solving memory leak by discarding sets that are no longer in use
-                    i = self.read_buffer_set_start_id
-                    for j in range(self.num_sets_prefetch_buffer):
-                        self.list_of_sets[i+j] = None
-
-
-                    self.read_buffer_set_start_id += self.num_sets_prefetch_buffer
-                    self.read_buffer_set_end_id += self.num_sets_prefetch_buffer
-                    self.last_prefetch_start_cycle = self.last_prefetch_end_cycle +1
-                    self.last_prefetch_end_cycle = cycle
+        addr_end = self.addr_base + self.last_set_ids.shape[0]
+        if self.addr_base <= min_addr and max_addr < addr_end:
+            return
+
+        # Grow geometrically, the addresses of an operand are usually seen in an increasing order
+        size = self.last_set_ids.shape[0]
+        new_base = min(min_addr, self.addr_base)
+        new_end = max(max_addr + 1, addr_end)
+        if new_end > addr_end:
+            new_end = max(new_end, addr_end + size)
+        if new_base < self.addr_base:
+            new_base = min(new_base, self.addr_base - size)
+
+        last_set_ids = np.full(new_end - new_base, -1, dtype=np.int32)
+        offset = self.addr_base - new_base
+        last_set_ids[offset: offset + size] = self.last_set_ids
+
+        self.addr_base = new_base
+        self.last_set_ids = last_set_ids
+
+    # The current set is full, move on to the next set and prefetch if the read buffer is full
+    def fill_current_set(self, cycle):
+        self.list_of_sets += [self.get_current_set()]
+        self.current_set_elems = []
+        self.elems_current_set = 0
+        self.current_set_id += 1
+
+        if self.current_set_id == self.read_buffer_set_end_id + 1:  # This should be prefetched
+            if not self.active_buffer_prefetch_done:
+                self.prefetch_bandwidth = self.default_bandwidth
+                self.last_prefetch_end_cycle = self.first_request_rcvd_cycle - 1 - self.backing_buffer.get_latency()
+
+                cycles_needed = (self.num_sets_prefetch_buffer * self.num_items_per_set) \
+                                / self.prefetch_bandwidth
+                cycles_needed = math.ceil(cycles_needed)
+
+                self.last_prefetch_start_cycle = self.last_prefetch_end_cycle - cycles_needed + 1
+
+                self.prefetch()
+                self.prefetch_buffer_set_start_id =self.read_buffer_set_end_id + 1
+                self.prefetch_buffer_set_end_id = self.prefetch_buffer_set_start_id + \
+                                                  self.num_sets_prefetch_buffer - 1
+                self.active_buffer_prefetch_done = True
+
+            else:
+                elems_to_prefetch = self.num_sets_prefetch_buffer * self.num_items_per_set
+                cycles_needed = self.last_prefetch_end_cycle - self.last_prefetch_start_cycle + 1
+                self.prefetch_bandwidth = math.ceil(elems_to_prefetch / cycles_needed)
+                self.prefetch()
+                self.prefetch_buffer_set_start_id += self.num_sets_prefetch_buffer
+                self.prefetch_buffer_set_end_id += self.num_sets_prefetch_buffer
+
+            #Solving memory leak by discarding sets that are no longer in use
+            # The addresses in these sets are new again, as their set ids are below the read buffer start
+            i = self.read_buffer_set_start_id
+            for j in range(self.num_sets_prefetch_buffer):
+                self.list_of_sets[i+j] = None
+
+            self.read_buffer_set_start_id += self.num_sets_prefetch_buffer
+            self.read_buffer_set_end_id += self.num_sets_prefetch_buffer
+            self.last_prefetch_start_cycle = self.last_prefetch_end_cycle +1
+            self.last_prefetch_end_cycle = cycle
+
+    # The addresses of the current set, as a python set
+    # prefetch() reads the addresses in the iteration order of the set, the traces depend on it
+    def get_current_set(self):
+        if len(self.current_set_elems) == 0:
+            return set()
+        return set(np.concatenate(self.current_set_elems).tolist())
 
     #
     def check_hit(self, addr):
         assert self.params_set_flag, 'Parameters are not set yet'
 
-        start_set_idx = self.read_buffer_set_start_id
-        end_set_idx = min(self.current_set_id, self.read_buffer_set_end_id + 1)
-
-        if start_set_idx == end_set_idx:
+        addr_idx = addr - self.addr_base
+        if not 0 <= addr_idx < self.last_set_ids.shape[0]:
             return False
 
-        for idx in range(start_set_idx, end_set_idx):
-            if addr in self.list_of_sets[idx]:
-                return True
-
-        return False
+        set_id = self.last_set_ids[addr_idx]
+        return self.read_buffer_set_start_id <= set_id < self.current_set_id
 
     #
     def complete_all_prefetches(self):
         assert self.params_set_flag, 'Parameters are not set yet'
 
-        current_set_elems = list(self.current_set)
-        if len(current_set_elems) > 0:
-            self.list_of_sets += [self.current_set]
+        if self.elems_current_set > 0:
+            self.list_of_sets += [self.get_current_set()]
         else:
             self.current_set_id -= 1    # If there are no elems in this set, dont consider it
 
@@ -217,6 +298,7 @@ class ReadBufferEstimateBw:
     #
     def prefetch(self):
         assert self.params_set_flag, 'Parameters are not set yet'
+        self.num_prefetches += 1
 
         if not self.active_buffer_prefetch_done:
             start_set_idx = 0
@@ -241,9 +323,10 @@ class ReadBufferEstimateBw:
             for _ in range(delta):
                 all_addresses += [-1]
 
-        prefetch_requests = np.asarray(all_addresses).reshape((cycles_needed, self.prefetch_bandwidth))
+        prefetch_requests = np.asarray(all_addresses, dtype=self.addr_dtype)
+        prefetch_requests = prefetch_requests.reshape((cycles_needed, self.prefetch_bandwidth))
 
-        cycles_arr = np.zeros((cycles_needed,1))
+        cycles_arr = np.zeros((cycles_needed,1), dtype=cycle_dtype)
         for i in range(cycles_arr.shape[0]):
             cycles_arr[i][0] = self.last_prefetch_start_cycle + i
 
@@ -253,22 +336,18 @@ class ReadBufferEstimateBw:
         # Create / add elements to the trace matrix
         this_prefetch_traces = np.concatenate((response_cycles_arr, prefetch_requests), axis=1)
 
-        if not self.trace_valid:
-            self.trace_matrix = this_prefetch_traces
+        if self.trace_sink is not None:
+            # The sink pads the rows to the widest prefetch, as done below
+            self.trace_sink.append(this_prefetch_traces)
             self.trace_valid = True
 
         else:
-            del_cols = self.trace_matrix.shape[1] - this_prefetch_traces.shape[1]
-            if del_cols > 0:
-                empty_cols = np.ones((this_prefetch_traces.shape[0], del_cols))
-                this_prefetch_traces = np.concatenate((this_prefetch_traces, empty_cols), axis=1)
+            # The arena pads the rows to the widest prefetch with 1s
+            if not self.trace_valid:
+                self.trace_matrix.set_params(num_cols=this_prefetch_traces.shape[1], pad_value=1)
+                self.trace_valid = True
 
-            elif del_cols < 0:
-                del_cols = int(-1 * del_cols)
-                empty_cols = np.ones((self.trace_matrix.shape[0], del_cols))
-                self.trace_matrix = np.concatenate((self.trace_matrix, empty_cols), axis=1)
-
-            self.trace_matrix = np.concatenate((self.trace_matrix, this_prefetch_traces), axis=0)
+            self.trace_matrix.append(this_prefetch_traces)
 
     #
     def get_latency(self):
@@ -281,7 +360,8 @@ class ReadBufferEstimateBw:
             print('No trace has been generated yet')
             return
 
-        return self.trace_matrix
+        assert self.trace_sink is None, 'The trace is streamed to the disk'
+        return self.trace_matrix.get_view()
 
     #
     def get_hit_latency(self):
@@ -292,20 +372,29 @@ class ReadBufferEstimateBw:
         assert self.trace_valid, 'Traces not ready yet'
         return self.num_access
 
+    #
+    def get_num_prefetches(self):
+        return self.num_prefetches
+
     #
     def get_external_access_start_stop_cycles(self):
         assert self.trace_valid, 'Traces not ready yet'
-        start_cycle = self.trace_matrix[0][0]
-        end_cycle = self.trace_matrix[-1][0]
+        if self.trace_sink is not None:
+            return self.trace_sink.get_start_stop_cycles()
+
+        trace_matrix = self.trace_matrix.get_view()
+        start_cycle = trace_matrix[0][0]
+        end_cycle = trace_matrix[-1][0]
 
         return start_cycle, end_cycle
 
     #
-    def print_trace(self, filename):
+    def print_trace(self, filename, trace_format='csv'):
         if not self.trace_valid:
             print('No trace has been generated yet')
             return
 
-        np.savetxt(filename, self.trace_matrix, fmt='%s', delimiter=",")
+        assert self.trace_sink is None, 'The trace is streamed to the disk'
+        write_trace(filename, self.trace_matrix.get_view(), trace_format=trace_format)
 
 
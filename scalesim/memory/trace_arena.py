@@ -0,0 +1,124 @@
+# Growable storage for the rows of a trace
+# The rows are kept in one preallocated array whose capacity doubles when it is full,
+# so appending a block of rows only copies the block, in the amortized sense
+import numpy as np
+
+from scalesim.dtype_utils import cycle_dtype
+
+# Rows allocated on the first append
+default_init_rows = 2 ** 10
+
+
+class trace_arena:
+    def __init__(self):
+        self.num_cols = 0
+        self.dtype = np.dtype(cycle_dtype)
+        self.init_rows = default_init_rows
+
+        # Value used for the columns missing in the narrower rows
+        self.pad_value = 1
+
+        # The live rows are storage[start_row:end_row]
+        self.storage = np.zeros((0, 0), dtype=self.dtype)
+        self.start_row = 0
+        self.end_row = 0
+
+        self.params_set_flag = False
+
+    #
+    def set_params(self, num_cols=0, dtype=cycle_dtype, init_rows=default_init_rows, pad_value=1):
+        assert num_cols >= 0, 'Number of columns cannot be negative'
+        assert init_rows > 0, 'At least one row should be allocated'
+
+        self.num_cols = num_cols
+        self.dtype = np.dtype(dtype)
+        self.init_rows = init_rows
+        self.pad_value = pad_value
+
+        self.storage = np.zeros((0, self.num_cols), dtype=self.dtype)
+        self.start_row = 0
+        self.end_row = 0
+
+        self.params_set_flag = True
+
+    #
+    def reset(self):
+        self.storage = np.zeros((0, self.num_cols), dtype=self.dtype)
+        self.start_row = 0
+        self.end_row = 0
+
+    # Appends a 2D block of rows
+    # Narrower blocks are padded with pad_value, a wider block pads all the rows stored so far
+    def append(self, trace_block):
+        assert self.params_set_flag, 'Parameters are not set'
+
+        rows = trace_block.shape[0]
+        if rows == 0:
+            return
+
+        cols = trace_block.shape[1]
+        if cols > self.num_cols:
+            self.widen(cols)
+
+        self.reserve(rows)
+
+        new_end_row = self.end_row + rows
+        self.storage[self.end_row:new_end_row, :cols] = trace_block
+        if cols < self.num_cols:
+            self.storage[self.end_row:new_end_row, cols:] = self.pad_value
+        self.end_row = new_end_row
+
+    # Makes room for num_rows more rows at the end
+    def reserve(self, num_rows):
+        if self.end_row + num_rows <= self.storage.shape[0]:
+            return
+
+        live_rows = self.end_row - self.start_row
+        capacity = max(self.storage.shape[0], self.init_rows)
+        while capacity < live_rows + num_rows:
+            capacity *= 2
+
+        # The rows dropped from the front make room before the storage is grown
+        if capacity > self.storage.shape[0]:
+            new_storage = np.empty((capacity, self.num_cols), dtype=self.dtype)
+        else:
+            new_storage = self.storage
+
+        new_storage[:live_rows] = self.storage[self.start_row:self.end_row]
+        self.storage = new_storage
+        self.start_row = 0
+        self.end_row = live_rows
+
+    #
+    def widen(self, num_cols):
+        new_storage = np.empty((self.storage.shape[0], num_cols), dtype=self.dtype)
+        new_storage[:, :self.num_cols] = self.storage
+        new_storage[:, self.num_cols:] = self.pad_value
+
+        self.storage = new_storage
+        self.num_cols = num_cols
+
+    # Drops the first num_rows rows, for the rows which are not needed any more
+    def discard_rows(self, num_rows):
+        assert 0 <= num_rows <= self.get_num_rows(), 'Cannot discard more rows than stored'
+        self.start_row += num_rows
+
+        if self.start_row == self.end_row:
+            self.start_row = 0
+            self.end_row = 0
+
+    # Zero copy view of the rows, it is only valid till the next append or discard
+    def get_view(self):
+        return self.storage[self.start_row:self.end_row]
+
+    #
+    def get_num_rows(self):
+        return self.end_row - self.start_row
+
+    #
+    def get_num_cols(self):
+        return self.num_cols
+
+    #
+    def is_empty(self):
+        return self.end_row == self.start_row
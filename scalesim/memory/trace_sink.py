@@ -0,0 +1,238 @@
+# Streams a trace to the disk while the simulation runs
+# Only a fixed number of rows are held in the memory, the rest of the trace is on the disk
+# With a trace_writer set, the rows are written on its thread and the trace is complete only once it is drained
+import os
+import numpy as np
+
+from scalesim.dtype_utils import cycle_dtype
+from scalesim.trace_utils import trace_formats, write_trace
+
+# Rows buffered per trace before they are written out
+default_flush_rows = 2 ** 14
+
+# The .npy header is written with a fixed size, so that the shape can be filled in once the trace is complete
+npy_header_size = 128
+
+
+class trace_sink:
+    def __init__(self):
+        self.filename = ''
+        self.trace_format = 'csv'
+        self.flush_rows = default_flush_rows
+        self.dtype = np.dtype(cycle_dtype)
+
+        # Rows waiting to be written
+        self.pending_blocks = []
+        self.pending_rows = 0
+
+        # Summary of the rows seen so far
+        self.num_rows = 0
+        self.num_cols = 0
+        self.first_cycle = 0
+        self.last_cycle = 0
+
+        # Rows and columns of the runs of rows written to the file
+        # The rows narrower than the widest row are padded with 1s when the sink is closed
+        self.file_segments = []
+
+        self.file_handle = None
+        self.params_set_flag = False
+        self.closed_flag = False
+
+        # The time spent writing is added to the trace_writing stage, when profiling
+        self.profiler = None
+
+        # When set, the blocks are written on the background thread of the writer, see trace_writer
+        self.writer = None
+
+    #
+    def set_params(self, filename, trace_format='csv', flush_rows=default_flush_rows):
+        assert trace_format in trace_formats, 'Trace format should be one of ' + ', '.join(trace_formats)
+        assert flush_rows > 0, 'At least one row should be buffered'
+
+        self.filename = filename
+        self.trace_format = trace_format
+        self.flush_rows = flush_rows
+
+        self.pending_blocks = []
+        self.pending_rows = 0
+        self.num_rows = 0
+        self.num_cols = 0
+        self.file_segments = []
+
+        self.file_handle = None
+        self.params_set_flag = True
+        self.closed_flag = False
+
+    # The trace block has the cycles in the first column followed by the addresses
+    def append(self, trace_block):
+        assert self.params_set_flag, 'Parameters are not set'
+        assert not self.closed_flag, 'The trace is already closed'
+
+        rows = trace_block.shape[0]
+        if rows == 0:
+            return
+
+        # Narrower blocks are padded with 1s, as in the traces kept in the memory
+        cols = trace_block.shape[1]
+        if cols < self.num_cols:
+            pad = np.ones((rows, self.num_cols - cols), dtype=self.dtype)
+            trace_block = np.concatenate((trace_block, pad), axis=1)
+        elif cols > self.num_cols:
+            self.flush()
+            self.num_cols = cols
+
+        if self.num_rows == 0:
+            self.first_cycle = trace_block[0][0]
+        self.last_cycle = trace_block[-1][0]
+        self.num_rows += rows
+
+        self.pending_blocks.append(trace_block)
+        self.pending_rows += rows
+
+        if not self.pending_rows < self.flush_rows:
+            self.flush()
+
+    #
+    def set_profiler(self, profiler):
+        self.profiler = profiler
+
+    # The writes and the fix up of the file when it is closed are handed over to the writer
+    # Needs to be called before any rows are appended
+    def set_trace_writer(self, writer):
+        assert self.num_rows == 0, 'Rows have been appended already'
+        self.writer = writer
+
+    # Writes the pending rows to the file, or hands them over to the writer
+    def flush(self):
+        if self.pending_rows == 0:
+            return
+
+        if self.profiler is not None:
+            self.profiler.start('trace_writing')
+
+        if self.file_handle is None:
+            self.open_file()
+
+        # The concatenated block is a new array, hence the writer can own it
+        trace_block = np.concatenate(self.pending_blocks, axis=0).astype(self.dtype, copy=False)
+        if self.writer is None:
+            self.write_block(trace_block)
+        else:
+            self.writer.submit(self.write_block, trace_block)
+
+        cols = trace_block.shape[1]
+        if len(self.file_segments) > 0 and self.file_segments[-1][1] == cols:
+            self.file_segments[-1][0] += trace_block.shape[0]
+        else:
+            self.file_segments.append([trace_block.shape[0], cols])
+
+        self.pending_blocks = []
+        self.pending_rows = 0
+
+        if self.profiler is not None:
+            self.profiler.stop('trace_writing')
+
+    #
+    def write_block(self, trace_block):
+        if self.trace_format == 'npy':
+            self.file_handle.write(np.ascontiguousarray(trace_block).tobytes())
+        else:
+            write_trace(self.file_handle, trace_block, trace_format='csv')
+
+    #
+    def open_file(self):
+        if self.trace_format == 'npy':
+            self.file_handle = open(self.filename, 'wb')
+            write_npy_header(self.file_handle, self.dtype, (0, 0))
+        else:
+            self.file_handle = open(self.filename, 'w')
+
+    # Writes out the rest of the trace and fixes up the file, the trace is not written if there are no rows
+    def close(self):
+        assert self.params_set_flag, 'Parameters are not set'
+        if self.closed_flag:
+            return
+
+        self.flush()
+        self.closed_flag = True
+
+        if self.file_handle is None:
+            return
+
+        # The file is complete once the writer is done with the blocks handed over before
+        if self.writer is not None:
+            self.writer.submit(self.finish_file)
+            return
+
+        if self.profiler is not None:
+            self.profiler.start('trace_writing')
+        self.finish_file()
+        if self.profiler is not None:
+            self.profiler.stop('trace_writing')
+
+    # Fills in the shape of a binary trace and pads the narrower rows
+    def finish_file(self):
+        if self.trace_format == 'npy':
+            self.file_handle.seek(0)
+            write_npy_header(self.file_handle, self.dtype, (self.num_rows, self.num_cols))
+        self.file_handle.close()
+        self.file_handle = None
+
+        if len(self.file_segments) > 1:
+            self.pad_file_to_num_cols()
+
+    # Pads the rows written before a wider block came in, one run of rows at a time
+    def pad_file_to_num_cols(self):
+        tmp_filename = self.filename + '.tmp'
+        src = open(self.filename, 'rb')
+        dst = open(tmp_filename, 'wb')
+
+        if self.trace_format == 'npy':
+            src.seek(npy_header_size)
+            write_npy_header(dst, self.dtype, (self.num_rows, self.num_cols))
+
+        for rows, cols in self.file_segments:
+            pad_cols = self.num_cols - cols
+            for start in range(0, rows, self.flush_rows):
+                num_rows = min(self.flush_rows, rows - start)
+                if self.trace_format == 'npy':
+                    trace_block = np.frombuffer(src.read(num_rows * cols * self.dtype.itemsize), dtype=self.dtype)
+                    trace_block = trace_block.reshape((num_rows, cols))
+                    pad = np.ones((num_rows, pad_cols), dtype=self.dtype)
+                    dst.write(np.concatenate((trace_block, pad), axis=1).tobytes())
+                else:
+                    pad = b',1' * pad_cols + b'\n'
+                    for _ in range(num_rows):
+                        dst.write(src.readline().rstrip(b'\n') + pad)
+
+        src.close()
+        dst.close()
+        os.replace(tmp_filename, self.filename)
+
+    #
+    def get_num_rows(self):
+        return self.num_rows
+
+    # Cycles of the first and the last rows of the trace
+    def get_start_stop_cycles(self):
+        assert self.num_rows > 0, 'No trace has been generated yet'
+        return self.first_cycle, self.last_cycle
+
+    #
+    def is_closed(self):
+        return self.closed_flag
+
+
+# Writes a .npy version 1.0 header of npy_header_size bytes
+def write_npy_header(file_handle, dtype, shape):
+    header = "{'descr': " + repr(np.lib.format.dtype_to_descr(dtype)) + ", "
+    header += "'fortran_order': False, "
+    header += "'shape': (" + str(shape[0]) + ", " + str(shape[1]) + "), }"
+
+    header_len = npy_header_size - 10
+    header = header.ljust(header_len - 1) + '\n'
+
+    file_handle.write(b'\x93NUMPY\x01\x00')
+    file_handle.write(np.array(header_len, dtype='<u2').tobytes())
+    file_handle.write(header.encode('latin1'))
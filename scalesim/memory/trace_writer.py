@@ -0,0 +1,91 @@
+# Writes the traces on a background thread, while the simulation goes on
+# The trace sinks hand over the blocks of rows to be written, and the writes of a finished layer
+# overlap with the simulation of the next one. The blocks are written in the order they are handed over.
+# At most max_pending jobs wait to be written, after which the simulation waits for the writer,
+# so the memory held by the pending blocks stays bounded.
+#
+# The errors raised while writing are kept and raised by drain(), ie. at the end of the run.
+import queue
+import threading
+
+default_max_pending = 16
+
+
+class trace_writer:
+    def __init__(self):
+        self.max_pending = default_max_pending
+
+        self.jobs = queue.Queue(maxsize=self.max_pending)
+        self.thread = None
+
+        # The errors of the jobs, in the order they were raised
+        self.errors = []
+        self.errors_lock = threading.Lock()
+
+        self.params_set_flag = False
+
+    #
+    def set_params(self, max_pending=default_max_pending):
+        assert max_pending > 0, 'At least one job should be allowed to wait'
+        assert self.thread is None, 'The writer is already running'
+
+        self.max_pending = max_pending
+        self.jobs = queue.Queue(maxsize=self.max_pending)
+        self.params_set_flag = True
+
+    # Queues the call to func(*args), waits if max_pending jobs are waiting already
+    # The arguments should not be modified by the caller once handed over
+    def submit(self, func, *args):
+        assert self.params_set_flag, 'Parameters are not set'
+
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run_jobs, name='scalesim_trace_writer', daemon=True)
+            self.thread.start()
+
+        self.jobs.put((func, args))
+
+    #
+    def run_jobs(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                self.jobs.task_done()
+                return
+
+            func, args = job
+            try:
+                func(*args)
+            except Exception as error:
+                with self.errors_lock:
+                    self.errors.append(error)
+            finally:
+                self.jobs.task_done()
+
+    # Waits for all the jobs queued so far to finish
+    # Raises the first error of the jobs, once all of them are done
+    def drain(self):
+        if self.thread is not None:
+            self.jobs.join()
+
+        with self.errors_lock:
+            errors = self.errors
+            self.errors = []
+
+        if len(errors) > 0:
+            print('ERROR: trace_writer: ' + str(len(errors)) + ' trace writes failed')
+            for error in errors:
+                print(repr(error))
+            raise errors[0]
+
+    # Finishes the jobs and stops the thread
+    def close(self):
+        if self.thread is not None:
+            self.jobs.put(None)
+            self.thread.join()
+            self.thread = None
+
+        self.drain()
+
+    #
+    def get_num_pending(self):
+        return self.jobs.qsize()
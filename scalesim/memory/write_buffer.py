@@ -4,8 +4,11 @@ import time
 import math
 import numpy as np
 #import matplotlib.pyplot as plt
-from tqdm import tqdm
 from scalesim.memory.write_port import write_port
+from scalesim.memory.trace_arena import trace_arena
+from scalesim.dtype_utils import cycle_dtype
+from scalesim.trace_utils import write_trace
+from scalesim.band_matrix import get_valid_requests
 
 
 class write_buffer:
@@ -30,17 +33,20 @@ class write_buffer:
         self.drain_buf_end_line_id = 0
 
         # Helper data structures for faster execution
-        self.line_idx = 0
-        self.current_line = np.ones((1, 1)) * -1
-        self.max_cache_lines = 2 ** 10              # TODO: This is arbitrary, check if this can be tuned
-        self.trace_matrix_cache = np.zeros((1, 1))
+        # The requests stored since the last drain are kept as they come in,
+        # they are packed into lines of req_gen_bandwidth only when the drain starts
+        self.addr_dtype = np.int32                  # Follows the dtype of the incoming requests
+        self.pending_elems = []
+        self.num_pending_elems = 0
+        self.drain_lines = trace_arena()            # Packed lines yet to be drained
 
         # Access counts
         self.num_access = 0
+        self.num_drains = 0
 
-        # Trace matrix
-        self.trace_matrix = np.zeros((1, 1))
-        self.cycles_vec = np.zeros((1, 1))
+        # Trace matrix, the cycle at which each line is drained followed by the line
+        self.trace_matrix = trace_arena()
+        self.trace_sink = None      # When set, the drained lines are written to the sink instead
 
         # Flags
         # This variable determines where the new requests should be buffered
@@ -51,7 +57,6 @@ class write_buffer:
 
         self.trace_valid = False
         # Fixing ISSUE #10
-        self.trace_matrix_cache_empty = True
         self.trace_matrix_empty = True
 
     #
@@ -73,6 +78,10 @@ class write_buffer:
         self.drain_buf_size = self.total_size_elems - self.active_buf_size
         self.free_space = self.total_size_elems
 
+    # The trace is streamed to the sink as the lines are drained, instead of being kept in the memory
+    def set_trace_sink(self, trace_sink):
+        self.trace_sink = trace_sink
+
     #
     def reset(self):
         self.total_size_bytes = 128
@@ -87,158 +96,177 @@ class write_buffer:
         self.drain_buf_contents = []
         self.drain_end_cycle = 0
 
-        self.trace_matrix = np.zeros((1, 1))
+        self.trace_matrix = trace_arena()
+        self.trace_sink = None
+        self.pending_elems = []
+        self.num_pending_elems = 0
+        self.drain_lines = trace_arena()
 
         self.num_access = 0
+        self.num_drains = 0
         self.state = 0
 
         self.trace_valid = False
         # Fixing ISSUE #10
-        self.trace_matrix_cache_empty = True
         self.trace_matrix_empty = True
 
-    #
-    def store_to_trace_mat_cache(self, elem):
-        if elem == -1:
+    # Stores the valid requests in the order of service
+    def store_to_trace_mat_cache(self, elems):
+        if elems.shape[0] == 0:
             return
 
-        if self.current_line.shape == (1,1):    # This line is empty
-            self.current_line = np.ones((1, self.req_gen_bandwidth)) * -1
+        self.pending_elems.append(elems)
+        self.num_pending_elems += elems.shape[0]
+        self.free_space -= elems.shape[0]
 
-        self.current_line[0, self.line_idx] = elem
-        self.line_idx += 1
-        self.free_space -= 1
+    # Packs the stored requests into lines and appends them to the trace matrix
+    # The last line is padded with -1 if the requests do not fill it
+    def append_to_trace_mat(self):
+        if self.num_pending_elems == 0:
+            return
 
-        if not self.line_idx < self.req_gen_bandwidth:
-            # Store to the cache matrix
-            # Fixing ISSUE #10
-            # if self.trace_matrix_cache.shape == (1,1):
-            if self.trace_matrix_cache_empty:
-                self.trace_matrix_cache = self.current_line
-                self.trace_matrix_cache_empty = False
-            else:
-                self.trace_matrix_cache = np.concatenate((self.trace_matrix_cache, self.current_line), axis=0)
+        num_lines = int(math.ceil(self.num_pending_elems / self.req_gen_bandwidth))
+        new_lines = np.full(num_lines * self.req_gen_bandwidth, -1, dtype=self.addr_dtype)
+        new_lines[:self.num_pending_elems] = np.concatenate(self.pending_elems)
+        new_lines = new_lines.reshape((num_lines, self.req_gen_bandwidth))
 
-            self.current_line = np.ones((1,1)) * -1
-            self.line_idx = 0
+        self.pending_elems = []
+        self.num_pending_elems = 0
 
-            if not self.trace_matrix_cache.shape[0] < self.max_cache_lines:
-                self.append_to_trace_mat()
-
-    #
-    def append_to_trace_mat(self, force=False):
-        if force:   # This forces the contents for self.current_line and self.trace_matrix cache to be dumped
-            if not self.line_idx == 0:
-                #if self.trace_matrix_cache.shape == (1,1):
-                if self.trace_matrix_cache_empty:
-                    self.trace_matrix_cache = self.current_line
-                    self.trace_matrix_cache_empty = False
-                else:
-                    self.trace_matrix_cache = np.concatenate((self.trace_matrix_cache, self.current_line), axis=0)
-
-                self.current_line = np.ones((1,1)) * -1
-                self.line_idx = 0
-        # Fixing ISSUE #10
-        # if self.trace_matrix_cache.shape == (1,1):
-        if self.trace_matrix_cache_empty:
-            return
-
-        #if self.trace_matrix.shape == (1,1):
         if self.trace_matrix_empty:
-            self.trace_matrix = self.trace_matrix_cache
+            self.drain_lines.set_params(num_cols=self.req_gen_bandwidth, dtype=self.addr_dtype, pad_value=-1)
             self.drain_buf_start_line_id = 0
             self.trace_matrix_empty = False
-        else:
-            self.trace_matrix = np.concatenate((self.trace_matrix, self.trace_matrix_cache), axis=0)
-
-        self.trace_matrix_cache = np.zeros((1,1))
-        # Fixing ISSUE #10
-        self.trace_matrix_cache_empty = True
 
-    #
-    def service_writes(self, incoming_requests_arr_np, incoming_cycles_arr_np):
-        assert incoming_cycles_arr_np.shape[0] == incoming_requests_arr_np.shape[0], 'Cycles and requests do not match'
-        out_cycles_arr = []
-        offset = 0
+        self.drain_lines.append(new_lines)
 
-        DEBUG_num_drains = 0
-        DEBUG_append_to_trace_times = []
+    # Index of the first line of requests at which the buffer either stalls or starts draining
+    # Returns the number of lines if neither happens
+    # This does not change the state of the buffer
+    def get_first_event_line(self, incoming_requests_arr_np, incoming_cycles_arr_np):
+        num_lines = incoming_requests_arr_np.shape[0]
 
-        for i in tqdm(range(incoming_requests_arr_np.shape[0]), disable=True):
-            row = incoming_requests_arr_np[i]
-            cycle = incoming_cycles_arr_np[i]
-            current_cycle = cycle[0] + offset
+        # The requests are an array or a band matrix, only the valid requests take space
+        elems, elem_lines = get_valid_requests(incoming_requests_arr_np)
 
-            for elem in row:
-                # Pay no attention to empty requests
-                if elem == -1:
-                    continue
+        # Free space left after each request is stored, in the order of service
+        free_space_after = self.free_space - np.arange(1, elems.shape[0] + 1)
 
-                self.store_to_trace_mat_cache(elem)
+        draining = incoming_cycles_arr_np.reshape(num_lines)[elem_lines] < self.drain_end_cycle
+        stalls = np.logical_and(draining, free_space_after <= 0)
+        drains = np.logical_and(np.logical_not(draining),
+                                free_space_after < (self.total_size_elems - self.drain_buf_size))
 
-                if current_cycle < self.drain_end_cycle:
-                    if not self.free_space > 0:
-                        offset += max(self.drain_end_cycle - current_cycle, 0)
-                        current_cycle = self.drain_end_cycle
+        events = np.flatnonzero(np.logical_or(stalls, drains))
 
-                elif self.free_space < (self.total_size_elems - self.drain_buf_size):
-                    self.append_to_trace_mat(force=True)
-                    self.drain_end_cycle = self.empty_drain_buf(empty_start_cycle=current_cycle)
+        if events.shape[0] == 0:
+            return num_lines
 
-            out_cycles_arr.append(current_cycle)
+        return int(elem_lines[events[0]])
 
+    # The requests are serviced in bulk between the events, ie. the requests at which the buffer
+    # stalls for the ongoing drain or starts a new drain. Only the events are stepped through one by one.
+    def service_writes(self, incoming_requests_arr_np, incoming_cycles_arr_np):
+        assert incoming_cycles_arr_np.shape[0] == incoming_requests_arr_np.shape[0], 'Cycles and requests do not match'
+        self.addr_dtype = incoming_requests_arr_np.dtype
         num_lines = incoming_requests_arr_np.shape[0]
-        out_cycles_arr_np = np.asarray(out_cycles_arr).reshape((num_lines, 1))
 
-        #print('DEBUG: Num Drains = ' + str(DEBUG_num_drains))
-        #print('DEBUG: Num appeneds = ' + str(len(DEBUG_append_to_trace_times)))
-        #plt.plot(DEBUG_append_to_trace_times)
-        #plt.show()
+        # The valid requests in the order of service, with the cycle of the line each comes from
+        elems, elem_lines = get_valid_requests(incoming_requests_arr_np)
+        elem_cycles = incoming_cycles_arr_np.reshape(num_lines)[elem_lines]
+        num_elems = elems.shape[0]
+
+        # Stall cycles added at each line, these delay all the lines that follow
+        line_stalls = np.zeros(num_lines, dtype=cycle_dtype)
+        offset = 0
+
+        # Every request after the free space runs out is an event,
+        # the events are looked for in windows which grow while there are none
+        min_window = self.drain_buf_size + 1
+        window = min_window
+        start = 0
+        while start < num_elems:
+            end = min(start + window, start + max(self.free_space, 1), num_elems)
+
+            free_space_after = self.free_space - np.arange(1, end - start + 1)
+            draining = (elem_cycles[start:end] + offset) < self.drain_end_cycle
+            stalls = np.logical_and(draining, free_space_after <= 0)
+            drains = np.logical_and(np.logical_not(draining),
+                                    free_space_after < (self.total_size_elems - self.drain_buf_size))
+            events = np.flatnonzero(np.logical_or(stalls, drains))
+
+            if events.shape[0] == 0:
+                self.store_to_trace_mat_cache(elems[start:end])
+                start = end
+                window *= 2
+                continue
+
+            event_idx = start + int(events[0])
+            self.store_to_trace_mat_cache(elems[start:event_idx + 1])
+
+            current_cycle = elem_cycles[event_idx] + offset
+            if current_cycle < self.drain_end_cycle:
+                stall = self.drain_end_cycle - current_cycle
+                line_stalls[elem_lines[event_idx]] += stall
+                offset += stall
+            else:
+                self.append_to_trace_mat()
+                self.drain_end_cycle = self.empty_drain_buf(empty_start_cycle=current_cycle)
+
+            start = event_idx + 1
+            window = min_window
 
-        return out_cycles_arr_np
+        out_cycles_arr_np = incoming_cycles_arr_np.reshape((num_lines, 1)) \
+                            + np.cumsum(line_stalls).reshape((num_lines, 1))
+
+        return out_cycles_arr_np.astype(cycle_dtype, copy=False)
 
     #
     def empty_drain_buf(self, empty_start_cycle=0):
 
         lines_to_fill_dbuf = int(math.ceil(self.drain_buf_size / self.req_gen_bandwidth))
+        self.num_drains += 1
         self.drain_buf_end_line_id = self.drain_buf_start_line_id + lines_to_fill_dbuf
-        self.drain_buf_end_line_id = min(self.drain_buf_end_line_id, self.trace_matrix.shape[0])
+        self.drain_buf_end_line_id = min(self.drain_buf_end_line_id, self.drain_lines.get_num_rows())
 
-        requests_arr_np = self.trace_matrix[self.drain_buf_start_line_id: self.drain_buf_end_line_id, :]
+        requests_arr_np = self.drain_lines.get_view()[self.drain_buf_start_line_id: self.drain_buf_end_line_id, :]
         num_lines = requests_arr_np.shape[0]
 
         data_sz_to_drain = num_lines * requests_arr_np.shape[1]
         # Adjust for -1
-        for elem in requests_arr_np[-1,:]:
-            if elem == -1:
-                data_sz_to_drain -= 1
+        data_sz_to_drain -= int(np.count_nonzero(requests_arr_np[-1, :] == -1))
         self.num_access += data_sz_to_drain
 
-        cycles_arr = [x+empty_start_cycle for x in range(num_lines)]
-        cycles_arr_np = np.asarray(cycles_arr).reshape((num_lines, 1))
+        cycles_arr_np = np.arange(num_lines, dtype=cycle_dtype).reshape((num_lines, 1)) + empty_start_cycle
         serviced_cycles_arr = self.backing_buffer.service_writes(requests_arr_np, cycles_arr_np)
 
-        # Assign the cycles vector which will be used to generate the complete trace
-        if not self.trace_valid:
-            self.cycles_vec = serviced_cycles_arr
-            self.trace_valid = True
+        # Add the drained lines to the complete trace
+        this_drain_trace = np.concatenate((serviced_cycles_arr, requests_arr_np), axis=1)
+        if self.trace_sink is not None:
+            self.trace_sink.append(this_drain_trace)
         else:
-            self.cycles_vec = np.concatenate((self.cycles_vec, serviced_cycles_arr), axis=0)
+            if not self.trace_valid:
+                self.trace_matrix.set_params(num_cols=this_drain_trace.shape[1])
+            self.trace_matrix.append(this_drain_trace)
+        self.trace_valid = True
 
         service_end_cycle = serviced_cycles_arr[-1][0]
         self.free_space += data_sz_to_drain
 
-        self.drain_buf_start_line_id = self.drain_buf_end_line_id
+        # The drained lines are in the trace already, only the lines yet to be drained are kept
+        self.drain_lines.discard_rows(self.drain_buf_end_line_id)
+        self.drain_buf_start_line_id = 0
+
         return service_end_cycle
 
     #
     def empty_all_buffers(self, cycle):
-        self.append_to_trace_mat(force=True)
+        self.append_to_trace_mat()
 
         if self.trace_matrix_empty:
            return
 
-        while self.drain_buf_start_line_id < self.trace_matrix.shape[0]:
+        while not self.drain_lines.is_empty():
             self.drain_end_cycle = self.empty_drain_buf(empty_start_cycle=cycle)
             cycle = self.drain_end_cycle + 1
 
@@ -248,9 +276,8 @@ class write_buffer:
             print('No trace has been generated yet')
             return
 
-        trace_matrix = np.concatenate((self.cycles_vec, self.trace_matrix), axis=1)
-
-        return trace_matrix
+        assert self.trace_sink is None, 'The trace is streamed to the disk'
+        return self.trace_matrix.get_view()
 
     #
     def get_free_space(self):
@@ -261,18 +288,26 @@ class write_buffer:
         assert self.trace_valid, 'Traces not ready yet'
         return self.num_access
 
+    #
+    def get_num_drains(self):
+        return self.num_drains
+
     #
     def get_external_access_start_stop_cycles(self):
         assert self.trace_valid, 'Traces not ready yet'
-        start_cycle = self.cycles_vec[0][0]
-        end_cycle = self.cycles_vec[-1][0]
+        if self.trace_sink is not None:
+            return self.trace_sink.get_start_stop_cycles()
+
+        trace_matrix = self.trace_matrix.get_view()
+        start_cycle = trace_matrix[0][0]
+        end_cycle = trace_matrix[-1][0]
 
         return start_cycle, end_cycle
 
     #
-    def print_trace(self, filename):
+    def print_trace(self, filename, trace_format='csv'):
         if not self.trace_valid:
             print('No trace has been generated yet')
             return
         trace_matrix = self.get_trace_matrix()
-        np.savetxt(filename, trace_matrix, fmt='%s', delimiter=",")
+        write_trace(filename, trace_matrix, trace_format=trace_format)
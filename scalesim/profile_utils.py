@@ -0,0 +1,98 @@
+# Wall time spent in the stages of a layer run, used for the PROFILE_REPORT.csv
+# The stages can be nested, the time of a stage excludes the time of the stages started within it.
+# Hence the stage times of a layer add up to nearly all of its total run time.
+# The profiler does nothing unless it is enabled, so it can be called unconditionally.
+import time
+
+# Stages of a layer run, in the order of the columns of the profile report
+profile_stages = ['operand_matrices', 'prefetch_matrices', 'demand_matrices', 'memory_setup',
+                  'memory_service', 'trace_writing', 'result_cache']
+
+# Columns of the profile report after the layer id
+profile_report_columns = ['Total Time (s)', 'Operand Matrix Time (s)', 'Prefetch Matrix Time (s)',
+                          'Demand Matrix Time (s)', 'Memory Setup Time (s)', 'Memory Service Time (s)',
+                          'Trace Write Time (s)', 'Result Cache Time (s)',
+                          'Lines Serviced', 'IFMAP Prefetches', 'Filter Prefetches', 'OFMAP Drains',
+                          'Total Cycles', 'Simulated Cycles per Second']
+
+
+class stage_profiler:
+    def __init__(self):
+        self.enabled = False
+
+        self.stage_times = {}
+        for stage in profile_stages:
+            self.stage_times[stage] = 0.0
+
+        # Running stages, each as [name, start time, time of the stages nested within]
+        self.stage_stack = []
+
+        self.total_start_time = 0
+        self.total_time = 0.0
+
+    #
+    def enable(self):
+        self.enabled = True
+
+    #
+    def is_enabled(self):
+        return self.enabled
+
+    #
+    def start_total(self):
+        if not self.enabled:
+            return
+        self.total_start_time = time.perf_counter()
+
+    #
+    def stop_total(self):
+        if not self.enabled:
+            return
+        self.total_time += time.perf_counter() - self.total_start_time
+
+    #
+    def start(self, stage):
+        if not self.enabled:
+            return
+        assert stage in self.stage_times, 'Unknown stage: ' + str(stage)
+        self.stage_stack.append([stage, time.perf_counter(), 0.0])
+
+    #
+    def stop(self, stage):
+        if not self.enabled:
+            return
+        assert len(self.stage_stack) > 0 and self.stage_stack[-1][0] == stage, 'Stage ' + str(stage) + ' is not running'
+
+        _, start_time, nested_time = self.stage_stack.pop()
+        elapsed = time.perf_counter() - start_time
+        self.stage_times[stage] += elapsed - nested_time
+
+        if len(self.stage_stack) > 0:
+            self.stage_stack[-1][2] += elapsed
+
+    # Times each step of the iterator as the stage, eg. the demand matrices generated fold by fold
+    def profile_iterator(self, stage, iterator):
+        if not self.enabled:
+            return iterator
+        return self.timed_iterator(stage, iterator)
+
+    #
+    def timed_iterator(self, stage, iterator):
+        iterator = iter(iterator)
+        while True:
+            self.start(stage)
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.stop(stage)
+                return
+            self.stop(stage)
+            yield item
+
+    #
+    def get_stage_time(self, stage):
+        return self.stage_times[stage]
+
+    #
+    def get_total_time(self):
+        return self.total_time
@@ -1,6 +1,9 @@
 import argparse
 
 from scalesim.scale_sim import scalesim
+from scalesim.matrix_cache import default_max_size_mb as default_matrix_cache_mb
+from scalesim.matrix_spill import default_threshold_mb as default_spill_threshold_mb
+from scalesim.memory.trace_writer import default_max_pending as default_trace_queue_depth
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -20,12 +23,64 @@ if __name__ == '__main__':
                         default="conv",
                         help="Type of input topology, gemm: MNK, conv: conv"
                         )
+    parser.add_argument('-w', metavar='num workers', type=int,
+                        default=1,
+                        help="Number of processes to simulate the layers in parallel"
+                        )
+    parser.add_argument('-f', metavar='fidelity', type=str,
+                        default="detailed",
+                        help="Simulation fidelity, detailed: cycle accurate, analytic: closed form estimate"
+                        )
+    parser.add_argument('-o', metavar='trace format', type=str,
+                        default="csv",
+                        help="Format of the traces, csv: text, npy: binary numpy arrays"
+                        )
+    parser.add_argument('--no-cache', action='store_true',
+                        help="Simulate all the layers, instead of reusing the cached results of the same layers"
+                        )
+    parser.add_argument('--profile', action='store_true',
+                        help="Time the stages of each layer and write them to PROFILE_REPORT.csv"
+                        )
+    parser.add_argument('--matrix-cache-mb', metavar='size MB', type=int,
+                        default=default_matrix_cache_mb,
+                        help="Memory for the matrices shared by the layers with the same shape, 0: no sharing"
+                        )
+    parser.add_argument('--lazy-operands', action='store_true',
+                        help="Compute the operand matrices tile by tile as the folds need them, for the layers too large for the memory"
+                        )
+    parser.add_argument('--spill-dir', metavar='spill dir', type=str,
+                        default="",
+                        help="Scratch directory for the matrices too large for the memory, the system temp dir by default"
+                        )
+    parser.add_argument('--spill-threshold-mb', metavar='size MB', type=int,
+                        default=default_spill_threshold_mb,
+                        help="Matrices larger than this are kept in files in the spill dir, 0: never"
+                        )
+    parser.add_argument('--trace-queue-depth', metavar='blocks', type=int,
+                        default=default_trace_queue_depth,
+                        help="Trace blocks which can wait to be written in the background, 0: write the traces in line"
+                        )
+    parser.add_argument('--cache-dir', metavar='cache dir', type=str,
+                        default="",
+                        help="Path to the layer result cache, ~/.cache/scalesim by default"
+                        )
 
     args = parser.parse_args()
     topology = args.t
     config = args.c
     logpath = args.p
     inp_type = args.i
+    num_workers = args.w
+    fidelity = args.f
+    trace_format = args.o
+    use_cache = not args.no_cache
+    cache_dir = args.cache_dir
+    profile = args.profile
+    matrix_cache_mb = args.matrix_cache_mb
+    lazy_operands = args.lazy_operands
+    spill_dir = args.spill_dir
+    spill_threshold_mb = args.spill_threshold_mb
+    trace_queue_depth = args.trace_queue_depth
 
     gemm_input = False
     if inp_type == 'gemm':
@@ -34,6 +89,17 @@ if __name__ == '__main__':
     s = scalesim(save_disk_space=True, verbose=True,
                  config=config,
                  topology=topology,
-                 input_type_gemm=gemm_input
+                 input_type_gemm=gemm_input,
+                 num_workers=num_workers,
+                 fidelity=fidelity,
+                 trace_format=trace_format,
+                 use_cache=use_cache,
+                 cache_dir=cache_dir,
+                 profile=profile,
+                 matrix_cache_mb=matrix_cache_mb,
+                 lazy_operands=lazy_operands,
+                 spill_dir=spill_dir,
+                 spill_threshold_mb=spill_threshold_mb,
+                 trace_queue_depth=trace_queue_depth
                  )
     s.run_scale(top_path=logpath)
@@ -2,6 +2,10 @@ import os
 from scalesim.scale_config import scale_config
 from scalesim.topology_utils import topologies
 from scalesim.simulator import simulator as sim
+from scalesim.layer_cache import layer_cache, default_max_size_mb
+from scalesim.matrix_cache import default_max_size_mb as default_matrix_cache_mb
+from scalesim.matrix_spill import default_threshold_mb as default_spill_threshold_mb
+from scalesim.memory.trace_writer import default_max_pending as default_trace_queue_depth
 
 
 class scalesim:
@@ -10,7 +14,20 @@ class scalesim:
                  verbose=True,
                  config='',
                  topology='',
-                 input_type_gemm=False):
+                 input_type_gemm=False,
+                 num_workers=1,
+                 fidelity='detailed',
+                 trace_format='csv',
+                 use_cache=False,
+                 cache_dir='',
+                 cache_size_mb=default_max_size_mb,
+                 cache_traces=False,
+                 profile=False,
+                 matrix_cache_mb=default_matrix_cache_mb,
+                 lazy_operands=False,
+                 spill_dir='',
+                 spill_threshold_mb=default_spill_threshold_mb,
+                 trace_queue_depth=default_trace_queue_depth):
 
         # Data structures
         self.config = scale_config()
@@ -28,7 +45,24 @@ class scalesim:
         self.read_gemm_inputs = input_type_gemm
         self.save_space = save_disk_space
         self.verbose_flag = verbose
+        self.num_workers = num_workers
+        self.fidelity = fidelity
+        self.trace_format = trace_format
+        self.profile = profile
+        self.matrix_cache_mb = matrix_cache_mb
+        self.lazy_operands = lazy_operands
+        self.spill_dir = spill_dir
+        self.spill_threshold_mb = spill_threshold_mb
+        self.trace_queue_depth = trace_queue_depth
         self.run_done_flag = False
+
+        # Results of the layers simulated in the earlier runs, see layer_cache
+        self.result_cache = None
+        if use_cache:
+            self.result_cache = layer_cache()
+            self.result_cache.set_params(cache_dir=cache_dir,
+                                         max_size_mb=cache_size_mb,
+                                         cache_traces=cache_traces)
         self.logs_generated_flag = False
 
         self.set_params(config_filename=config, topology_filename=topology)
@@ -81,7 +115,17 @@ class scalesim:
             topo_obj=self.topo,
             top_path=self.top_path,
             verbosity=self.verbose_flag,
-            save_trace=save_trace
+            save_trace=save_trace,
+            num_workers=self.num_workers,
+            fidelity=self.fidelity,
+            trace_format=self.trace_format,
+            result_cache=self.result_cache,
+            profile=self.profile,
+            matrix_cache_mb=self.matrix_cache_mb,
+            lazy_operands=self.lazy_operands,
+            spill_dir=self.spill_dir,
+            spill_threshold_mb=self.spill_threshold_mb,
+            trace_queue_depth=self.trace_queue_depth
         )
         self.run_once()
 
@@ -134,6 +178,8 @@ class scalesim:
         print("SRAM OFMAP (kB): \t" + str(ofmap_kb))
         print("Dataflow: \t" + df_string)
         print("CSV file path: \t" + self.config.get_topology_path())
+        if self.fidelity == 'analytic':
+            print('Working in ANALYTIC mode. The reports are estimates.')
 
         if self.config.use_user_dram_bandwidth():
             print("Bandwidth: \t" + self.config.get_bandwidths_as_string())
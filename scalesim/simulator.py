@@ -1,8 +1,17 @@
 import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 
 from scalesim.scale_config import scale_config as cfg
 from scalesim.topology_utils import topologies as topo
 from scalesim.single_layer_sim import single_layer_sim as layer_sim
+from scalesim.analytic_layer_sim import analytic_layer_sim
+from scalesim.trace_utils import trace_formats
+from scalesim.profile_utils import profile_report_columns
+from scalesim.matrix_cache import matrix_cache, get_process_matrix_cache
+from scalesim.matrix_cache import default_max_size_mb as default_matrix_cache_mb
+from scalesim.matrix_spill import matrix_spill, default_threshold_mb as default_spill_threshold_mb
+from scalesim.memory.trace_writer import trace_writer, default_max_pending as default_trace_queue_depth
 
 
 class simulator:
@@ -13,11 +22,32 @@ class simulator:
         self.top_path = "./"
         self.verbose = True
         self.save_trace = True
+        self.trace_format = 'csv'
 
         self.num_layers = 0
 
+        self.num_workers = 1
+        self.fidelity = 'detailed'
+        self.result_cache = None    # layer_cache object, the layers are always simulated if not set
+        self.profile = False
+        self.matrix_cache_mb = default_matrix_cache_mb    # The matrices are not shared between the layers if 0
+        self.lazy_operands = False      # Operand tiles computed on demand instead of the full matrices
+
+        # The matrices larger than the threshold are kept in files in spill_dir, never if the threshold is 0
+        self.spill_dir = ''
+        self.spill_threshold_mb = default_spill_threshold_mb
+
+        # Trace blocks which can wait to be written in the background, the traces are written in line if 0
+        self.trace_queue_depth = default_trace_queue_depth
+
         self.single_layer_sim_object_list = []
 
+        # Report items gathered per layer, in layer order
+        self.compute_report_items_list = []
+        self.bandwidth_report_items_list = []
+        self.detail_report_items_list = []
+        self.profile_report_items_list = []
+
         self.params_set_flag = False
         self.all_layer_run_done = False
 
@@ -27,7 +57,17 @@ class simulator:
                    topo_obj=topo(),
                    top_path="./",
                    verbosity=True,
-                   save_trace=True
+                   save_trace=True,
+                   num_workers=1,
+                   fidelity='detailed',
+                   trace_format='csv',
+                   result_cache=None,
+                   profile=False,
+                   matrix_cache_mb=default_matrix_cache_mb,
+                   lazy_operands=False,
+                   spill_dir='',
+                   spill_threshold_mb=default_spill_threshold_mb,
+                   trace_queue_depth=default_trace_queue_depth
                    ):
 
         self.conf = config_obj
@@ -37,6 +77,40 @@ class simulator:
         self.verbose = verbosity
         self.save_trace = save_trace
 
+        assert trace_format in trace_formats, 'Trace format should be one of ' + ', '.join(trace_formats)
+        self.trace_format = trace_format
+
+        assert num_workers > 0, 'Number of workers should be at least 1'
+        self.num_workers = num_workers
+
+        assert fidelity in ['detailed', 'analytic'], 'Fidelity should be detailed or analytic'
+        self.fidelity = fidelity
+
+        # The analytic mode does not generate any traces
+        # The estimates are quick to compute, the results are not cached either
+        # The stages profiled are those of the detailed simulation
+        # There are no matrices to share, spill or compute lazily
+        if self.fidelity == 'analytic':
+            self.save_trace = False
+            result_cache = None
+            profile = False
+            matrix_cache_mb = 0
+            spill_threshold_mb = 0
+            lazy_operands = False
+        self.result_cache = result_cache
+        self.profile = profile
+
+        assert matrix_cache_mb >= 0, 'Matrix cache size cannot be negative'
+        self.matrix_cache_mb = matrix_cache_mb
+        self.lazy_operands = lazy_operands
+
+        assert spill_threshold_mb >= 0, 'Spill threshold cannot be negative'
+        self.spill_dir = spill_dir
+        self.spill_threshold_mb = spill_threshold_mb
+
+        assert trace_queue_depth >= 0, 'Trace queue depth cannot be negative'
+        self.trace_queue_depth = trace_queue_depth
+
         # Calculate inferrable parameters here
         self.num_layers = self.topo.get_num_layers()
 
@@ -46,65 +120,145 @@ class simulator:
     def run(self):
         assert self.params_set_flag, 'Simulator parameters are not set'
 
+        if not os.path.isdir(self.top_path):
+            os.mkdir(self.top_path)
+
+        report_path = self.top_path + '/' + self.conf.get_run_name()
+
+        if not os.path.isdir(report_path):
+            os.mkdir(report_path)
+
+        self.top_path = report_path
+
+        self.compute_report_items_list = []
+        self.bandwidth_report_items_list = []
+        self.detail_report_items_list = []
+        self.profile_report_items_list = []
+
+        if self.num_workers > 1:
+            self.run_parallel()
+        else:
+            self.run_serial()
+
+        self.all_layer_run_done = True
+
+        self.generate_reports()
+
+    #
+    def run_serial(self):
+        # The layers with the same shape share their matrices within the run
+        layer_matrix_cache = None
+        if self.matrix_cache_mb > 0:
+            layer_matrix_cache = matrix_cache()
+            layer_matrix_cache.set_params(max_size_mb=self.matrix_cache_mb)
+
+        spill = get_matrix_spill(self.spill_dir, self.spill_threshold_mb)
+
+        # The traces of a layer are written while the next layers run, the writes are finished at the end of the run
+        writer = None
+        if self.save_trace:
+            writer = get_trace_writer(self.trace_queue_depth)
+
         # 1. Create the layer runners for each layer
         for i in range(self.num_layers):
-            this_layer_sim = layer_sim()
+            this_layer_sim = get_layer_sim(self.fidelity)
             this_layer_sim.set_params(layer_id=i,
                                  config_obj=self.conf,
                                  topology_obj=self.topo,
-                                 verbose=self.verbose)
+                                 verbose=self.verbose,
+                                 save_trace=self.save_trace)
 
-            self.single_layer_sim_object_list.append(this_layer_sim)
+            # The traces are written while the layer runs
+            if self.save_trace:
+                this_layer_sim.stream_traces(self.top_path, trace_format=self.trace_format)
 
-        if not os.path.isdir(self.top_path):
-            os.mkdir(self.top_path)
+            if writer is not None:
+                this_layer_sim.set_trace_writer(writer)
 
-        report_path = self.top_path + '/' + self.conf.get_run_name()
+            if self.result_cache is not None:
+                this_layer_sim.set_result_cache(self.result_cache)
 
-        if not os.path.isdir(report_path):
-            os.mkdir(report_path)
+            if layer_matrix_cache is not None:
+                this_layer_sim.set_matrix_cache(layer_matrix_cache)
 
-        self.top_path = report_path
+            if self.lazy_operands:
+                this_layer_sim.enable_lazy_operands()
+
+            if spill is not None:
+                this_layer_sim.set_matrix_spill(spill)
+
+            if self.profile:
+                this_layer_sim.enable_profiling()
+
+            self.single_layer_sim_object_list.append(this_layer_sim)
 
         # 2. Run each layer
-        # TODO: This is parallelizable
         for single_layer_obj in self.single_layer_sim_object_list:
 
+            layer_id = single_layer_obj.get_layer_id()
             if self.verbose:
-                layer_id = single_layer_obj.get_layer_id()
                 print('\nRunning Layer ' + str(layer_id))
 
             single_layer_obj.run()
 
-            if self.verbose:
-                comp_items = single_layer_obj.get_compute_report_items()
-                comp_cycles = comp_items[0]
-                stall_cycles = comp_items[1]
-                util = comp_items[2]
-                mapping_eff = comp_items[3]
-                print('Compute cycles: ' + str(comp_cycles))
-                print('Stall cycles: ' + str(stall_cycles))
-                print('Overall utilization: ' + "{:.2f}".format(util) +'%')
-                print('Mapping efficiency: ' + "{:.2f}".format(mapping_eff) +'%')
-
-                avg_bw_items = single_layer_obj.get_bandwidth_report_items()
-                avg_ifmap_bw = avg_bw_items[3]
-                avg_filter_bw = avg_bw_items[4]
-                avg_ofmap_bw = avg_bw_items[5]
-                print('Average IFMAP DRAM BW: ' + "{:.3f}".format(avg_ifmap_bw) + ' words/cycle')
-                print('Average Filter DRAM BW: ' + "{:.3f}".format(avg_filter_bw) + ' words/cycle')
-                print('Average OFMAP DRAM BW: ' + "{:.3f}".format(avg_ofmap_bw) + ' words/cycle')
+            comp_items = single_layer_obj.get_compute_report_items()
+            bw_items = single_layer_obj.get_bandwidth_report_items()
+            detail_items = single_layer_obj.get_detail_report_items()
 
-            if self.save_trace:
-                if self.verbose:
-                    print('Saving traces: ', end='')
-                single_layer_obj.save_traces(self.top_path)
-                if self.verbose:
-                    print('Done!')
+            self.compute_report_items_list.append(comp_items)
+            self.bandwidth_report_items_list.append(bw_items)
+            self.detail_report_items_list.append(detail_items)
 
-        self.all_layer_run_done = True
+            if self.profile:
+                self.profile_report_items_list.append(single_layer_obj.get_profile_report_items())
 
-        self.generate_reports()
+            if self.verbose:
+                print_layer_summary(comp_items, bw_items)
+
+        # The errors in writing the traces, if any, are raised here
+        if writer is not None:
+            if self.verbose:
+                print('\nWaiting for the traces to be written')
+            writer.close()
+
+    # The layers are independent of each other, hence they are farmed out to a pool of processes
+    # Only the report items are sent back, the traces are written by the worker running the layer
+    # Each worker keeps its own matrix cache, shared by the layers it runs
+    def run_parallel(self):
+        layer_runner = partial(run_single_layer,
+                               config_obj=self.conf,
+                               topo_obj=self.topo,
+                               top_path=self.top_path,
+                               save_trace=self.save_trace,
+                               fidelity=self.fidelity,
+                               trace_format=self.trace_format,
+                               result_cache=self.result_cache,
+                               profile=self.profile,
+                               matrix_cache_mb=self.matrix_cache_mb,
+                               lazy_operands=self.lazy_operands,
+                               spill_dir=self.spill_dir,
+                               spill_threshold_mb=self.spill_threshold_mb,
+                               trace_queue_depth=self.trace_queue_depth)
+
+        if self.verbose:
+            print('\nRunning ' + str(self.num_layers) + ' layers on '
+                  + str(self.num_workers) + ' workers')
+
+        with ProcessPoolExecutor(max_workers=self.num_workers) as executor:
+            # map() hands back the results in the order of the layer ids
+            for layer_id, report_items in enumerate(executor.map(layer_runner, range(self.num_layers))):
+                comp_items, bw_items, detail_items, profile_items = report_items
+
+                self.compute_report_items_list.append(comp_items)
+                self.bandwidth_report_items_list.append(bw_items)
+                self.detail_report_items_list.append(detail_items)
+
+                if self.profile:
+                    self.profile_report_items_list.append(profile_items)
+
+                if self.verbose:
+                    print('\nLayer ' + str(layer_id))
+                    print_layer_summary(comp_items, bw_items)
 
     #
     def generate_reports(self):
@@ -132,21 +286,20 @@ class simulator:
         header += 'DRAM OFMAP Start Cycle, DRAM OFMAP Stop Cycle, DRAM OFMAP Writes,\n'
         detail_report.write(header)
 
-        for lid in range(len(self.single_layer_sim_object_list)):
-            single_layer_obj = self.single_layer_sim_object_list[lid]
-            compute_report_items_this_layer = single_layer_obj.get_compute_report_items()
+        for lid in range(len(self.compute_report_items_list)):
+            compute_report_items_this_layer = self.compute_report_items_list[lid]
             log = str(lid) +', '
             log += ', '.join([str(x) for x in compute_report_items_this_layer])
             log += ',\n'
             compute_report.write(log)
 
-            bandwidth_report_items_this_layer = single_layer_obj.get_bandwidth_report_items()
+            bandwidth_report_items_this_layer = self.bandwidth_report_items_list[lid]
             log = str(lid) + ', '
             log += ', '.join([str(x) for x in bandwidth_report_items_this_layer])
             log += ',\n'
             bandwidth_report.write(log)
 
-            detail_report_items_this_layer = single_layer_obj.get_detail_report_items()
+            detail_report_items_this_layer = self.detail_report_items_list[lid]
             log = str(lid) + ', '
             log += ', '.join([str(x) for x in detail_report_items_this_layer])
             log += ',\n'
@@ -156,16 +309,130 @@ class simulator:
         bandwidth_report.close()
         detail_report.close()
 
+        if self.profile:
+            self.generate_profile_report()
+
+    # Wall time of the stages of each layer, with the events in the memory system
+    def generate_profile_report(self):
+        profile_report_name = self.top_path + '/PROFILE_REPORT.csv'
+        profile_report = open(profile_report_name, 'w')
+        header = 'LayerID, ' + ', '.join(profile_report_columns) + ',\n'
+        profile_report.write(header)
+
+        for lid in range(len(self.profile_report_items_list)):
+            log = str(lid) + ', '
+            log += ', '.join([str(x) for x in self.profile_report_items_list[lid]])
+            log += ',\n'
+            profile_report.write(log)
+
+        profile_report.close()
+
     #
     def get_total_cycles(self):
         assert self.all_layer_run_done, 'Layer runs are not done yet'
 
         total_cycles = 0
-        for layer_obj in self.single_layer_sim_object_list:
-            cycles_this_layer = int(layer_obj.get_compute_report_items[0])
+        for comp_items in self.compute_report_items_list:
+            cycles_this_layer = int(comp_items[0])
             total_cycles += cycles_this_layer
 
         return total_cycles
 
 
+# Runs one layer end to end, this is the unit of work for the process pool
+def run_single_layer(layer_id, config_obj, topo_obj, top_path, save_trace, fidelity='detailed',
+                     trace_format='csv', result_cache=None, profile=False, matrix_cache_mb=0,
+                     lazy_operands=False, spill_dir='', spill_threshold_mb=0, trace_queue_depth=0):
+    this_layer_sim = get_layer_sim(fidelity)
+    this_layer_sim.set_params(layer_id=layer_id,
+                              config_obj=config_obj,
+                              topology_obj=topo_obj,
+                              verbose=False,
+                              save_trace=save_trace)
+
+    # The traces are written while the layer runs
+    # The writes overlap with the rest of the layer, these are finished before the layer returns
+    writer = None
+    if save_trace:
+        this_layer_sim.stream_traces(top_path, trace_format=trace_format)
+        writer = get_trace_writer(trace_queue_depth)
+        if writer is not None:
+            this_layer_sim.set_trace_writer(writer)
+
+    if result_cache is not None:
+        this_layer_sim.set_result_cache(result_cache)
+
+    if matrix_cache_mb > 0:
+        this_layer_sim.set_matrix_cache(get_process_matrix_cache(matrix_cache_mb))
+
+    if lazy_operands:
+        this_layer_sim.enable_lazy_operands()
+
+    spill = get_matrix_spill(spill_dir, spill_threshold_mb)
+    if spill is not None:
+        this_layer_sim.set_matrix_spill(spill)
+
+    if profile:
+        this_layer_sim.enable_profiling()
+
+    this_layer_sim.run()
+
+    if writer is not None:
+        writer.close()
+
+    comp_items = this_layer_sim.get_compute_report_items()
+    bw_items = this_layer_sim.get_bandwidth_report_items()
+    detail_items = this_layer_sim.get_detail_report_items()
+
+    profile_items = []
+    if profile:
+        profile_items = this_layer_sim.get_profile_report_items()
+
+    return comp_items, bw_items, detail_items, profile_items
+
+
+# None if the matrices are never to be spilled
+def get_matrix_spill(spill_dir, spill_threshold_mb):
+    if spill_threshold_mb == 0:
+        return None
+
+    spill = matrix_spill()
+    spill.set_params(scratch_dir=spill_dir, threshold_mb=spill_threshold_mb)
+    return spill
+
+
+# None if the traces are to be written in line
+def get_trace_writer(trace_queue_depth):
+    if trace_queue_depth == 0:
+        return None
+
+    writer = trace_writer()
+    writer.set_params(max_pending=trace_queue_depth)
+    return writer
+
+
+# The detailed mode simulates the demand matrices cycle by cycle,
+# the analytic mode estimates the reports from the layer dimensions
+def get_layer_sim(fidelity='detailed'):
+    if fidelity == 'analytic':
+        return analytic_layer_sim()
+    return layer_sim()
+
+
+#
+def print_layer_summary(comp_items, bw_items):
+    comp_cycles = comp_items[0]
+    stall_cycles = comp_items[1]
+    util = comp_items[2]
+    mapping_eff = comp_items[3]
+    print('Compute cycles: ' + str(comp_cycles))
+    print('Stall cycles: ' + str(stall_cycles))
+    print('Overall utilization: ' + "{:.2f}".format(util) +'%')
+    print('Mapping efficiency: ' + "{:.2f}".format(mapping_eff) +'%')
 
+    avg_ifmap_bw = bw_items[3]
+    avg_filter_bw = bw_items[4]
+    avg_ofmap_bw = bw_items[5]
+    print('Average IFMAP DRAM BW: ' + "{:.3f}".format(avg_ifmap_bw) + ' words/cycle')
+    print('Average Filter DRAM BW: ' + "{:.3f}".format(avg_filter_bw) + ' words/cycle')
+    print('Average OFMAP DRAM BW: ' + "{:.3f}".format(avg_ofmap_bw) + ' words/cycle')
@@ -2,11 +2,15 @@ import os
 
 from scalesim.scale_config import scale_config as cfg
 from scalesim.topology_utils import topologies as topo
-from scalesim.compute.operand_matrix import operand_matrix as opmat
+from scalesim.compute.operand_matrix import operand_matrix as opmat, default_max_cached_tiles
 from scalesim.compute.systolic_compute_os import systolic_compute_os
 from scalesim.compute.systolic_compute_ws import systolic_compute_ws
 from scalesim.compute.systolic_compute_is import systolic_compute_is
 from scalesim.memory.double_buffered_scratchpad_mem import double_buffered_scratchpad as mem_dbsp
+from scalesim.memory.trace_sink import trace_sink
+from scalesim.trace_utils import get_trace_filename, trace_names
+from scalesim.profile_utils import stage_profiler, profile_stages
+from scalesim.matrix_cache import get_operand_key, get_compute_key, freeze_arrays
 
 
 class single_layer_sim:
@@ -20,6 +24,28 @@ class single_layer_sim:
         self.memory_system = mem_dbsp()
 
         self.verbose = True
+        self.save_trace = True
+
+        # Traces written to the disk while the layer runs
+        self.trace_stream_path = ''
+        self.trace_format = 'csv'
+        self.trace_writer = None    # Writes the streamed traces on a background thread, if set
+
+        # Results of the layers simulated before, see layer_cache
+        self.result_cache = None
+        self.result_cache_key = ''
+        self.results_from_cache = False
+
+        # Matrices of the layers run before in this run, see matrix_cache
+        self.matrix_cache = None
+        self.cached_demand_folds = []
+        self.cached_demand_bytes = 0
+
+        # Files backing the matrices too large for the memory, see matrix_spill
+        self.spill = None
+
+        # Wall time of the stages of the run, only measured if enabled
+        self.profiler = stage_profiler()
 
         # Report items : Compute report
         self.total_cycles = 0
@@ -71,7 +97,8 @@ class single_layer_sim:
     def set_params(self,
                    layer_id=0,
                    config_obj=cfg(), topology_obj=topo(),
-                   verbose=True):
+                   verbose=True,
+                   save_trace=True):
 
         self.layer_id = layer_id
         self.config = config_obj
@@ -93,9 +120,62 @@ class single_layer_sim:
         arr_dims =self.config.get_array_dims()
         self.num_mac_unit = arr_dims[0] * arr_dims[1]
         self.verbose=verbose
+        self.save_trace = save_trace
 
         self.params_set_flag = True
 
+    # The traces are streamed to the layer directory under top_path while the layer runs,
+    # only a few rows of each trace are held in the memory. save_traces() is not needed then
+    def stream_traces(self, top_path, trace_format='csv'):
+        assert self.params_set_flag, 'Parameters are not set'
+        assert self.save_trace, 'Traces are not enabled for this layer'
+
+        self.trace_stream_path = top_path
+        self.trace_format = trace_format
+
+    # The streamed traces are written on the thread of the writer, which can be shared by the layers of a run
+    # The traces of the layer, and its entry in the result cache, are complete only once the writer is drained
+    def set_trace_writer(self, writer):
+        assert self.params_set_flag, 'Parameters are not set'
+        self.trace_writer = writer
+
+    # The operand matrices are built outside and can be shared by the layer runs of several configs,
+    # as these depend only on the layer and the offsets
+    def set_operand_matrix(self, op_mat_obj):
+        assert self.params_set_flag, 'Parameters are not set'
+        self.op_mat_obj = op_mat_obj
+
+    # The results are looked up in the cache before the layer is simulated, and added to it after
+    # With the traces enabled, only the entries which have the traces are used and
+    # the traces should be streamed, as there is no memory system to print them from on a hit
+    def set_result_cache(self, cache_obj):
+        assert self.params_set_flag, 'Parameters are not set'
+
+        self.result_cache = cache_obj
+        self.result_cache_key = cache_obj.get_layer_key(self.config, self.topo, self.layer_id)
+
+    # The operand, prefetch and demand matrices are taken from the cache if a layer with the same shape ran before,
+    # and added to it otherwise
+    def set_matrix_cache(self, cache_obj):
+        assert self.params_set_flag, 'Parameters are not set'
+        self.matrix_cache = cache_obj
+
+    # The operand matrices are not built in full, the compute system pulls the tiles it needs fold by fold
+    # For the layers whose operand matrices do not fit in the memory
+    def enable_lazy_operands(self, max_cached_tiles=default_max_cached_tiles):
+        assert self.params_set_flag, 'Parameters are not set'
+        self.op_mat_obj.enable_lazy_tiles(max_cached_tiles=max_cached_tiles)
+
+    # The operand and demand matrices above the threshold of the spill object are kept in files
+    # The files are removed at the end of the run
+    def set_matrix_spill(self, spill_obj):
+        assert self.params_set_flag, 'Parameters are not set'
+        self.spill = spill_obj
+
+    # Times the stages of the run and save_traces(), see get_profile_report_items()
+    def enable_profiling(self):
+        self.profiler.enable()
+
     # This communicates that the memory is being managed externally
     # And the class will not interfere with setting it up
     def set_memory_system(self, mem_sys_obj=mem_dbsp()):
@@ -105,29 +185,67 @@ class single_layer_sim:
     def run(self):
         assert self.params_set_flag, 'Parameters are not set. Run set_params()'
 
+        self.profiler.start_total()
+
+        # 0. Reuse the results of the same layer, if it was simulated before
+        if self.result_cache is not None:
+            self.profiler.start('result_cache')
+            cache_hit = self.load_cached_results()
+            self.profiler.stop('result_cache')
+
+            if cache_hit:
+                self.profiler.stop_total()
+                return
+
         # 1. Setup and the get the demand from compute system
 
         # 1.1 Get the operand matrices
-        _, ifmap_op_mat = self.op_mat_obj.get_ifmap_matrix()
-        _, filter_op_mat = self.op_mat_obj.get_filter_matrix()
-        _, ofmap_op_mat = self.op_mat_obj.get_ofmap_matrix()
+        # These are not needed if the compute system of a layer with the same shape is cached
+        self.profiler.start('operand_matrices')
+        compute_entry = None
+        if self.matrix_cache is not None:
+            compute_entry = self.matrix_cache.lookup(get_compute_key(self.config, self.topo, self.layer_id))
+
+        if compute_entry is None:
+            ifmap_op_mat, filter_op_mat, ofmap_op_mat = self.get_operand_matrices()
+        self.profiler.stop('operand_matrices')
 
         self.num_compute = self.topo.get_layer_num_ofmap_px(self.layer_id) \
                            * self.topo.get_layer_window_size(self.layer_id)
 
         # 1.2 Get the prefetch matrices for both operands
-        self.compute_system.set_params(config_obj=self.config,
-                                       ifmap_op_mat=ifmap_op_mat,
-                                       filter_op_mat=filter_op_mat,
-                                       ofmap_op_mat=ofmap_op_mat)
+        self.profiler.start('prefetch_matrices')
+        if compute_entry is None:
+            self.compute_system.set_params(config_obj=self.config,
+                                           ifmap_op_mat=ifmap_op_mat,
+                                           filter_op_mat=filter_op_mat,
+                                           ofmap_op_mat=ofmap_op_mat)
+            self.compute_system.set_matrix_spill(self.spill)
+        else:
+            self.compute_system = compute_entry[0]
 
         # 1.3 Get the no compute demand matrices from for 2 operands and the output
-        ifmap_prefetch_mat, filter_prefetch_mat = self.compute_system.get_prefetch_matrices()
-        ifmap_demand_mat, filter_demand_mat, ofmap_demand_mat = self.compute_system.get_demand_matrices()
+        # The demand matrices are generated fold by fold, as the memory system consumes them
+        # The prefetch matrices are only used with the user given bandwidth, these are as large as the operands
+        ifmap_prefetch_mat, filter_prefetch_mat = None, None
+        if self.config.use_user_dram_bandwidth():
+            ifmap_prefetch_mat, filter_prefetch_mat = self.compute_system.get_prefetch_matrices()
+        self.profiler.stop('prefetch_matrices')
+
+        # The demand folds of a cached compute system are kept too, unless these did not fit in the cache
+        if compute_entry is not None and compute_entry[1] is not None:
+            demand_matrices_per_fold = iter(compute_entry[1])
+        else:
+            # The demands are band matrices, which store only the valid requests, see band_matrix
+            demand_matrices_per_fold = self.compute_system.get_demand_bands_per_fold()
+            if self.matrix_cache is not None and compute_entry is None:
+                demand_matrices_per_fold = self.record_demand_folds(demand_matrices_per_fold)
+        demand_matrices_per_fold = self.profiler.profile_iterator('demand_matrices', demand_matrices_per_fold)
         #print('DEBUG: Compute operations done')
         # 2. Setup the memory system and run the demands through it to find any memory bottleneck and generate traces
 
         # 2.1 Setup the memory system if it was not setup externally
+        self.profiler.start('memory_setup')
         if not self.memory_system_ready_flag:
             word_size = 1           # bytes, this can be incorporated in the config file
             active_buf_frac = 0.5   # This can be incorporated in the config as well
@@ -167,42 +285,196 @@ class single_layer_sim:
                     filter_backing_buf_bw=filter_backing_bw,
                     ofmap_backing_buf_bw=ofmap_backing_bw,
                     verbose=self.verbose,
-                    estimate_bandwidth_mode=estimate_bandwidth_mode
+                    estimate_bandwidth_mode=estimate_bandwidth_mode,
+                    keep_sram_traces=self.save_trace
             )
 
-        # 2.2 Install the prefetch matrices to the read buffers to finish setup
+        # 2.2 Open the traces on the disk, if they are to be streamed
+        if not self.trace_stream_path == '':
+            dir_name = self.get_trace_dir(self.trace_stream_path)
+            sinks = []
+            for trace_name in trace_names:
+                sink = trace_sink()
+                sink.set_params(filename=get_trace_filename(dir_name, trace_name, self.trace_format),
+                                trace_format=self.trace_format)
+                sink.set_profiler(self.profiler)
+                if self.trace_writer is not None:
+                    sink.set_trace_writer(self.trace_writer)
+                sinks.append(sink)
+            self.memory_system.set_trace_sinks(*sinks)
+
+        # 2.3 Install the prefetch matrices to the read buffers to finish setup
         if self.config.use_user_dram_bandwidth() :
             self.memory_system.set_read_buf_prefetch_matrices(ifmap_prefetch_mat=ifmap_prefetch_mat,
                                                               filter_prefetch_mat=filter_prefetch_mat)
+        self.profiler.stop('memory_setup')
 
-        # 2.3 Start sending the requests through the memory system until
+        # 2.4 Start sending the requests through the memory system until
         # all the OFMAP memory requests have been serviced
-        self.memory_system.service_memory_requests(ifmap_demand_mat, filter_demand_mat, ofmap_demand_mat)
+        # The demand matrices generated and the traces written meanwhile are timed as their own stages
+        self.profiler.start('memory_service')
+        self.memory_system.service_memory_requests_per_fold(demand_matrices_per_fold)
+        self.profiler.stop('memory_service')
+
+        self.runs_ready = True
+
+        # The spilled matrices stay readable once their files are gone
+        if self.spill is not None:
+            self.spill.release()
+
+        # 2.5 Keep the matrices for the layers with the same shape
+        if self.matrix_cache is not None and compute_entry is None:
+            self.store_compute_matrices(ifmap_prefetch_mat, filter_prefetch_mat)
+
+        # 3. Add the results to the cache
+        if self.result_cache is not None:
+            self.profiler.start('result_cache')
+            self.store_cached_results()
+            self.profiler.stop('result_cache')
 
+        self.profiler.stop_total()
+
+    # Operand matrices of the layer, taken from the matrix cache when a layer with the same shape ran before
+    # The lazy operand matrices hold only a few tiles, these are not cached
+    def get_operand_matrices(self):
+        use_cache = self.matrix_cache is not None and not self.op_mat_obj.is_lazy()
+
+        cached_op_mat = None
+        if use_cache:
+            operand_key = get_operand_key(self.config, self.topo, self.layer_id)
+            cached_op_mat = self.matrix_cache.lookup(operand_key)
+
+        if cached_op_mat is not None:
+            self.op_mat_obj = cached_op_mat
+        else:
+            self.op_mat_obj.set_matrix_spill(self.spill)
+
+        _, ifmap_op_mat = self.op_mat_obj.get_ifmap_matrix()
+        _, filter_op_mat = self.op_mat_obj.get_filter_matrix()
+        _, ofmap_op_mat = self.op_mat_obj.get_ofmap_matrix()
+
+        if use_cache and cached_op_mat is None:
+            size_bytes = freeze_arrays([ifmap_op_mat, filter_op_mat, ofmap_op_mat])
+            self.matrix_cache.store(operand_key, self.op_mat_obj, size_bytes)
+
+        return ifmap_op_mat, filter_op_mat, ofmap_op_mat
+
+    # Passes the demand folds on to the memory system and keeps them for the matrix cache
+    # The folds are dropped once they outgrow the cache
+    def record_demand_folds(self, demand_matrices_per_fold):
+        self.cached_demand_folds = []
+        self.cached_demand_bytes = 0
+
+        for fold_demands in demand_matrices_per_fold:
+            if self.cached_demand_folds is not None:
+                for fold_demand in fold_demands:
+                    self.cached_demand_bytes += freeze_arrays(fold_demand.get_arrays())
+                if self.cached_demand_bytes > self.matrix_cache.get_max_size_bytes():
+                    self.cached_demand_folds = None
+                else:
+                    self.cached_demand_folds.append(fold_demands)
+
+            yield fold_demands
+
+    # The compute system holds the prefetch matrices and the per fold metrics used in the reports
+    def store_compute_matrices(self, ifmap_prefetch_mat, filter_prefetch_mat):
+        size_bytes = 0
+        if ifmap_prefetch_mat is not None:
+            size_bytes += freeze_arrays([ifmap_prefetch_mat, filter_prefetch_mat])
+        if self.cached_demand_folds is not None:
+            size_bytes += self.cached_demand_bytes
+
+        compute_key = get_compute_key(self.config, self.topo, self.layer_id)
+        self.matrix_cache.store(compute_key, [self.compute_system, self.cached_demand_folds], size_bytes)
+
+        # The cache holds the folds now
+        self.cached_demand_folds = []
+        self.cached_demand_bytes = 0
+
+    # Returns True if the report items, and the traces if needed, were found in the cache
+    def load_cached_results(self):
+        trace_format = ''
+        if self.save_trace:
+            if self.trace_stream_path == '':
+                return False
+            trace_format = self.trace_format
+
+        cached_items = self.result_cache.lookup(self.result_cache_key, trace_format=trace_format)
+        if cached_items is None:
+            return False
+
+        if self.save_trace:
+            dir_name = self.get_trace_dir(self.trace_stream_path)
+            self.result_cache.restore_traces(self.result_cache_key, dir_name, trace_format=trace_format)
+
+        if self.verbose:
+            print('Results of the layer found in the cache')
+
+        self.set_report_items(*cached_items)
+        self.results_from_cache = True
         self.runs_ready = True
 
+        return True
+
+    #
+    def store_cached_results(self):
+        dir_name = ''
+        if not self.trace_stream_path == '':
+            dir_name = self.get_trace_dir(self.trace_stream_path)
+
+        # The traces are copied to the cache once the writer is done with them
+        if self.trace_writer is not None and not dir_name == '':
+            self.trace_writer.submit(self.result_cache.store, self.result_cache_key,
+                                     self.get_compute_report_items(),
+                                     self.get_bandwidth_report_items(),
+                                     self.get_detail_report_items(),
+                                     dir_name, self.trace_format)
+            return
+
+        self.result_cache.store(self.result_cache_key,
+                                self.get_compute_report_items(),
+                                self.get_bandwidth_report_items(),
+                                self.get_detail_report_items(),
+                                dir_name=dir_name, trace_format=self.trace_format)
+
     # This will write the traces
-    def save_traces(self, top_path):
+    def save_traces(self, top_path, trace_format='csv'):
         assert self.params_set_flag, 'Parameters are not set'
 
+        # Already on the disk
+        if not self.trace_stream_path == '':
+            return
+
+        self.profiler.start_total()
+        self.profiler.start('trace_writing')
+
+        dir_name = self.get_trace_dir(top_path)
+
+        ifmap_sram_filename = get_trace_filename(dir_name, 'IFMAP_SRAM_TRACE', trace_format)
+        filter_sram_filename = get_trace_filename(dir_name, 'FILTER_SRAM_TRACE', trace_format)
+        ofmap_sram_filename = get_trace_filename(dir_name, 'OFMAP_SRAM_TRACE', trace_format)
+
+        ifmap_dram_filename = get_trace_filename(dir_name, 'IFMAP_DRAM_TRACE', trace_format)
+        filter_dram_filename = get_trace_filename(dir_name, 'FILTER_DRAM_TRACE', trace_format)
+        ofmap_dram_filename = get_trace_filename(dir_name, 'OFMAP_DRAM_TRACE', trace_format)
+
+        self.memory_system.print_ifmap_sram_trace(ifmap_sram_filename, trace_format=trace_format)
+        self.memory_system.print_ifmap_dram_trace(ifmap_dram_filename, trace_format=trace_format)
+        self.memory_system.print_filter_sram_trace(filter_sram_filename, trace_format=trace_format)
+        self.memory_system.print_filter_dram_trace(filter_dram_filename, trace_format=trace_format)
+        self.memory_system.print_ofmap_sram_trace(ofmap_sram_filename, trace_format=trace_format)
+        self.memory_system.print_ofmap_dram_trace(ofmap_dram_filename, trace_format=trace_format)
+
+        self.profiler.stop('trace_writing')
+        self.profiler.stop_total()
+
+    #
+    def get_trace_dir(self, top_path):
         dir_name = top_path + '/layer' + str(self.layer_id)
         if not os.path.isdir(dir_name):
             os.mkdir(dir_name)
 
-        ifmap_sram_filename = dir_name +  '/IFMAP_SRAM_TRACE.csv'
-        filter_sram_filename = dir_name + '/FILTER_SRAM_TRACE.csv'
-        ofmap_sram_filename = dir_name +  '/OFMAP_SRAM_TRACE.csv'
-
-        ifmap_dram_filename = dir_name +  '/IFMAP_DRAM_TRACE.csv'
-        filter_dram_filename = dir_name + '/FILTER_DRAM_TRACE.csv'
-        ofmap_dram_filename = dir_name +  '/OFMAP_DRAM_TRACE.csv'
-
-        self.memory_system.print_ifmap_sram_trace(ifmap_sram_filename)
-        self.memory_system.print_ifmap_dram_trace(ifmap_dram_filename)
-        self.memory_system.print_filter_sram_trace(filter_sram_filename)
-        self.memory_system.print_filter_dram_trace(filter_dram_filename)
-        self.memory_system.print_ofmap_sram_trace(ofmap_sram_filename)
-        self.memory_system.print_ofmap_dram_trace(ofmap_dram_filename)
+        return dir_name
 
     #
     def calc_report_data(self):
@@ -249,6 +521,46 @@ class single_layer_sim:
 
         self.report_items_ready = True
 
+    # Sets the report items as returned by the get_*_report_items() methods
+    def set_report_items(self, comp_items, bw_items, detail_items):
+        self.total_cycles, self.stall_cycles, self.overall_util, self.mapping_eff, self.compute_util = comp_items
+
+        self.avg_ifmap_sram_bw, self.avg_filter_sram_bw, self.avg_ofmap_sram_bw, \
+            self.avg_ifmap_dram_bw, self.avg_filter_dram_bw, self.avg_ofmap_dram_bw = bw_items
+
+        self.ifmap_sram_start_cycle, self.ifmap_sram_stop_cycle, self.ifmap_sram_reads, \
+            self.filter_sram_start_cycle, self.filter_sram_stop_cycle, self.filter_sram_reads, \
+            self.ofmap_sram_start_cycle, self.ofmap_sram_stop_cycle, self.ofmap_sram_writes, \
+            self.ifmap_dram_start_cycle, self.ifmap_dram_stop_cycle, self.ifmap_dram_reads, \
+            self.filter_dram_start_cycle, self.filter_dram_stop_cycle, self.filter_dram_reads, \
+            self.ofmap_dram_start_cycle, self.ofmap_dram_stop_cycle, self.ofmap_dram_writes = detail_items
+
+        self.report_items_ready = True
+
+    # Wall time of each stage, the events in the memory system and the simulation speed
+    # The columns are given by profile_utils.profile_report_columns
+    def get_profile_report_items(self):
+        assert self.profiler.is_enabled(), 'Profiling is not enabled'
+        if not self.report_items_ready:
+            self.calc_report_data()
+
+        items = [self.profiler.get_total_time()]
+        items += [self.profiler.get_stage_time(stage) for stage in profile_stages]
+
+        # There are no memory system events when the results are taken from the cache
+        lines_serviced, ifmap_prefetches, filter_prefetches, ofmap_drains = 0, 0, 0, 0
+        if not self.results_from_cache:
+            lines_serviced = self.memory_system.get_num_lines_serviced()
+            ifmap_prefetches, filter_prefetches, ofmap_drains = self.memory_system.get_buffer_event_counts()
+        items += [lines_serviced, ifmap_prefetches, filter_prefetches, ofmap_drains]
+
+        cycles_per_sec = 0
+        if self.profiler.get_total_time() > 0:
+            cycles_per_sec = self.total_cycles / self.profiler.get_total_time()
+        items += [self.total_cycles, cycles_per_sec]
+
+        return items
+
     #
     def get_layer_id(self):
         assert self.params_set_flag, 'Parameters are not set yet'
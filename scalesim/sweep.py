@@ -0,0 +1,325 @@
+# Design space sweep over the array dimensions, the SRAM sizes and the dataflow
+#
+# The topology is parsed once and every config point of the grid is simulated for every layer.
+# The operand matrices depend only on the layer and the offsets, these are kept in the matrix cache
+# of the worker process and shared by all the chunks of config points of the layer it runs.
+# No trace or per point directory is written, the report items of all the points are gathered in one table.
+#
+# Usage:
+#   python3 -m scalesim.sweep -c <config> -t <topology> -g ArrayHeight=8,16,32 -g Dataflow=os,ws -o sweep.csv
+import argparse
+import copy
+import itertools
+import math
+from concurrent.futures import ProcessPoolExecutor
+
+from scalesim.scale_config import scale_config
+from scalesim.topology_utils import topologies
+from scalesim.compute.operand_matrix import operand_matrix as opmat
+from scalesim.single_layer_sim import single_layer_sim as layer_sim
+from scalesim.layer_cache import layer_cache
+from scalesim.matrix_cache import get_process_matrix_cache, get_operand_key, freeze_arrays
+
+# The config fields which can be swept, named as in the config file
+sweep_params = ['ArrayHeight', 'ArrayWidth', 'IfmapSramSzkB', 'FilterSramSzkB', 'OfmapSramSzkB', 'Dataflow']
+
+# Columns of the results table after the swept parameters, the layer and the report items in the report order
+report_columns = ['LayerID', 'LayerName',
+                  'Total Cycles', 'Stall Cycles', 'Overall Util %', 'Mapping Efficiency %', 'Compute Util %',
+                  'Avg IFMAP SRAM BW', 'Avg FILTER SRAM BW', 'Avg OFMAP SRAM BW',
+                  'Avg IFMAP DRAM BW', 'Avg FILTER DRAM BW', 'Avg OFMAP DRAM BW',
+                  'SRAM IFMAP Start Cycle', 'SRAM IFMAP Stop Cycle', 'SRAM IFMAP Reads',
+                  'SRAM Filter Start Cycle', 'SRAM Filter Stop Cycle', 'SRAM Filter Reads',
+                  'SRAM OFMAP Start Cycle', 'SRAM OFMAP Stop Cycle', 'SRAM OFMAP Writes',
+                  'DRAM IFMAP Start Cycle', 'DRAM IFMAP Stop Cycle', 'DRAM IFMAP Reads',
+                  'DRAM Filter Start Cycle', 'DRAM Filter Stop Cycle', 'DRAM Filter Reads',
+                  'DRAM OFMAP Start Cycle', 'DRAM OFMAP Stop Cycle', 'DRAM OFMAP Writes']
+
+
+class sweep:
+    def __init__(self):
+        self.config = scale_config()
+        self.topo = topologies()
+
+        # Swept parameter name to the list of its values
+        self.param_grid = {}
+        self.config_points = []     # Values of sweep_params at each point, in the order of the grid
+
+        self.num_workers = 1
+        self.verbose = True
+        self.result_cache = None
+
+        # One row per config point and layer
+        self.results = []
+
+        self.params_set_flag = False
+        self.sweep_done_flag = False
+
+    #
+    def set_params(self,
+                   config_obj=scale_config(),
+                   topo_obj=topologies(),
+                   param_grid=None,
+                   num_workers=1,
+                   verbose=True,
+                   result_cache=None):
+
+        self.config = config_obj
+        self.topo = topo_obj
+
+        if param_grid is None:
+            param_grid = {}
+
+        for param in param_grid:
+            if param not in sweep_params:
+                print('ERROR: sweep.set_params(): ' + str(param) + ' cannot be swept')
+                print('Sweep parameters: ' + ', '.join(sweep_params))
+                exit()
+
+            if len(param_grid[param]) == 0:
+                print('ERROR: sweep.set_params(): No values given for ' + str(param))
+                exit()
+
+        self.param_grid = param_grid
+        self.config_points = get_config_points(self.config, self.param_grid)
+
+        assert num_workers > 0, 'Number of workers should be at least 1'
+        self.num_workers = num_workers
+        self.verbose = verbose
+        self.result_cache = result_cache
+
+        self.params_set_flag = True
+
+    #
+    def run(self):
+        assert self.params_set_flag, 'Sweep parameters are not set'
+
+        num_layers = self.topo.get_num_layers()
+        num_points = len(self.config_points)
+
+        # Work units: a layer with a chunk of the config points
+        # The chunks are small enough to keep all the workers busy
+        num_chunks_per_layer = 1
+        if self.num_workers > 1:
+            num_chunks_per_layer = min(num_points, int(math.ceil(4 * self.num_workers / num_layers)))
+        chunk_size = int(math.ceil(num_points / num_chunks_per_layer))
+
+        work_units = []
+        for layer_id in range(num_layers):
+            for start in range(0, num_points, chunk_size):
+                point_ids = list(range(start, min(start + chunk_size, num_points)))
+                work_units.append((layer_id, point_ids))
+
+        if self.verbose:
+            print('Sweeping ' + str(num_points) + ' config points over '
+                  + str(num_layers) + ' layers on ' + str(self.num_workers) + ' workers')
+
+        results = {}
+        if self.num_workers > 1:
+            with ProcessPoolExecutor(max_workers=self.num_workers) as executor:
+                futures = [executor.submit(run_layer_points, layer_id, point_ids, self.config_points,
+                                           self.config, self.topo, self.result_cache)
+                           for layer_id, point_ids in work_units]
+                for future in futures:
+                    results.update(future.result())
+        else:
+            for layer_id, point_ids in work_units:
+                results.update(run_layer_points(layer_id, point_ids, self.config_points,
+                                                self.config, self.topo, self.result_cache))
+
+        # Rows in the order of the config points, then the layers
+        self.results = []
+        for point_id in range(num_points):
+            for layer_id in range(num_layers):
+                row = list(self.config_points[point_id])
+                row += [layer_id, self.topo.get_layer_name(layer_id)]
+                row += results[(point_id, layer_id)]
+                self.results.append(row)
+
+        self.sweep_done_flag = True
+
+    #
+    def get_header(self):
+        return sweep_params + report_columns
+
+    #
+    def get_results(self):
+        assert self.sweep_done_flag, 'Sweep is not done yet'
+        return self.results
+
+    # Total cycles of all the layers, for each config point
+    def get_total_cycles_per_point(self):
+        assert self.sweep_done_flag, 'Sweep is not done yet'
+
+        cycles_col = len(sweep_params) + report_columns.index('Total Cycles')
+        num_layers = self.topo.get_num_layers()
+
+        total_cycles = []
+        for point_id in range(len(self.config_points)):
+            rows = self.results[point_id * num_layers: (point_id + 1) * num_layers]
+            total_cycles.append(sum([int(row[cycles_col]) for row in rows]))
+
+        return total_cycles
+
+    #
+    def write_results(self, filename):
+        assert self.sweep_done_flag, 'Sweep is not done yet'
+
+        with open(filename, 'w', encoding='utf-8') as f:
+            f.write(', '.join(self.get_header()) + ',\n')
+            for row in self.results:
+                f.write(', '.join([str(x) for x in row]) + ',\n')
+
+
+# Values of sweep_params at each point of the grid, the parameters not in the grid keep the config values
+def get_config_points(config_obj, param_grid):
+    arr_h, arr_w = config_obj.get_array_dims()
+    ifmap_kb, filter_kb, ofmap_kb = config_obj.get_mem_sizes()
+    base_values = [arr_h, arr_w, ifmap_kb, filter_kb, ofmap_kb, config_obj.get_dataflow()]
+
+    values_per_param = []
+    for param, base_value in zip(sweep_params, base_values):
+        values_per_param.append(param_grid.get(param, [base_value]))
+
+    return [list(point) for point in itertools.product(*values_per_param)]
+
+
+# Copy of the config with the swept parameters set to the values of the point
+def get_point_config(config_obj, point):
+    arr_h, arr_w, ifmap_kb, filter_kb, ofmap_kb, dataflow = point
+
+    point_config = copy.deepcopy(config_obj)
+    point_config.set_arr_dims(rows=int(arr_h), cols=int(arr_w))
+    point_config.set_buffer_sizes_kb(ifmap_size_kb=int(ifmap_kb),
+                                     filter_size_kb=int(filter_kb),
+                                     ofmap_size_kb=int(ofmap_kb))
+    point_config.set_dataflow(dataflow)
+
+    return point_config
+
+
+# The operand matrices do not depend on the swept parameters
+# These are taken from the process matrix cache if a chunk of the layer, or a layer of the same shape, ran before
+def get_layer_operand_matrix(layer_id, config_obj, topo_obj):
+    cache = get_process_matrix_cache()
+    operand_key = get_operand_key(config_obj, topo_obj, layer_id)
+
+    op_mat_obj = cache.lookup(operand_key)
+    if op_mat_obj is not None:
+        return op_mat_obj
+
+    op_mat_obj = opmat()
+    op_mat_obj.set_params(config_obj=config_obj, topoutil_obj=topo_obj, layer_id=layer_id)
+
+    _, ifmap_op_mat = op_mat_obj.get_ifmap_matrix()
+    _, filter_op_mat = op_mat_obj.get_filter_matrix()
+    _, ofmap_op_mat = op_mat_obj.get_ofmap_matrix()
+    size_bytes = freeze_arrays([ifmap_op_mat, filter_op_mat, ofmap_op_mat])
+    cache.store(operand_key, op_mat_obj, size_bytes)
+
+    return op_mat_obj
+
+
+# Simulates one layer for the given config points, this is the unit of work for the process pool
+# Returns the report items keyed by (point id, layer id)
+def run_layer_points(layer_id, point_ids, config_points, config_obj, topo_obj, result_cache=None):
+    op_mat_obj = get_layer_operand_matrix(layer_id, config_obj, topo_obj)
+
+    results = {}
+    for point_id in point_ids:
+        point_config = get_point_config(config_obj, config_points[point_id])
+
+        this_layer_sim = layer_sim()
+        this_layer_sim.set_params(layer_id=layer_id,
+                                  config_obj=point_config,
+                                  topology_obj=topo_obj,
+                                  verbose=False,
+                                  save_trace=False)
+        this_layer_sim.set_operand_matrix(op_mat_obj)
+
+        if result_cache is not None:
+            this_layer_sim.set_result_cache(result_cache)
+
+        this_layer_sim.run()
+
+        report_items = this_layer_sim.get_compute_report_items()
+        report_items += this_layer_sim.get_bandwidth_report_items()
+        report_items += this_layer_sim.get_detail_report_items()
+        results[(point_id, layer_id)] = report_items
+
+    return results
+
+
+# Parses the grid arguments of the form Name=value1,value2,...
+def parse_param_grid(grid_args):
+    param_grid = {}
+    for grid_arg in grid_args:
+        if '=' not in grid_arg:
+            print('ERROR: sweep.parse_param_grid(): Grid should be given as Name=value1,value2,...')
+            print('Input: ' + grid_arg)
+            exit()
+
+        param, values = grid_arg.split('=', 1)
+        param = param.strip()
+        values = [x.strip() for x in values.split(',') if not x.strip() == '']
+
+        if not param == 'Dataflow':
+            values = [int(x) for x in values]
+        param_grid[param] = values
+
+    return param_grid
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-t', metavar='Topology file', type=str,
+                        default="../topologies/conv_nets/test.csv",
+                        help="Path to the topology file"
+                        )
+    parser.add_argument('-c', metavar='Config file', type=str,
+                        default="../configs/scale.cfg",
+                        help="Path to the config file, the base of all the config points"
+                        )
+    parser.add_argument('-i', metavar='input type', type=str,
+                        default="conv",
+                        help="Type of input topology, gemm: MNK, conv: conv"
+                        )
+    parser.add_argument('-g', metavar='grid', type=str, action='append', default=[],
+                        help="Values of a swept parameter, eg. ArrayHeight=8,16,32. "
+                             "Parameters: " + ', '.join(sweep_params)
+                        )
+    parser.add_argument('-o', metavar='results file', type=str,
+                        default="sweep_results.csv",
+                        help="Path to the csv file with the results of all the config points"
+                        )
+    parser.add_argument('-w', metavar='num workers', type=int,
+                        default=1,
+                        help="Number of processes to simulate the config points in parallel"
+                        )
+    parser.add_argument('--no-cache', action='store_true',
+                        help="Simulate all the layers, instead of reusing the cached results of the same layers"
+                        )
+
+    args = parser.parse_args()
+
+    config = scale_config()
+    config.read_conf_file(args.c)
+
+    topo = topologies()
+    topo.load_arrays(topofile=args.t, mnk_inputs=(args.i == 'gemm'))
+
+    cache = None
+    if not args.no_cache:
+        cache = layer_cache()
+        cache.set_params()
+
+    s = sweep()
+    s.set_params(config_obj=config,
+                 topo_obj=topo,
+                 param_grid=parse_param_grid(args.g),
+                 num_workers=args.w,
+                 verbose=True,
+                 result_cache=cache)
+    s.run()
+    s.write_results(args.o)
+    print('Results of ' + str(len(s.config_points)) + ' config points written to ' + args.o)
@@ -218,6 +218,8 @@ class topologies(object):
         s_row = -1
         s_col = -1
         t_time = -1
+        if not self.topo_calc_hyper_param_flag:
+            self.topo_calc_hyperparams(self.topo_file_name)
         if self.topo_calc_hyper_param_flag:
             num_filt  = self.get_layer_num_filters(layer_id= layer_id)
             num_ofmap = self.get_layer_num_ofmap_px(layer_id=layer_id)
@@ -235,8 +237,6 @@ class topologies(object):
                 s_row = window_sz
                 s_col = num_ofmap
                 t_time = num_filt
-        else:
-            self.topo_calc_hyperparams(self.topo_file_name)
         return s_row, s_col, t_time
 
     def set_spatio_temporal_params(self):
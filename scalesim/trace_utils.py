@@ -0,0 +1,91 @@
+import os
+import argparse
+import numpy as np
+
+
+# Formats in which the per layer traces can be written
+# csv: Text, one line per cycle. Each line has the cycle followed by the addresses, -1 is a null request
+# npy: Binary numpy array with the same rows and columns as the csv.
+#      The .npy header records the dtype and the shape, ie. the number of lines and columns of the trace.
+#      The layer and the buffer are given by the path, ie. <run_dir>/layer<id>/<BUFFER>_TRACE.npy
+#      These files can be memory mapped for analysis with load_trace()
+trace_formats = ['csv', 'npy']
+
+# The SRAM traces followed by the DRAM traces, each in the order ifmap, filter, ofmap
+trace_names = ['IFMAP_SRAM_TRACE', 'FILTER_SRAM_TRACE', 'OFMAP_SRAM_TRACE',
+               'IFMAP_DRAM_TRACE', 'FILTER_DRAM_TRACE', 'OFMAP_DRAM_TRACE']
+
+
+#
+def get_trace_filename(dir_name, trace_name, trace_format='csv'):
+    assert trace_format in trace_formats, 'Trace format should be one of ' + ', '.join(trace_formats)
+    return dir_name + '/' + trace_name + '.' + trace_format
+
+
+#
+def write_trace(filename, trace_matrix, trace_format='csv'):
+    assert trace_format in trace_formats, 'Trace format should be one of ' + ', '.join(trace_formats)
+
+    if trace_format == 'npy':
+        np.save(filename, trace_matrix, allow_pickle=False)
+    else:
+        np.savetxt(filename, trace_matrix, fmt='%i', delimiter=",")
+
+
+# Returns a read only memory mapped view of a binary trace, the file is not read into the memory
+def load_trace(filename, mmap=True):
+    mmap_mode = None
+    if mmap:
+        mmap_mode = 'r'
+
+    return np.load(filename, mmap_mode=mmap_mode, allow_pickle=False)
+
+
+# Writes the legacy csv for a binary trace, next to it unless a filename is given
+def convert_trace_to_csv(npy_filename, csv_filename=''):
+    if csv_filename == '':
+        csv_filename = os.path.splitext(npy_filename)[0] + '.csv'
+
+    trace_matrix = load_trace(npy_filename)
+    write_trace(csv_filename, trace_matrix, trace_format='csv')
+
+    return csv_filename
+
+
+# Converts the binary traces of all the layers in a run directory to csv
+def convert_run_to_csv(run_dir, remove_npy=False):
+    if not os.path.isdir(run_dir):
+        print('ERROR: trace_utils.convert_run_to_csv(): Run directory not found')
+        print('Input directory: ' + run_dir)
+        exit()
+
+    converted_files = []
+    for layer_dir in sorted(os.listdir(run_dir)):
+        layer_path = run_dir + '/' + layer_dir
+        if not (layer_dir.startswith('layer') and os.path.isdir(layer_path)):
+            continue
+
+        for trace_name in trace_names:
+            npy_filename = get_trace_filename(layer_path, trace_name, trace_format='npy')
+            if not os.path.exists(npy_filename):
+                continue
+
+            converted_files.append(convert_trace_to_csv(npy_filename))
+            if remove_npy:
+                os.remove(npy_filename)
+
+    return converted_files
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-p', metavar='run dir', type=str,
+                        help="Path to the run directory with the layer<id> trace directories"
+                        )
+    parser.add_argument('-r', action='store_true',
+                        help="Remove the binary traces once converted"
+                        )
+
+    args = parser.parse_args()
+    converted = convert_run_to_csv(run_dir=args.p, remove_npy=args.r)
+    print('Converted ' + str(len(converted)) + ' traces to csv')
@@ -0,0 +1,162 @@
+# Deviation of the analytic fidelity mode from the detailed simulation
+#
+# Runs every layer of the topologies in both the modes and writes the per layer
+# numbers, their relative deviation and the wall clock time of each mode to a csv file.
+#
+# Usage (from the repo root):
+#   python3 test/benchmarks/analytic_deviation.py -c configs/scale.cfg -t topologies/conv_nets -o deviation.csv
+import argparse
+import glob
+import os
+import time
+
+from scalesim.scale_config import scale_config
+from scalesim.topology_utils import topologies
+from scalesim.simulator import get_layer_sim
+
+
+# Name of the metric and its index in the compute (C) or the detailed access (D) report items
+metrics = [
+    ('Total Cycles', 'C', 0),
+    ('Stall Cycles', 'C', 1),
+    ('Overall Util %', 'C', 2),
+    ('Mapping Efficiency %', 'C', 3),
+    ('Compute Util %', 'C', 4),
+    ('SRAM IFMAP Reads', 'D', 2),
+    ('SRAM Filter Reads', 'D', 5),
+    ('SRAM OFMAP Writes', 'D', 8),
+    ('DRAM IFMAP Reads', 'D', 11),
+    ('DRAM Filter Reads', 'D', 14),
+    ('DRAM OFMAP Writes', 'D', 17),
+]
+
+
+# The GEMM topologies have 4 entries per row: layer name, M, N, K
+def is_gemm_topology(topofile):
+    f = open(topofile, 'r')
+    header = f.readline()
+    f.close()
+    fields = [x for x in header.strip().split(',') if not x.strip() == '']
+    return len(fields) == 4
+
+
+def get_topology_files(paths):
+    topofiles = []
+    for path in paths:
+        if os.path.isdir(path):
+            topofiles += sorted(glob.glob(os.path.join(path, '**', '*.csv'), recursive=True))
+        else:
+            topofiles.append(path)
+    return topofiles
+
+
+def run_layer(fidelity, layer_id, config_obj, topo_obj):
+    layer_sim = get_layer_sim(fidelity)
+    layer_sim.set_params(layer_id=layer_id,
+                         config_obj=config_obj,
+                         topology_obj=topo_obj,
+                         verbose=False)
+
+    start = time.perf_counter()
+    layer_sim.run()
+    comp_items = layer_sim.get_compute_report_items()
+    detail_items = layer_sim.get_detail_report_items()
+    elapsed = time.perf_counter() - start
+
+    values = []
+    for _, report, idx in metrics:
+        items = comp_items if report == 'C' else detail_items
+        values.append(float(items[idx]))
+
+    return values, elapsed
+
+
+# Relative to the detailed number, the denominator is clamped to 1 for the metrics which can be 0 (eg. stalls)
+def deviation_percent(reference, estimate):
+    return (estimate - reference) * 100 / max(abs(reference), 1)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', metavar='Config file', type=str,
+                        default="./configs/scale.cfg",
+                        help="Path to the config file"
+                        )
+    parser.add_argument('-t', metavar='Topology path', type=str, nargs='+',
+                        default=["./topologies"],
+                        help="Topology files or directories to search for topology files"
+                        )
+    parser.add_argument('-o', metavar='Output file', type=str,
+                        default="./analytic_deviation.csv",
+                        help="Path to the output csv file"
+                        )
+    parser.add_argument('-l', metavar='Max layers', type=int,
+                        default=0,
+                        help="Maximum number of layers simulated per topology, 0: all layers"
+                        )
+    args = parser.parse_args()
+
+    config_obj = scale_config()
+    config_obj.read_conf_file(args.c)
+
+    header = 'Topology, LayerID, '
+    for name, _, _ in metrics:
+        header += 'Detailed ' + name + ', Analytic ' + name + ', Deviation ' + name + ' %, '
+    header += 'Detailed Time (s), Analytic Time (s),\n'
+
+    out_file = open(args.o, 'w')
+    out_file.write(header)
+
+    abs_dev_sums = [0.0] * len(metrics)
+    num_layers_run = 0
+    detailed_time = 0
+    analytic_time = 0
+
+    for topofile in get_topology_files(args.t):
+        topo_obj = topologies()
+        try:
+            topo_obj.load_arrays(topofile=topofile, mnk_inputs=is_gemm_topology(topofile))
+            topo_obj.topo_calc_hyperparams()
+        except (ValueError, IndexError, AssertionError):
+            print('WARNING: Could not parse ' + topofile + '. Skipping.')
+            continue
+
+        num_layers = topo_obj.get_num_layers()
+        if args.l > 0:
+            num_layers = min(num_layers, args.l)
+
+        print('Running ' + topofile + ' (' + str(num_layers) + ' layers)')
+        for layer_id in range(num_layers):
+            detailed_values, detailed_elapsed = run_layer('detailed', layer_id, config_obj, topo_obj)
+            analytic_values, analytic_elapsed = run_layer('analytic', layer_id, config_obj, topo_obj)
+
+            log = topofile + ', ' + str(layer_id) + ', '
+            for idx in range(len(metrics)):
+                dev = deviation_percent(detailed_values[idx], analytic_values[idx])
+                abs_dev_sums[idx] += abs(dev)
+                log += str(detailed_values[idx]) + ', ' + str(analytic_values[idx]) + ', '
+                log += "{:.3f}".format(dev) + ', '
+            log += "{:.6f}".format(detailed_elapsed) + ', ' + "{:.6f}".format(analytic_elapsed) + ',\n'
+            out_file.write(log)
+            out_file.flush()
+
+            num_layers_run += 1
+            detailed_time += detailed_elapsed
+            analytic_time += analytic_elapsed
+
+    out_file.close()
+
+    if num_layers_run == 0:
+        print('ERROR: No layers were simulated')
+        return
+
+    print('Layers simulated: ' + str(num_layers_run))
+    print('Detailed time: ' + "{:.3f}".format(detailed_time) + ' s, '
+          + 'Analytic time: ' + "{:.3f}".format(analytic_time) + ' s')
+    for idx, (name, _, _) in enumerate(metrics):
+        print('Mean absolute deviation ' + name + ': '
+              + "{:.3f}".format(abs_dev_sums[idx] / num_layers_run) + ' %')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,419 @@
+# Throughput of the simulator, per stage and end to end
+#
+# Times the layers of representative topologies and of synthetic GEMM layers whose M, N, K
+# and array size are scaled geometrically. The wall time of each stage is taken from the
+# profiler of the layer run. For every scaled dimension the growth of the run time is fitted
+# against the growth of the SRAM accesses simulated, an exponent well above 1 points at
+# super linear work in the simulator, eg. a matrix concatenated in a loop.
+#
+# The results are written to a json file with the commit they were taken on,
+# a file from an earlier run can be given with --compare to print the speedup of each case.
+# On the trees without the stage profiler, eg. the commits before it was added, each layer is run
+# on its own through simulator.run() and only its wall clock time is taken, so these can be compared too.
+#
+# Usage (from the repo root):
+#   python3 test/benchmarks/throughput.py -c configs/scale.cfg -o throughput.json
+#   python3 test/benchmarks/throughput.py -o new.json --compare old.json
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+
+import numpy as np
+
+from scalesim.scale_config import scale_config
+from scalesim.topology_utils import topologies
+from scalesim.single_layer_sim import single_layer_sim
+from scalesim.simulator import simulator
+
+try:
+    from scalesim.profile_utils import profile_stages
+except ImportError:
+    profile_stages = None
+
+# Bump this when the layout of the results file changes
+results_version = 1
+
+default_topologies = ['./topologies/conv_nets/test.csv',
+                      './topologies/GEMM_mnk/test_mnk_input.csv',
+                      './topologies/translation/gpt2.csv']
+
+# Dimensions scaled in the synthetic layers, one at a time
+scaled_dims = ['M', 'N', 'K', 'Array']
+
+# An exponent above this is reported as super linear
+super_linear_exponent = 1.25
+
+
+# The GEMM topologies have 4 entries per row: layer name, M, N, K
+def is_gemm_topology(topofile):
+    f = open(topofile, 'r')
+    header = f.readline()
+    f.close()
+    fields = [x for x in header.strip().split(',') if not x.strip() == '']
+    return len(fields) == 4
+
+
+# A topology with a single GEMM layer, in the layout used by topologies.load_arrays_gemm()
+def get_gemm_topology(m, n, k):
+    topo_obj = topologies()
+    topo_obj.current_topo_name = 'synthetic'
+    topo_obj.append_topo_entry_from_list(['gemm_' + str(m) + '_' + str(n) + '_' + str(k), m, k, 1, k, 1, n, 1])
+    return topo_obj
+
+
+#
+def get_commit():
+    repo_root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    try:
+        out = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=repo_root,
+                             capture_output=True, text=True, timeout=10)
+    except (OSError, subprocess.SubprocessError):
+        return ''
+    return out.stdout.strip()
+
+
+# The stages are timed only if the layers can be profiled
+def is_profiling_available():
+    return profile_stages is not None and hasattr(single_layer_sim, 'enable_profiling')
+
+
+# Runs the layer repeats times and keeps the fastest run
+# With trace_dir given, the traces are written there and timed as the trace_writing stage
+def run_layer(layer_id, config_obj, topo_obj, repeats=1, trace_dir=''):
+    if not is_profiling_available():
+        return run_layer_wall_clock(layer_id, config_obj, topo_obj, repeats=repeats, trace_dir=trace_dir)
+
+    best = None
+    for _ in range(repeats):
+        layer_sim = single_layer_sim()
+        layer_sim.set_params(layer_id=layer_id,
+                             config_obj=config_obj,
+                             topology_obj=topo_obj,
+                             verbose=False,
+                             save_trace=not trace_dir == '')
+        layer_sim.enable_profiling()
+
+        layer_sim.run()
+        if not trace_dir == '':
+            layer_sim.save_traces(trace_dir)
+
+        profile_items = layer_sim.get_profile_report_items()
+        if best is None or profile_items[0] < best[0][0]:
+            best = (profile_items, layer_sim.get_detail_report_items())
+
+    profile_items, detail_items = best
+    stage_times = {}
+    for idx, stage in enumerate(profile_stages):
+        stage_times[stage] = profile_items[1 + idx]
+
+    layer_params = topo_obj.get_layer_params(layer_id)
+    result = {
+        'layer_name': str(layer_params[0]),
+        'layer_params': [int(x) for x in layer_params[1:]],
+        'array_dims': [int(x) for x in config_obj.get_array_dims()],
+        'dataflow': config_obj.get_dataflow(),
+        'total_time': profile_items[0],
+        'stage_times': stage_times,
+        'total_cycles': int(profile_items[-2]),
+        'cycles_per_sec': float(profile_items[-1]),
+        # IFMAP and filter SRAM reads, OFMAP SRAM writes
+        'sram_accesses': int(detail_items[2]) + int(detail_items[5]) + int(detail_items[8]),
+    }
+    return result
+
+
+# Same as run_layer(), for the trees without the stage profiler
+# The layer is run alone through simulator.run(), the time includes writing its reports and traces
+# The cycles and the accesses are read back from the reports, hence only the APIs of the first release are used
+def run_layer_wall_clock(layer_id, config_obj, topo_obj, repeats=1, trace_dir=''):
+    layer_params = topo_obj.get_layer_params(layer_id)
+
+    best = None
+    for _ in range(repeats):
+        layer_topo = topologies()
+        layer_topo.append_layer_entry(list(layer_params), toponame='layer')
+
+        top_path = tempfile.mkdtemp(prefix='scalesim_throughput_', dir=trace_dir if not trace_dir == '' else None)
+        sim = simulator()
+        sim.set_params(config_obj=config_obj,
+                       topo_obj=layer_topo,
+                       top_path=top_path,
+                       verbosity=False,
+                       save_trace=not trace_dir == '')
+
+        start = time.perf_counter()
+        sim.run()
+        total_time = time.perf_counter() - start
+
+        report_dir = os.path.join(top_path, config_obj.get_run_name())
+        comp_items = read_report_items(os.path.join(report_dir, 'COMPUTE_REPORT.csv'))
+        detail_items = read_report_items(os.path.join(report_dir, 'DETAILED_ACCESS_REPORT.csv'))
+        shutil.rmtree(top_path, ignore_errors=True)
+
+        if best is None or total_time < best[0]:
+            best = (total_time, comp_items, detail_items)
+
+    total_time, comp_items, detail_items = best
+    total_cycles = int(float(comp_items[0]))
+
+    result = {
+        'layer_name': str(layer_params[0]),
+        'layer_params': [int(x) for x in layer_params[1:]],
+        'array_dims': [int(x) for x in config_obj.get_array_dims()],
+        'dataflow': config_obj.get_dataflow(),
+        'total_time': total_time,
+        'stage_times': {},
+        'total_cycles': total_cycles,
+        'cycles_per_sec': total_cycles / max(total_time, 1e-9),
+        # IFMAP and filter SRAM reads, OFMAP SRAM writes
+        'sram_accesses': int(float(detail_items[2])) + int(float(detail_items[5])) + int(float(detail_items[8])),
+    }
+    return result
+
+
+# Report items of the first layer in a report file, without the LayerID
+def read_report_items(filename):
+    f = open(filename, 'r')
+    lines = f.readlines()
+    f.close()
+
+    fields = [x.strip() for x in lines[1].split(',')]
+    return [x for x in fields[1:] if not x == '']
+
+
+# Slope of the least squares line through the points, in the log-log space
+def get_scaling_exponent(work, times):
+    if len(work) < 2:
+        return 0.0
+    log_work = np.log(np.asarray(work, dtype=np.float64))
+    log_times = np.log(np.maximum(np.asarray(times, dtype=np.float64), 1e-9))
+    if np.ptp(log_work) == 0:
+        return 0.0
+    return float(np.polyfit(log_work, log_times, 1)[0])
+
+
+#
+def print_case(case):
+    print('  ' + case['name'] + ': ' + "{:.4f}".format(case['total_time']) + ' s, '
+          + "{:.0f}".format(case['cycles_per_sec']) + ' cycles/s')
+
+
+# Speedup of each case found in both the files, matched by the case name
+def compare_results(old_results, new_results):
+    old_cases = {}
+    for case in old_results['cases']:
+        old_cases[case['name']] = case
+
+    if not old_results.get('timing', 'stages') == new_results.get('timing', 'stages'):
+        print('WARNING: One of the runs is timed end to end through the simulator, '
+              'the times include the reports and the setup of the run')
+
+    print('Speedup over ' + str(old_results.get('commit', '')) + ' (old time / new time):')
+    old_total = 0
+    new_total = 0
+    for case in new_results['cases']:
+        if case['name'] not in old_cases:
+            continue
+        old_time = old_cases[case['name']]['total_time']
+        new_time = case['total_time']
+        old_total += old_time
+        new_total += new_time
+        print('  ' + case['name'] + ': ' + "{:.2f}".format(old_time / max(new_time, 1e-9)) + 'x')
+
+    if new_total > 0:
+        print('  Total: ' + "{:.2f}".format(old_total / new_total) + 'x')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-c', metavar='Config file', type=str,
+                        default="./configs/scale.cfg",
+                        help="Path to the config file"
+                        )
+    parser.add_argument('-t', metavar='Topology files', type=str, nargs='*',
+                        default=default_topologies,
+                        help="Topology files to time layer by layer"
+                        )
+    parser.add_argument('-o', metavar='Output file', type=str,
+                        default="./throughput.json",
+                        help="Path to the output json file"
+                        )
+    parser.add_argument('-d', metavar='Dataflows', type=str, nargs='+',
+                        default=[],
+                        help="Dataflows to time, default: the dataflow in the config"
+                        )
+    parser.add_argument('-l', metavar='Max layers', type=int,
+                        default=0,
+                        help="Maximum number of layers timed per topology, 0: all layers"
+                        )
+    parser.add_argument('-m', metavar='Max MACs', type=float,
+                        default=1e8,
+                        help="Layers with more MACs than this are skipped, 0: no limit"
+                        )
+    parser.add_argument('-r', metavar='Repeats', type=int,
+                        default=3,
+                        help="Runs per case, the fastest one is reported"
+                        )
+    parser.add_argument('-s', metavar='Scaling steps', type=int,
+                        default=4,
+                        help="Points per scaled dimension of the synthetic layers, 0: no synthetic layers"
+                        )
+    parser.add_argument('-b', metavar='Base M N K Array', type=int, nargs=4,
+                        default=[64, 64, 64, 8],
+                        help="Synthetic layer the dimensions are scaled from, the array is square"
+                        )
+    parser.add_argument('-f', metavar='Factor', type=int,
+                        default=2,
+                        help="Growth of the scaled dimension from a point to the next"
+                        )
+    parser.add_argument('--traces', action='store_true',
+                        help="Also write the traces of each run to a temporary directory and time them"
+                        )
+    parser.add_argument('--compare', metavar='Old results', type=str,
+                        default='',
+                        help="Results file of an earlier run to compare with"
+                        )
+    args = parser.parse_args()
+
+    assert args.r > 0, 'At least one run per case is needed'
+    assert args.f > 1, 'The scaling factor should be at least 2'
+
+    config_obj = scale_config()
+    config_obj.read_conf_file(args.c)
+
+    dataflows = args.d
+    if len(dataflows) == 0:
+        dataflows = [config_obj.get_dataflow()]
+
+    trace_dir = ''
+    if args.traces:
+        trace_dir = tempfile.mkdtemp(prefix='scalesim_throughput_')
+
+    results = {
+        'version': results_version,
+        'commit': get_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'config': args.c,
+        'bandwidth_mode': 'USER' if config_obj.use_user_dram_bandwidth() else 'CALC',
+        'repeats': args.r,
+        'traces': args.traces,
+        'timing': 'stages' if is_profiling_available() else 'wall_clock',
+        'cases': [],
+        'scaling': [],
+    }
+
+    if not is_profiling_available():
+        print('WARNING: No stage profiler in this tree, the layers are timed end to end through the simulator')
+
+    start = time.perf_counter()
+    for dataflow in dataflows:
+        df_config = scale_config()
+        df_config.read_conf_file(args.c)
+        df_config.set_dataflow(dataflow)
+
+        # Representative layers
+        for topofile in args.t:
+            topo_obj = topologies()
+            topo_obj.load_arrays(topofile=topofile, mnk_inputs=is_gemm_topology(topofile))
+            topo_obj.topo_calc_hyperparams()
+
+            num_layers = topo_obj.get_num_layers()
+            if args.l > 0:
+                num_layers = min(num_layers, args.l)
+
+            print('Timing ' + topofile + ' (' + dataflow + ')')
+            for layer_id in range(num_layers):
+                macs = topo_obj.get_layer_mac_ops(layer_id)
+                if args.m > 0 and macs > args.m:
+                    print('  ' + topo_obj.get_layer_name(layer_id) + ': skipped, ' + str(macs) + ' MACs')
+                    continue
+
+                case = run_layer(layer_id, df_config, topo_obj, repeats=args.r, trace_dir=trace_dir)
+                case['suite'] = 'topology'
+                case['topology'] = topofile
+                case['name'] = os.path.basename(topofile) + ':' + case['layer_name'] + ':' + dataflow
+                results['cases'].append(case)
+                print_case(case)
+
+        # Synthetic layers, one dimension scaled at a time from the base layer
+        for dim in scaled_dims:
+            if args.s == 0:
+                break
+
+            print('Scaling ' + dim + ' (' + dataflow + ')')
+            work = []
+            times = []
+            values = []
+            for step in range(args.s):
+                m, n, k, arr = args.b
+                scale = args.f ** step
+                if dim == 'M':
+                    m *= scale
+                elif dim == 'N':
+                    n *= scale
+                elif dim == 'K':
+                    k *= scale
+                else:
+                    arr *= scale
+
+                point_config = scale_config()
+                point_config.read_conf_file(args.c)
+                point_config.set_dataflow(dataflow)
+                point_config.set_arr_dims(rows=arr, cols=arr)
+
+                case = run_layer(0, point_config, get_gemm_topology(m, n, k), repeats=args.r, trace_dir=trace_dir)
+                case['suite'] = 'synthetic'
+                case['scaled_dim'] = dim
+                # The base layer is a point of every scaled dimension, hence the dimension in the name
+                case['name'] = 'scale_' + dim + ':' + case['layer_name'] + ':' + str(arr) + 'x' + str(arr) + ':' + dataflow
+                results['cases'].append(case)
+                print_case(case)
+
+                values.append([m, n, k, arr])
+                work.append(case['sram_accesses'])
+                times.append(case['total_time'])
+
+            exponent = get_scaling_exponent(work, times)
+            results['scaling'].append({
+                'scaled_dim': dim,
+                'dataflow': dataflow,
+                'points': values,
+                'sram_accesses': work,
+                'total_times': times,
+                'exponent': exponent,
+                'super_linear': exponent > super_linear_exponent,
+            })
+
+            log = '  Time ~ accesses^' + "{:.2f}".format(exponent)
+            if exponent > super_linear_exponent:
+                log += '  <-- super linear'
+            print(log)
+
+    results['benchmark_time'] = time.perf_counter() - start
+
+    if not trace_dir == '':
+        shutil.rmtree(trace_dir, ignore_errors=True)
+
+    f = open(args.o, 'w')
+    json.dump(results, f, indent=2)
+    f.close()
+
+    print('Cases timed: ' + str(len(results['cases'])) + ', in ' + "{:.2f}".format(results['benchmark_time']) + ' s')
+    print('Results written to ' + args.o)
+
+    if not args.compare == '':
+        f = open(args.compare, 'r')
+        old_results = json.load(f)
+        f.close()
+        compare_results(old_results, results)
+
+
+if __name__ == '__main__':
+    main()
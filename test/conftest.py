@@ -0,0 +1,41 @@
+# Config and topology shared by the unit tests
+# The array and the buffers are small, so that the layers run in several folds and their operands do not fit
+import pytest
+
+from scalesim.scale_config import scale_config
+from scalesim.topology_utils import topologies
+
+
+def make_config(dataflow='os'):
+    config_obj = scale_config()
+    config_obj.force_valid()
+    config_obj.set_arr_dims(rows=4, cols=4)
+    config_obj.set_buffer_sizes_kb(ifmap_size_kb=1, filter_size_kb=1, ofmap_size_kb=1)
+    config_obj.set_dataflow(dataflow)
+    return config_obj
+
+
+# Two strided convolutions of the same shape with a rectangular window, a convolution of another shape and a GEMM
+def make_topology():
+    topo_obj = topologies()
+    topo_obj.append_topo_entry_from_list(['Conv1', 9, 7, 3, 2, 3, 5, 2])
+    topo_obj.append_topo_entry_from_list(['Conv2', 9, 7, 3, 2, 3, 5, 2])
+    topo_obj.append_topo_entry_from_list(['Conv3', 6, 6, 3, 3, 2, 4, 1])
+    topo_obj.append_topo_entry_from_list(['GEMM1', 6, 10, 1, 10, 1, 7, 1])
+    return topo_obj
+
+
+# The tests for a single dataflow override it with @pytest.mark.parametrize('dataflow', [...])
+@pytest.fixture(params=['os', 'ws', 'is'])
+def dataflow(request):
+    return request.param
+
+
+@pytest.fixture
+def config_obj(dataflow):
+    return make_config(dataflow)
+
+
+@pytest.fixture
+def topo_obj():
+    return make_topology()
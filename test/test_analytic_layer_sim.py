@@ -0,0 +1,122 @@
+# Analytic fidelity mode run end to end through the simulator, checked against the detailed mode
+import pytest
+
+from scalesim.scale_config import scale_config
+from scalesim.topology_utils import topologies
+from scalesim.simulator import simulator
+
+
+topology_rows = [
+    'Layer name, IFMAP Height, IFMAP Width, Filter Height, Filter Width, Channels, Num Filter, Strides,',
+    'Conv1, 12, 12, 3, 3, 4, 8, 1,',
+    'Conv2, 10, 10, 3, 3, 8, 20, 1,',
+    'FC1, 1, 1, 1, 1, 72, 10, 1,',
+]
+
+
+def write_config(path, dataflow, bandwidth_mode):
+    lines = [
+        '[general]',
+        'run_name = analytic_' + dataflow + '_' + bandwidth_mode,
+        '',
+        '[architecture_presets]',
+        'ArrayHeight: 8',
+        'ArrayWidth: 8',
+        'IfmapSramSzkB: 1',
+        'FilterSramSzkB: 1',
+        'OfmapSramSzkB: 1',
+        'IfmapOffset: 0',
+        'FilterOffset: 10000000',
+        'OfmapOffset: 20000000',
+        'Bandwidth : 10',
+        'Dataflow : ' + dataflow,
+        'MemoryBanks: 1',
+        '',
+        '[run_presets]',
+        'InterfaceBandwidth: ' + bandwidth_mode,
+    ]
+    path.write_text('\n'.join(lines) + '\n')
+
+
+def run_simulator(tmp_path, dataflow, bandwidth_mode, fidelity, **kwargs):
+    config_file = tmp_path / 'scale.cfg'
+    write_config(config_file, dataflow, bandwidth_mode)
+    topology_file = tmp_path / 'topology.csv'
+    topology_file.write_text('\n'.join(topology_rows) + '\n')
+
+    config_obj = scale_config()
+    config_obj.read_conf_file(str(config_file))
+    topo_obj = topologies()
+    topo_obj.load_arrays(topofile=str(topology_file))
+
+    sim = simulator()
+    sim.set_params(config_obj=config_obj,
+                   topo_obj=topo_obj,
+                   top_path=str(tmp_path / fidelity),
+                   verbosity=False,
+                   save_trace=False,
+                   fidelity=fidelity,
+                   **kwargs)
+    sim.run()
+    return sim
+
+
+# The options of the detailed mode which do not apply to the analytic mode are ignored
+@pytest.mark.parametrize('num_workers', [1, 2])
+def test_analytic_run(tmp_path, num_workers):
+    sim = run_simulator(tmp_path, 'ws', 'USER', 'analytic',
+                        num_workers=num_workers,
+                        lazy_operands=True,
+                        spill_threshold_mb=1,
+                        matrix_cache_mb=1,
+                        profile=True)
+
+    assert len(sim.compute_report_items_list) == len(topology_rows) - 1
+    assert sim.get_total_cycles() > 0
+
+    report_dir = tmp_path / 'analytic' / 'analytic_ws_USER'
+    for report in ['COMPUTE_REPORT.csv', 'BANDWIDTH_REPORT.csv', 'DETAILED_ACCESS_REPORT.csv']:
+        lines = (report_dir / report).read_text().splitlines()
+        assert len(lines) == len(topology_rows)
+
+
+# Compute report, SRAM accesses and OFMAP DRAM writes follow from the fold structure
+# In the CALC mode there are no stalls, hence the compute report is exact
+@pytest.mark.parametrize('dataflow', ['os', 'ws', 'is'])
+def test_analytic_matches_detailed_calc(tmp_path, dataflow):
+    detailed = run_simulator(tmp_path, dataflow, 'CALC', 'detailed')
+    analytic = run_simulator(tmp_path, dataflow, 'CALC', 'analytic')
+
+    for layer_id in range(len(topology_rows) - 1):
+        detailed_comp = [float(x) for x in detailed.compute_report_items_list[layer_id]]
+        analytic_comp = [float(x) for x in analytic.compute_report_items_list[layer_id]]
+        assert analytic_comp == pytest.approx(detailed_comp, rel=1e-6)
+
+        detailed_items = detailed.detail_report_items_list[layer_id]
+        analytic_items = analytic.detail_report_items_list[layer_id]
+        # SRAM IFMAP Reads, SRAM Filter Reads, SRAM OFMAP Writes, DRAM OFMAP Writes
+        for idx in [2, 5, 8, 17]:
+            assert float(analytic_items[idx]) == pytest.approx(float(detailed_items[idx]), rel=0.01)
+
+        # The IFMAP DRAM reads are capped by the unique addresses, the ones of the detailed buffers
+        assert 0 < float(analytic_items[11]) <= float(detailed_items[11])
+
+
+# With the user bandwidth the stalls come only from the DRAM traffic which has to stream in
+# during the compute, the refetches of the detailed buffers are not modelled.
+# Hence the cycles estimated are a lower bound of the detailed ones.
+@pytest.mark.parametrize('dataflow', ['os', 'ws', 'is'])
+def test_analytic_cycles_bound_user(tmp_path, dataflow):
+    detailed = run_simulator(tmp_path, dataflow, 'USER', 'detailed')
+    analytic = run_simulator(tmp_path, dataflow, 'USER', 'analytic')
+
+    for layer_id in range(len(topology_rows) - 1):
+        detailed_cycles = int(detailed.compute_report_items_list[layer_id][0])
+        analytic_cycles = int(analytic.compute_report_items_list[layer_id][0])
+        assert 0 < analytic_cycles <= detailed_cycles
+
+        # SRAM accesses do not depend on the bandwidth
+        detailed_items = detailed.detail_report_items_list[layer_id]
+        analytic_items = analytic.detail_report_items_list[layer_id]
+        for idx in [2, 5, 8]:
+            assert float(analytic_items[idx]) == pytest.approx(float(detailed_items[idx]), rel=0.01)
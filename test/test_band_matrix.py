@@ -0,0 +1,78 @@
+# Band matrices of the demand folds match the dense matrices they stand for
+import numpy as np
+import pytest
+
+from scalesim.band_matrix import get_skewed_band, get_unskewed_band, concatenate_bands, \
+    concatenate_demand_blocks, get_valid_requests, get_dense_demand, get_null_lines
+from scalesim.compute.systolic_compute_os import skew_matrix
+
+
+# The input with null rows on the top and the bottom, and null columns on the right up to num_cols
+def get_padded(input_matrix, num_cols, prefix_rows, suffix_rows):
+    rows, cols = input_matrix.shape
+    padded = np.full((prefix_rows + rows + suffix_rows, num_cols), -1, dtype=input_matrix.dtype)
+    padded[prefix_rows:prefix_rows + rows, :cols] = input_matrix
+    return padded
+
+
+def get_input(rows, cols, seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.integers(0, 1000, size=(rows, cols)).astype(np.int32)
+
+
+shapes = [(1, 1, 1), (5, 3, 3), (3, 5, 8), (7, 2, 4), (2, 7, 7), (6, 6, 9)]
+
+
+@pytest.mark.parametrize('rows, cols, num_cols', shapes)
+@pytest.mark.parametrize('prefix_rows, suffix_rows', [(0, 0), (3, 0), (0, 4), (2, 5)])
+def test_skewed_band_matches_skew_matrix(rows, cols, num_cols, prefix_rows, suffix_rows):
+    input_matrix = get_input(rows, cols)
+    band = get_skewed_band(input_matrix, num_cols=num_cols, prefix_rows=prefix_rows, suffix_rows=suffix_rows)
+
+    expected = skew_matrix(get_padded(input_matrix, num_cols, prefix_rows, suffix_rows))
+    dense = band.to_dense()
+    assert band.shape == expected.shape
+    assert dense.dtype == expected.dtype
+    assert np.array_equal(dense, expected)
+    assert np.array_equal(np.asarray(band), expected)
+
+    # Only the input is stored
+    assert band.get_band_elems().shape[0] == rows * cols
+
+
+@pytest.mark.parametrize('rows, cols, num_cols', shapes)
+def test_unskewed_band(rows, cols, num_cols):
+    input_matrix = get_input(rows, cols)
+    band = get_unskewed_band(input_matrix, num_cols=num_cols, prefix_rows=2, suffix_rows=3)
+    assert np.array_equal(band.to_dense(), get_padded(input_matrix, num_cols, 2, 3))
+
+
+# Blocks of rows and the stacked bands, as the memory system takes these
+def test_rows_and_concatenate():
+    bands = [get_skewed_band(get_input(4, 3, seed), num_cols=5, prefix_rows=seed, suffix_rows=2)
+             for seed in range(3)]
+    dense = np.concatenate([band.to_dense() for band in bands], axis=0)
+
+    stacked = concatenate_bands(bands)
+    assert np.array_equal(stacked.to_dense(), dense)
+
+    for start_row, end_row in [(0, 4), (3, 11), (10, dense.shape[0]), (5, 5), (20, 100)]:
+        assert np.array_equal(stacked[start_row:end_row].to_dense(), dense[start_row:end_row])
+        assert np.array_equal(stacked[start_row:end_row, :].to_dense(), dense[start_row:end_row, :])
+
+    blocks = [stacked[0:7], stacked[7:9], stacked[9:]]
+    assert np.array_equal(concatenate_demand_blocks(blocks).to_dense(), dense)
+
+
+# The valid requests and the null lines are the same for a band and its dense matrix
+def test_valid_requests_and_null_lines():
+    input_matrix = get_input(5, 4)
+    input_matrix[1, 2] = -1
+    band = get_skewed_band(input_matrix, num_cols=6, prefix_rows=2, suffix_rows=3)[1:14]
+    dense = get_dense_demand(band)
+
+    band_elems, band_lines = get_valid_requests(band)
+    dense_elems, dense_lines = get_valid_requests(dense)
+    assert np.array_equal(band_elems, dense_elems)
+    assert np.array_equal(band_lines, dense_lines)
+    assert np.array_equal(get_null_lines(band), get_null_lines(dense))
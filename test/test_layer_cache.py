@@ -0,0 +1,95 @@
+# Store, lookup and eviction of the persistent layer cache
+import os
+
+import pytest
+
+from scalesim import layer_cache as layer_cache_module
+from scalesim.layer_cache import layer_cache, get_dir_size, report_filename
+
+
+comp_items = [100, 0, 50.0, 100.0, 50.0]
+bw_items = [1.0, 2.0, 3.0, 0.5, 0.25, 0.125]
+detail_items = list(range(18))
+
+
+def get_cache(tmp_path, max_size_mb=1):
+    cache = layer_cache()
+    cache.set_params(cache_dir=str(tmp_path / 'cache'), max_size_mb=max_size_mb)
+    return cache
+
+
+def test_store_lookup(tmp_path):
+    cache = get_cache(tmp_path)
+
+    assert cache.lookup('abc') is None
+    cache.store('abc', comp_items, bw_items, detail_items)
+    assert cache.lookup('abc') == (comp_items, bw_items, detail_items)
+
+    # Without the traces stored, a lookup asking for them misses
+    assert cache.lookup('abc', trace_format='csv') is None
+
+
+def test_store_lookup_traces(tmp_path):
+    cache = layer_cache()
+    cache.set_params(cache_dir=str(tmp_path / 'cache'), cache_traces=True)
+
+    layer_dir = tmp_path / 'layer0'
+    layer_dir.mkdir()
+    (layer_dir / 'IFMAP_SRAM_TRACE.csv').write_text('0,1,2\n')
+
+    cache.store('abc', comp_items, bw_items, detail_items, dir_name=str(layer_dir), trace_format='csv')
+    assert cache.lookup('abc', trace_format='csv') is not None
+    assert cache.lookup('abc', trace_format='npy') is None
+
+    restore_dir = tmp_path / 'restored'
+    restore_dir.mkdir()
+    cache.restore_traces('abc', str(restore_dir), trace_format='csv')
+    assert (restore_dir / 'IFMAP_SRAM_TRACE.csv').read_text() == '0,1,2\n'
+
+
+# The least recently used entries go first once the cache is over its size
+def test_evict_least_recently_used(tmp_path):
+    cache = get_cache(tmp_path)
+    cache.store('first', comp_items, bw_items, detail_items)
+    entry_size = get_dir_size(cache.get_entry_dir('first'))
+
+    cache.max_size_bytes = 2 * entry_size
+    cache.store('second', comp_items, bw_items, detail_items)
+
+    # 'first' is used after 'second'
+    os.utime(os.path.join(cache.get_entry_dir('first'), report_filename), (2000, 2000))
+    os.utime(os.path.join(cache.get_entry_dir('second'), report_filename), (1000, 1000))
+
+    cache.store('third', comp_items, bw_items, detail_items)
+
+    assert cache.lookup('second') is None
+    assert cache.lookup('first') is not None
+    assert cache.lookup('third') is not None
+    assert cache.get_size_bytes() <= cache.max_size_bytes
+
+    cache.clear()
+    assert cache.get_size_bytes() == 0
+
+
+# The layers with the same shape share the key, the name does not matter
+def test_layer_key(tmp_path, config_obj, topo_obj):
+    cache = get_cache(tmp_path)
+
+    key0 = cache.get_layer_key(config_obj, topo_obj, 0)
+    assert key0 == cache.get_layer_key(config_obj, topo_obj, 1)
+    assert not key0 == cache.get_layer_key(config_obj, topo_obj, 2)
+
+    config_obj.set_arr_dims(rows=8, cols=8)
+    assert not key0 == cache.get_layer_key(config_obj, topo_obj, 0)
+
+
+# A change in the simulator sources changes all the keys
+@pytest.mark.parametrize('dataflow', ['os'])
+def test_layer_key_sources(tmp_path, monkeypatch, config_obj, topo_obj):
+    cache = get_cache(tmp_path)
+
+    key = cache.get_layer_key(config_obj, topo_obj, 0)
+    assert len(layer_cache_module.get_sources_hash()) == 64
+
+    monkeypatch.setattr(layer_cache_module, 'sources_hash', 'changed')
+    assert not key == cache.get_layer_key(config_obj, topo_obj, 0)
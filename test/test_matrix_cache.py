@@ -0,0 +1,74 @@
+# Size bounded LRU cache of the matrices shared by the layers of a run
+import numpy as np
+import pytest
+
+from scalesim.matrix_cache import matrix_cache, freeze_arrays
+
+mb = 1024 * 1024
+
+
+def get_cache(max_size_mb):
+    cache = matrix_cache()
+    cache.set_params(max_size_mb=max_size_mb)
+    return cache
+
+
+# The least recently used entries are dropped till the cache fits its size
+def test_lru_eviction_by_size():
+    cache = get_cache(max_size_mb=3)
+
+    cache.store('a', 'A', 1 * mb)
+    cache.store('b', 'B', 1 * mb)
+    cache.store('c', 'C', 1 * mb)
+    assert cache.get_num_entries() == 3
+
+    # 'a' is used after 'b' and 'c'
+    assert cache.lookup('a') == 'A'
+
+    cache.store('d', 'D', 2 * mb)
+    assert cache.lookup('b') is None
+    assert cache.lookup('c') is None
+    assert cache.lookup('a') == 'A'
+    assert cache.lookup('d') == 'D'
+    assert cache.get_size_bytes() == 3 * mb
+    assert cache.get_hit_counts() == (3, 2)
+
+
+def test_store_replaces_entry():
+    cache = get_cache(max_size_mb=2)
+
+    cache.store('a', 'A', 1 * mb)
+    cache.store('a', 'A2', 2 * mb)
+    assert cache.get_num_entries() == 1
+    assert cache.get_size_bytes() == 2 * mb
+    assert cache.lookup('a') == 'A2'
+
+
+# A value larger than the whole cache is not stored, and does not evict anything
+def test_store_too_large():
+    cache = get_cache(max_size_mb=1)
+
+    cache.store('a', 'A', mb // 2)
+    cache.store('b', 'B', 2 * mb)
+    assert cache.lookup('b') is None
+    assert cache.lookup('a') == 'A'
+
+
+# Shrinking the limit evicts right away
+def test_set_params_evicts():
+    cache = get_cache(max_size_mb=4)
+    for key in ['a', 'b', 'c', 'd']:
+        cache.store(key, key.upper(), 1 * mb)
+
+    cache.set_params(max_size_mb=2)
+    assert cache.get_num_entries() == 2
+    assert cache.lookup('c') == 'C'
+    assert cache.lookup('d') == 'D'
+
+
+def test_freeze_arrays():
+    arrays = [np.zeros((4, 4), dtype=np.int32), np.zeros(8, dtype=np.int64)]
+    assert freeze_arrays(arrays) == 4 * 4 * 4 + 8 * 8
+
+    with pytest.raises(ValueError):
+        arrays[0][0, 0] = 1
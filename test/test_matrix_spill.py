@@ -0,0 +1,89 @@
+# Matrices spilled to memmap files match the matrices built in the memory
+import os
+
+import numpy as np
+import pytest
+
+from scalesim.matrix_spill import matrix_spill, block_writer
+from scalesim.compute.operand_matrix import operand_matrix
+from scalesim.single_layer_sim import single_layer_sim
+
+
+def get_spill(tmp_path, threshold_mb=1e-6):
+    spill = matrix_spill()
+    spill.set_params(scratch_dir=str(tmp_path / 'spill'), threshold_mb=threshold_mb)
+    return spill
+
+
+def get_operand_matrices(config_obj, topo_obj, layer_id, spill=None):
+    op_mat = operand_matrix()
+    op_mat.set_params(config_obj=config_obj, topoutil_obj=topo_obj, layer_id=layer_id)
+    if spill is not None:
+        op_mat.set_matrix_spill(spill)
+    op_mat.create_operand_matrices()
+    return op_mat.get_ifmap_matrix()[1], op_mat.get_filter_matrix()[1], op_mat.get_ofmap_matrix()[1]
+
+
+@pytest.mark.parametrize('dataflow', ['os'])
+@pytest.mark.parametrize('layer_id', [0, 2, 3])
+def test_spilled_operands_match(tmp_path, layer_id, config_obj, topo_obj):
+    spill = get_spill(tmp_path)
+    spilled = get_operand_matrices(config_obj, topo_obj, layer_id, spill)
+    in_memory = get_operand_matrices(config_obj, topo_obj, layer_id)
+
+    for spilled_matrix, matrix in zip(spilled, in_memory):
+        assert isinstance(spilled_matrix, np.memmap)
+        assert not isinstance(matrix, np.memmap)
+        assert spilled_matrix.dtype == matrix.dtype
+        assert np.array_equal(spilled_matrix, matrix)
+
+    # The mapped matrices stay readable once the files are removed
+    spill_dir = spill.spill_dir
+    spill.release()
+    assert not os.path.isdir(spill_dir)
+    assert np.array_equal(spilled[0], in_memory[0])
+
+
+# Below the threshold the matrices stay in the memory
+def test_allocate_below_threshold(tmp_path):
+    spill = get_spill(tmp_path, threshold_mb=1)
+
+    matrix = spill.allocate((4, 4), np.int32)
+    assert not isinstance(matrix, np.memmap)
+    assert not spill.is_spilled()
+
+    matrix = spill.allocate((1024, 1024), np.int32)
+    assert isinstance(matrix, np.memmap)
+    assert spill.is_spilled()
+    spill.release()
+
+
+@pytest.mark.parametrize('threshold_mb', [1e-6, 1e-4, 1])
+def test_block_writer(tmp_path, threshold_mb):
+    spill = get_spill(tmp_path, threshold_mb=threshold_mb)
+    blocks = [np.arange(i * 24, (i + 1) * 24, dtype=np.int32).reshape((6, 4)) for i in range(10)]
+
+    writer = block_writer(spill, name='demand')
+    for block in blocks:
+        writer.append(block)
+    stacked = writer.finish()
+
+    assert isinstance(stacked, np.memmap) == (threshold_mb < 1)
+    assert np.array_equal(stacked, np.concatenate(blocks))
+    spill.release()
+
+
+# The reports of a layer do not change when its matrices are spilled
+def test_spilled_layer_reports(tmp_path, config_obj, topo_obj):
+    reports = []
+    for spill in [None, get_spill(tmp_path)]:
+        layer_sim = single_layer_sim()
+        layer_sim.set_params(layer_id=0, config_obj=config_obj, topology_obj=topo_obj,
+                             verbose=False, save_trace=False)
+        if spill is not None:
+            layer_sim.set_matrix_spill(spill)
+        layer_sim.run()
+        reports.append(layer_sim.get_compute_report_items() + layer_sim.get_bandwidth_report_items()
+                       + layer_sim.get_detail_report_items())
+
+    assert reports[0] == reports[1]
@@ -0,0 +1,68 @@
+# Design space sweep, each point checked against a run of the layer on its own
+import pytest
+
+from scalesim.single_layer_sim import single_layer_sim
+from scalesim.sweep import sweep, sweep_params, get_point_config, parse_param_grid, get_layer_operand_matrix
+
+
+def run_layer(config_obj, topo_obj, layer_id):
+    layer_sim = single_layer_sim()
+    layer_sim.set_params(layer_id=layer_id, config_obj=config_obj, topology_obj=topo_obj,
+                         verbose=False, save_trace=False)
+    layer_sim.run()
+    return layer_sim.get_compute_report_items() + layer_sim.get_bandwidth_report_items() \
+           + layer_sim.get_detail_report_items()
+
+
+@pytest.mark.parametrize('dataflow', ['os'])
+@pytest.mark.parametrize('num_workers', [1, 2])
+def test_sweep_matches_layer_runs(num_workers, config_obj, topo_obj):
+    s = sweep()
+    s.set_params(config_obj=config_obj,
+                 topo_obj=topo_obj,
+                 param_grid=parse_param_grid(['ArrayHeight=4,8', 'Dataflow=os,ws']),
+                 num_workers=num_workers,
+                 verbose=False)
+    s.run()
+
+    results = s.get_results()
+    assert len(s.config_points) == 4
+    assert len(results) == 4 * topo_obj.get_num_layers()
+
+    for row in results:
+        point = row[:len(sweep_params)]
+        layer_id = row[len(sweep_params)]
+        expected = run_layer(get_point_config(config_obj, point), topo_obj, layer_id)
+        assert [float(x) for x in row[len(sweep_params) + 2:]] == [float(x) for x in expected]
+
+    total_cycles = s.get_total_cycles_per_point()
+    assert len(total_cycles) == 4
+    assert all([cycles > 0 for cycles in total_cycles])
+
+
+# The chunks of config points of a layer run by a worker share its operand matrices
+@pytest.mark.parametrize('dataflow', ['os'])
+def test_operand_matrix_shared_by_chunks(config_obj, topo_obj):
+    op_mat_obj = get_layer_operand_matrix(2, config_obj, topo_obj)
+    assert get_layer_operand_matrix(2, config_obj, topo_obj) is op_mat_obj
+
+
+# Without a grid the sweep is the config itself
+def test_sweep_default_grid(tmp_path, dataflow, config_obj, topo_obj):
+    s = sweep()
+    s.set_params(config_obj=config_obj, topo_obj=topo_obj, verbose=False)
+    assert s.param_grid == {}
+    assert s.config_points == [[4, 4, 1, 1, 1, dataflow]]
+
+    s.run()
+    filename = tmp_path / 'sweep.csv'
+    s.write_results(str(filename))
+
+    lines = filename.read_text(encoding='utf-8').splitlines()
+    assert lines[0] == ', '.join(s.get_header()) + ','
+    assert len(lines) == 1 + topo_obj.get_num_layers()
+
+
+def test_parse_param_grid():
+    grid = parse_param_grid(['ArrayHeight=8, 16,32', 'Dataflow=os,is'])
+    assert grid == {'ArrayHeight': [8, 16, 32], 'Dataflow': ['os', 'is']}
@@ -0,0 +1,47 @@
+# Rows appended to the arena match the rows stacked in one go
+import numpy as np
+
+from scalesim.memory.trace_arena import trace_arena
+
+
+def test_append_grows_capacity():
+    arena = trace_arena()
+    arena.set_params(num_cols=3, init_rows=2)
+
+    blocks = [np.full((rows, 3), rows, dtype=np.int64) for rows in [1, 2, 5, 9]]
+    for block in blocks:
+        arena.append(block)
+
+    assert arena.get_num_rows() == 17
+    assert np.array_equal(arena.get_view(), np.concatenate(blocks, axis=0))
+    assert arena.storage.shape[0] == 32
+
+
+# Narrower blocks are padded, a wider block pads the rows stored before
+def test_append_pads_narrow_and_wide_blocks():
+    arena = trace_arena()
+    arena.set_params(num_cols=0, pad_value=1)
+
+    arena.append(np.array([[0, 10]]))
+    arena.append(np.array([[1, 11, 21, 31]]))
+    arena.append(np.array([[2, 12, 22]]))
+
+    expected = np.array([[0, 10, 1, 1], [1, 11, 21, 31], [2, 12, 22, 1]])
+    assert arena.get_num_cols() == 4
+    assert np.array_equal(arena.get_view(), expected)
+
+
+# The discarded rows make room before the storage is grown
+def test_discard_rows_reuses_storage():
+    arena = trace_arena()
+    arena.set_params(num_cols=2, init_rows=4)
+
+    arena.append(np.arange(8).reshape((4, 2)))
+    arena.discard_rows(3)
+    arena.append(np.arange(8, 14).reshape((3, 2)))
+
+    assert arena.storage.shape[0] == 4
+    assert np.array_equal(arena.get_view(), np.arange(6, 14).reshape((4, 2)))
+
+    arena.discard_rows(4)
+    assert arena.is_empty()
@@ -0,0 +1,98 @@
+# Traces streamed to the disk match the traces written in one go
+import numpy as np
+import pytest
+
+from scalesim.memory.trace_sink import trace_sink
+from scalesim.trace_utils import write_trace, load_trace
+
+
+# Blocks of rows of varying widths, the cycles in the first column
+def get_trace_blocks():
+    blocks = []
+    cycle = 0
+    for rows, cols in [(5, 3), (7, 3), (4, 5), (6, 2), (3, 5), (2, 4)]:
+        block = np.arange(rows * cols, dtype=np.int64).reshape((rows, cols)) + 100 * cycle
+        block[:, 0] = np.arange(cycle, cycle + rows)
+        blocks.append(block)
+        cycle += rows
+    return blocks
+
+
+# The trace kept in the memory, the narrower rows padded with 1s
+def get_padded_trace(blocks):
+    num_cols = max([block.shape[1] for block in blocks])
+    padded = []
+    for block in blocks:
+        pad = np.ones((block.shape[0], num_cols - block.shape[1]), dtype=block.dtype)
+        padded.append(np.concatenate((block, pad), axis=1))
+    return np.concatenate(padded, axis=0)
+
+
+def read_csv_lines(filename):
+    with open(filename, 'r') as f:
+        return f.read().splitlines()
+
+
+# A wider block after some rows are on the disk pads the rows written before, when the sink is closed
+@pytest.mark.parametrize('flush_rows', [1, 4, 1000])
+def test_widen_and_pad_csv(tmp_path, flush_rows):
+    blocks = get_trace_blocks()
+    filename = str(tmp_path / 'TRACE.csv')
+
+    sink = trace_sink()
+    sink.set_params(filename, trace_format='csv', flush_rows=flush_rows)
+    for block in blocks:
+        sink.append(block)
+    sink.close()
+
+    expected_filename = str(tmp_path / 'EXPECTED.csv')
+    write_trace(expected_filename, get_padded_trace(blocks), trace_format='csv')
+
+    assert read_csv_lines(filename) == read_csv_lines(expected_filename)
+    assert sink.get_num_rows() == sum([block.shape[0] for block in blocks])
+    assert sink.get_start_stop_cycles() == (0, sink.get_num_rows() - 1)
+
+
+@pytest.mark.parametrize('flush_rows', [1, 4, 1000])
+def test_widen_and_pad_npy(tmp_path, flush_rows):
+    blocks = get_trace_blocks()
+    filename = str(tmp_path / 'TRACE.npy')
+
+    sink = trace_sink()
+    sink.set_params(filename, trace_format='npy', flush_rows=flush_rows)
+    for block in blocks:
+        sink.append(block)
+    sink.close()
+
+    trace = load_trace(filename, mmap=False)
+    assert trace.dtype == np.int64
+    assert np.array_equal(trace, get_padded_trace(blocks))
+
+
+# The rows of one run are padded in place, the file is rewritten only once for all the runs
+def test_pad_file_to_num_cols(tmp_path):
+    filename = str(tmp_path / 'TRACE.csv')
+    with open(filename, 'w') as f:
+        f.write('0,10\n1,11\n2,12,22,32\n3,13,23\n')
+
+    sink = trace_sink()
+    sink.set_params(filename, trace_format='csv', flush_rows=1)
+    sink.num_rows = 4
+    sink.num_cols = 4
+    sink.file_segments = [[2, 2], [1, 4], [1, 3]]
+    sink.pad_file_to_num_cols()
+
+    assert read_csv_lines(filename) == ['0,10,1,1', '1,11,1,1', '2,12,22,32', '3,13,23,1']
+
+
+# There is no file for a trace without any rows
+def test_empty_trace(tmp_path):
+    filename = tmp_path / 'TRACE.csv'
+
+    sink = trace_sink()
+    sink.set_params(str(filename))
+    sink.append(np.zeros((0, 3), dtype=np.int64))
+    sink.close()
+
+    assert not filename.exists()
+    assert sink.is_closed()
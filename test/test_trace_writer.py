@@ -0,0 +1,107 @@
+# Background writer of the traces, its ordering, bound and error handling
+import threading
+
+import numpy as np
+import pytest
+
+from scalesim.memory.trace_writer import trace_writer
+from scalesim.memory.trace_sink import trace_sink
+from scalesim.trace_utils import load_trace
+
+
+def get_writer(max_pending=2):
+    writer = trace_writer()
+    writer.set_params(max_pending=max_pending)
+    return writer
+
+
+def test_jobs_run_in_order():
+    writer = get_writer()
+    done = []
+    for i in range(20):
+        writer.submit(done.append, i)
+    writer.drain()
+
+    assert done == list(range(20))
+    writer.close()
+
+
+# The error of a job is raised by drain(), once all the jobs queued before it are done
+def test_drain_raises_job_error():
+    writer = get_writer()
+    done = []
+
+    def fail():
+        raise OSError('disk full')
+
+    writer.submit(done.append, 0)
+    writer.submit(fail)
+    writer.submit(done.append, 1)
+
+    with pytest.raises(OSError, match='disk full'):
+        writer.drain()
+    assert done == [0, 1]
+
+    # The error is raised only once, the writer can be used again
+    writer.submit(done.append, 2)
+    writer.drain()
+    assert done == [0, 1, 2]
+    writer.close()
+
+
+def test_close_raises_job_error():
+    writer = get_writer()
+
+    def fail():
+        raise ValueError('bad block')
+
+    writer.submit(fail)
+    with pytest.raises(ValueError, match='bad block'):
+        writer.close()
+    assert writer.thread is None
+
+
+# The submits wait once max_pending jobs are queued
+def test_pending_jobs_bounded():
+    writer = get_writer(max_pending=2)
+    release = threading.Event()
+
+    writer.submit(release.wait)
+    submitter = threading.Thread(target=lambda: [writer.submit(lambda: None) for _ in range(4)])
+    submitter.start()
+    submitter.join(timeout=0.2)
+
+    assert submitter.is_alive()
+    assert writer.get_num_pending() <= 2
+
+    release.set()
+    submitter.join()
+    writer.close()
+    assert writer.get_num_pending() == 0
+
+
+# The traces written through the writer match the ones written in line, a wider block included
+@pytest.mark.parametrize('trace_format', ['csv', 'npy'])
+def test_sink_with_writer(tmp_path, trace_format):
+    blocks = [np.full((3, 2), 1, dtype=np.int64), np.full((2, 4), 2, dtype=np.int64),
+              np.full((4, 3), 3, dtype=np.int64)]
+
+    filenames = []
+    writer = get_writer()
+    for use_writer in [False, True]:
+        filename = str(tmp_path / ('TRACE_' + str(use_writer) + '.' + trace_format))
+        sink = trace_sink()
+        sink.set_params(filename, trace_format=trace_format, flush_rows=2)
+        if use_writer:
+            sink.set_trace_writer(writer)
+        for block in blocks:
+            sink.append(block)
+        sink.close()
+        filenames.append(filename)
+    writer.close()
+
+    if trace_format == 'npy':
+        assert np.array_equal(load_trace(filenames[0], mmap=False), load_trace(filenames[1], mmap=False))
+    else:
+        with open(filenames[0], 'r') as f0, open(filenames[1], 'r') as f1:
+            assert f0.read() == f1.read()